@@ -0,0 +1,135 @@
+"""
+Delivery acknowledgements of the chat messages sent to a socket.
+
+A client that offers the ACK_PROTOCOL subprotocol gets every frame of chat
+messages as records, '!id seq length text', all the records of a frame
+with the same id, the ids of a socket increasing from 1.  It confirms them
+cumulatively with '/ack id', which acknowledges every frame up to id, and
+it may acknowledge many frames at once.  At most size frames are in flight,
+unacknowledged, at a time; the following ones wait for room in the window,
+and those that find no room either are left for replay at the next login.
+When no acknowledgement arrives for timeout seconds every frame in flight
+is sent again with its id, and after retries such timeouts in a row the
+socket is disconnected.
+
+The chat messages of a frame are handed to confirm when the client
+acknowledges it.  Those still unacknowledged when the socket closes are
+never confirmed and are replayed at the next login, so a message is
+delivered at least once.  Each record carries the seq of its message, the
+same in the replay, so the client drops the duplicates.
+"""
+from collections import deque
+from gevent.event import Event
+from gevent.greenlet import Greenlet
+
+from codec import make_record
+import metrics
+
+RETRANSMITTED = metrics.counter("chat_ack_retransmitted_total", "Frames sent again for lack of an acknowledgement.")
+ACK_TIMEOUTS = metrics.counter("chat_ack_timeouts_total", "Sockets disconnected for not acknowledging frames.")
+ACK_DEFERRED = metrics.counter("chat_ack_deferred_total", "Frames left for replay on a full acknowledgement window.")
+
+
+class AckWindow(object):
+    __slots__ = ("write", "confirm", "disconnect", "size", "timeout", "retries", "backlog", "last_id", "acked",
+                 "in_flight", "waiting", "timer", "idle")
+
+    def __init__(self, write, confirm, disconnect, size, timeout, retries, backlog):
+        """
+        write sends a frame on the socket, confirm confirms the chat messages
+        the client has acknowledged and disconnect closes the socket.  backlog
+        is the number of frames that may wait for room in the window.
+        """
+
+        self.write = write
+        self.confirm = confirm
+        self.disconnect = disconnect
+        self.size = size
+        self.timeout = timeout
+        self.retries = retries
+        self.backlog = backlog
+        self.last_id = 0
+        self.acked = 0
+        self.in_flight = deque()
+        self.waiting = deque()
+        self.timer = None
+        self.idle = Event()
+        self.idle.set()
+
+    def send(self, lines, messages):
+        """
+        Sends the chat messages lines, whose (room, seq) are messages, in a
+        frame with the next id, or queues them if the window is full.
+        """
+
+        if len(self.in_flight) < self.size:
+            self._send(lines, messages)
+        elif len(self.waiting) < self.backlog:
+            self.waiting.append((lines, messages))
+        else:
+            ACK_DEFERRED.inc()
+
+    def ack(self, message_id):
+        """ Acknowledges the frames up to message_id and sends those waiting for room."""
+
+        if not self.acked < message_id <= self.last_id:
+            return
+
+        self.acked = message_id
+        acked = []
+        while self.in_flight and self.in_flight[0][0] <= message_id:
+            acked.extend(self.in_flight.popleft()[2])
+        if acked:
+            self.confirm(acked)
+        while self.waiting and len(self.in_flight) < self.size:
+            self._send(*self.waiting.popleft())
+        if not self.in_flight:
+            self.idle.set()
+
+    def wait(self, timeout=None):
+        """ Waits until every frame is acknowledged.  Returns False after timeout seconds."""
+
+        return self.idle.wait(timeout)
+
+    def close(self):
+        """ Stops the retransmissions.  The messages not acknowledged are left for replay."""
+
+        if self.timer is not None:
+            self.timer.kill(block=False)
+            self.timer = None
+        self.in_flight.clear()
+        self.waiting.clear()
+        self.idle.set()
+
+    def _send(self, lines, messages):
+        self.last_id += 1
+        frame = "\n".join([make_record(self.last_id, seq, line) for line, (_, seq) in zip(lines, messages)])
+        self.in_flight.append((self.last_id, frame, messages))
+        self.idle.clear()
+        self.write(frame)
+        if self.timer is None or self.timer.dead:
+            self.timer = Greenlet(self._retransmit)
+            self.timer.start()
+
+    def _retransmit(self):
+        """ Sends the frames in flight again each timeout without an acknowledgement, go-back-N style."""
+
+        failures = 0
+        while self.in_flight:
+            acked = self.acked
+            self.idle.wait(self.timeout)
+            if not self.in_flight:
+                break
+            if self.acked != acked:
+                failures = 0
+                continue
+
+            failures += 1
+            if failures > self.retries:
+                ACK_TIMEOUTS.inc()
+                self.disconnect()
+                return
+            RETRANSMITTED.inc(len(self.in_flight))
+            for _, frame, _ in list(self.in_flight):
+                self.write(frame)
+        self.timer = None
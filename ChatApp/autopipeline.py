@@ -0,0 +1,88 @@
+"""
+Automatic pipelining of redis commands.  The commands issued by different
+greenlets in the same hub tick, or within a window of a few microseconds,
+are sent in one pipeline, so a burst of publishes costs one round trip
+instead of one per message.  Every caller still gets its own result.
+"""
+import gevent
+from gevent.event import AsyncResult
+from redis.exceptions import NoScriptError
+
+import metrics
+
+PIPELINE_COMMANDS = metrics.histogram("chat_redis_pipeline_commands", "Commands sent in one auto pipeline.",
+                                      (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+
+class AutoPipeline(object):
+    def __init__(self, redis, window=0):
+        """ window is how long in seconds the first command of a pipeline waits for others."""
+
+        self.redis = redis
+        self.window = window
+        self.pending = []
+        self.flusher = None
+        self.loaded_scripts = set()
+
+    def call(self, function, *args):
+        """
+        Calls function(*args, client=pipeline) in the pipeline of the current
+        tick and returns its result once the pipeline ran.  function must
+        queue exactly one command, like a Script or Presence.publish_if_online.
+        """
+
+        result = AsyncResult()
+        self.pending.append((function, args, result))
+        if self.flusher is None:
+            self.flusher = gevent.spawn_later(self.window, self._flush) if self.window else gevent.spawn(self._flush)
+
+        return result.get()
+
+    def _flush(self):
+        batch, self.pending, self.flusher = self.pending, [], None
+        PIPELINE_COMMANDS.observe(len(batch))
+
+        pipe = self.redis.pipeline(transaction=False)
+        queued = []
+        for function, args, result in batch:
+            try:
+                function(*args, client=pipe)
+                queued.append((function, args, result))
+            except Exception, e:
+                result.set_exception(e)
+
+        try:
+            self._load_scripts(pipe)
+            replies = pipe.execute(raise_on_error=False)
+        except Exception, e:
+            for _, _, result in queued:
+                result.set_exception(e)
+            return
+
+        for (function, args, result), reply in zip(queued, replies):
+            if isinstance(reply, NoScriptError):
+                # redis lost its scripts, the script call loads them again
+                self.loaded_scripts.clear()
+                self._call_directly(function, args, result)
+            elif isinstance(reply, Exception):
+                result.set_exception(reply)
+            else:
+                result.set(reply)
+
+    def _load_scripts(self, pipe):
+        """
+        Loads the scripts of the pipeline once per process instead of letting
+        the pipeline check them with an extra round trip on every execute.
+        """
+
+        scripts, pipe.scripts = pipe.scripts, set()
+        for script in scripts:
+            if script.sha not in self.loaded_scripts:
+                script.sha = self.redis.script_load(script.script)
+                self.loaded_scripts.add(script.sha)
+
+    def _call_directly(self, function, args, result):
+        try:
+            result.set(function(*args))
+        except Exception, e:
+            result.set_exception(e)
@@ -0,0 +1,331 @@
+"""
+Benchmarks for the chat server internals.  They need a redis server running
+on localhost:6379.
+
+Usage:
+    benchmark.py idle [sockets] [seconds]
+    benchmark.py codec [iterations]
+    benchmark.py storage [messages] [users]
+    benchmark.py deflate [frames]
+    benchmark.py memory [connections] [none|deflate]
+"""
+import gc
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import gevent
+import redis
+import codec
+import server
+from django.conf import settings
+from django.db import connection
+from deflate import PerMessageDeflate, negotiate, offer
+from logstore import LogStore
+from orm.models import UserModel
+from storage import DjangoStore, Message
+from ws4py.messaging import TextMessage
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class IdleSocket(object):
+    """ Authenticated socket that never receives anything."""
+
+    def send(self, message):
+        pass
+
+
+def cpu_usage(seconds):
+    """ Fraction of one core used by this process while the hub runs for seconds."""
+
+    start_times, start = os.times(), time.time()
+    gevent.sleep(seconds)
+    end_times, end = os.times(), time.time()
+
+    cpu = (end_times[0] - start_times[0]) + (end_times[1] - start_times[1])
+    return cpu / (end - start)
+
+
+def _polling_listener(subscriber, ws):
+    """ The per socket get_message/sleep(0) loop the server used to run."""
+
+    while True:
+        message = subscriber.get_message()
+        if message and message["type"] == "message":
+            ws.send(message["data"])
+
+        gevent.sleep(0)
+
+
+def idle_polling(sockets, seconds):
+    client = redis.StrictRedis(host='localhost', port=6379, db=0)
+    subscribers = []
+    listeners = []
+    for i in range(sockets):
+        subscriber = client.pubsub()
+        subscriber.subscribe("idle_user_%d" % i)
+        subscribers.append(subscriber)
+        listeners.append(gevent.spawn(_polling_listener, subscriber, IdleSocket()))
+
+    usage = cpu_usage(seconds)
+
+    gevent.killall(listeners)
+    for subscriber in subscribers:
+        subscriber.close()
+
+    return usage
+
+
+def idle_blocking(sockets, seconds):
+    adapter = server.RedisAdapter()
+    connections = []
+    for i in range(sockets):
+        connection = ("idle_user_%d" % i, IdleSocket())
+        adapter.add_connection(*connection)
+        connections.append(connection)
+
+    usage = cpu_usage(seconds)
+
+    for connection in connections:
+        adapter.remove_connection(*connection)
+    gevent.joinall(adapter.listeners.values())
+
+    return usage
+
+
+def idle(sockets=1000, seconds=5):
+    """ CPU used by a server holding idle authenticated sockets."""
+
+    sockets, seconds = int(sockets), float(seconds)
+    print "CPU use for %d idle sockets over %.1fs" % (sockets, seconds)
+    print "  polling listener per socket: %5.1f%%" % (100 * idle_polling(sockets, seconds))
+    print "  shared blocking listener:    %5.1f%%" % (100 * idle_blocking(sockets, seconds))
+
+
+class LegacyMessageUtils:
+    """ The per message codec instance the server used to create."""
+
+    def make_message(self, username, message_text):
+        if username and message_text:
+            return "@" + str(username) + " >> " + message_text
+
+        raise Exception("Trying to create message with invalid username.")
+
+    def parse_message(self, message):
+        tokens = str(message).split(None, 1)
+
+        if len(tokens) == 2:
+            user = tokens[0]
+            message_text = tokens[1]
+
+            if user.startswith('@') and message_text:
+                return user[1:], message_text
+
+        raise Exception("Message could not be parsed.")
+
+
+def _allocations(function, iterations):
+    """ Memory blocks allocated per call, None without tracemalloc."""
+
+    if tracemalloc is None:
+        return None
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    snapshot = tracemalloc.take_snapshot()
+    for i in range(iterations):
+        function()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    return sum(stat.count_diff for stat in after.compare_to(snapshot, "filename")) / float(iterations)
+
+
+def codec_(iterations=200000):
+    """ Time (and allocations where tracemalloc exists) per message of the codec."""
+
+    iterations = int(iterations)
+    message = TextMessage("@to_user " + "x" * 200)
+
+    cases = [
+        ("parse  MessageUtils", lambda: LegacyMessageUtils().parse_message(message)),
+        ("parse  codec",        lambda: codec.parse_message(message)),
+        ("format MessageUtils", lambda: LegacyMessageUtils().make_message(u"from_user", "x" * 200)),
+        ("format codec",        lambda: codec.make_message(u"from_user", "x" * 200)),
+    ]
+
+    print "Codec cost per message over %d messages" % iterations
+    for name, function in cases:
+        seconds = timeit.timeit(function, number=iterations)
+        print "  %s: %6.0f ns" % (name, seconds / iterations * 1e9),
+        blocks = _allocations(function, iterations // 10)
+        print "" if blocks is None else "%5.1f allocations" % blocks
+
+
+def _store_throughput(store, users, messages):
+    """ Messages per second saved, then replayed as offline backlogs."""
+
+    batch_size = settings.CHAT_PERSIST_BATCH_SIZE
+    batch = [Message(users[i % len(users)], "x" * 100, to_user=users[(i + 1) % len(users)])
+             for i in range(messages)]
+
+    start = time.time()
+    for i in range(0, messages, batch_size):
+        store.save(batch[i:i + batch_size])
+    saved = messages / (time.time() - start)
+
+    start = time.time()
+    replayed = sum(len(chunk) for user in users
+                   for chunk in store.undelivered(user, settings.CHAT_OFFLINE_CHUNK_SIZE))
+    return saved, replayed / (time.time() - start)
+
+
+def storage(messages=100000, users=100):
+    """ Throughput of the database store on a sqlite file and of the log store."""
+
+    messages, users = int(messages), int(users)
+    directory = tempfile.mkdtemp()
+    settings.DATABASES["default"]["TEST_NAME"] = os.path.join(directory, "benchmark.sqlite3")
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        UserModel.objects.bulk_create([UserModel(username="storage_user_%d" % i) for i in range(users)])
+        users = list(UserModel.objects.all())
+        log = LogStore(os.path.join(directory, "log"))
+
+        print "Messages per second for %d messages to %d users" % (messages, len(users))
+        print "                      save   replay"
+        for name, store in (("database (sqlite)", DjangoStore()), ("append-only log", log)):
+            print "  %-17s %7.0f  %7.0f" % ((name,) + _store_throughput(store, users, messages))
+
+        log.close()
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        shutil.rmtree(directory)
+
+
+def _chat_messages(count, seed=0):
+    words = ("the", "meeting", "is", "moved", "to", "tomorrow", "ok", "thanks", "see", "you", "at", "lunch",
+             "did", "anyone", "read", "report", "yes", "no", "maybe", "later", "deploy", "done", "fixed", "bug")
+    rng = random.Random(seed)
+    return [codec.make_delivery(None, "user_%d" % rng.randint(0, 50),
+                                " ".join(rng.choice(words) for j in range(rng.randint(3, 20))))
+            for i in range(count)]
+
+
+def deflate(frames=200):
+    """ Bytes saved and time spent by permessage-deflate on an offline replay and on single room messages."""
+
+    frames = int(frames)
+    workloads = [
+        ("replay", ["\n".join(_chat_messages(settings.CHAT_OFFLINE_CHUNK_SIZE, i)) for i in range(frames)]),
+        ("single", _chat_messages(frames * 50)),
+    ]
+
+    print "permessage-deflate, compressed size and compression time"
+    print "                           replay frames         single messages"
+    for level in (1, 6, 9):
+        for takeover in (True, False):
+            print "  level %d %-16s" % (level, "takeover" if takeover else "no takeover"),
+            for name, payloads in workloads:
+                deflate = PerMessageDeflate(level, compress_takeover=takeover)
+                start = time.time()
+                size = sum(len(deflate.compress(payload)) for payload in payloads)
+                seconds = time.time() - start
+                print "  %5.1f%% %6.0f MB/s" % (100.0 * size / sum(map(len, payloads)),
+                                               sum(map(len, payloads)) / seconds / 1e6),
+            print
+
+
+class SinkSocket(object):
+    """ Socket of the idle connections, which discards what the server writes."""
+
+    def sendall(self, data):
+        pass
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+
+def _resident_bytes():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def memory(connections=10000, extension="deflate"):
+    """
+    Memory held by the server per idle authenticated connection: the socket
+    object, its outbox and controller, the cached user and session, the
+    subscriptions and, with the deflate extension, the zlib state the
+    CHAT_DEFLATE_* settings keep after the replay frame every connection is
+    sent at login.  The OS socket and the buffers of ws4py's handler are not
+    included, they are the same whatever the server keeps.
+    """
+
+    connections = int(connections)
+    replay = "\n".join(_chat_messages(20))
+    directory = tempfile.mkdtemp()
+    settings.DATABASES["default"]["TEST_NAME"] = os.path.join(directory, "benchmark.sqlite3")
+    # DEBUG keeps every query in memory
+    settings.DEBUG = False
+    old_name = connection.creation.create_test_db(verbosity=0)
+    usernames = ["memory_user_%d" % i for i in range(connections)]
+    sink = SinkSocket()
+    sockets = []
+    try:
+        UserModel.objects.bulk_create([UserModel(username=username) for username in usernames])
+        server.redis_adapter.sessions.ttl = 60
+        gc.collect()
+        objects, resident = len(gc.get_objects()), _resident_bytes()
+
+        for username in usernames:
+            environ = {}
+            if extension == "deflate" and settings.CHAT_DEFLATE_LEVEL is not None:
+                # a client offering context takeover, as client.py does by default
+                environ["chat.deflate"] = negotiate(offer(True), settings.CHAT_DEFLATE_LEVEL,
+                                                    settings.CHAT_DEFLATE_MIN_SIZE,
+                                                    settings.CHAT_DEFLATE_CONTEXT_TAKEOVER,
+                                                    settings.CHAT_DEFLATE_MAX_MESSAGE_SIZE)[1]
+            ws = server.ChatWebSocketServer(sink, environ=environ)
+            ws.opened()
+            ws.received_message(TextMessage(username))
+            ws.send(replay)
+            sockets.append(ws)
+        gevent.sleep(0)
+        gc.collect()
+        objects, resident = len(gc.get_objects()) - objects, _resident_bytes() - resident
+
+        print "Memory per idle authenticated connection over %d connections, %s" % (connections, extension)
+        print "  resident: %6.0f bytes" % (resident / float(connections))
+        print "  objects:  %6.1f tracked by the gc" % (objects / float(connections))
+
+        for ws in sockets:
+            ws.closed(1000)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        shutil.rmtree(directory)
+
+
+benchmarks = {
+    "idle": idle,
+    "codec": codec_,
+    "storage": storage,
+    "deflate": deflate,
+    "memory": memory,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print __doc__
+        exit()
+
+    benchmarks[sys.argv[1]](*sys.argv[2:])
@@ -0,0 +1,43 @@
+from collections import OrderedDict
+import time
+
+MISSING = object()
+
+
+class LRUCache(object):
+    """
+    Size bounded cache that evicts the least recently used entry when full.
+    Entries also expire ttl seconds after they were set.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[0] < time.time():
+            self.misses += 1
+            return default
+
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        self._entries.pop(key, None)
+        self._entries[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
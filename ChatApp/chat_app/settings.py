@@ -60,3 +60,153 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.8/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Chat server
+
+# With CHAT_COOPERATIVE the server patches the standard library with gevent,
+# so redis and the other network I/O yield to the hub instead of blocking
+# every socket, and runs the database queries on at most CHAT_DB_THREADS
+# threads.  0 runs them in the hub, as with an in-memory sqlite database.
+CHAT_COOPERATIVE = True
+CHAT_DB_THREADS = 10
+
+# Chat messages are saved in the background in batches of at most
+# CHAT_PERSIST_BATCH_SIZE, written at the latest CHAT_PERSIST_FLUSH_INTERVAL
+# seconds after the first message of the batch was queued.
+CHAT_PERSIST_BATCH_SIZE = 500
+CHAT_PERSIST_FLUSH_INTERVAL = 0.05
+
+# When CHAT_PERSIST_QUEUE_SIZE messages are waiting to be saved the sender either
+# waits for room in the queue ("block") or saves the queue itself ("flush").
+CHAT_PERSIST_QUEUE_SIZE = 10000
+CHAT_PERSIST_WHEN_FULL = "block"
+
+# A batch that could not be saved is retried after CHAT_PERSIST_RETRY_DELAY
+# seconds, doubled after each further failure up to CHAT_PERSIST_RETRY_MAX_DELAY.
+CHAT_PERSIST_RETRY_DELAY = 0.1
+CHAT_PERSIST_RETRY_MAX_DELAY = 5
+
+# Direct messages are saved undelivered until a socket of the recipient has
+# written them, or the client has acknowledged them.  A confirmation that
+# arrives before another server has saved its message is retried for up to
+# CHAT_DELIVERY_CONFIRM_TIMEOUT seconds, then the message is replayed at the
+# next login.
+CHAT_DELIVERY_CONFIRM_TIMEOUT = 30
+
+# Chat messages are kept by CHAT_STORAGE_BACKEND: "storage.DjangoStore" saves
+# them in the database, "logstore.LogStore" appends them to a local log in
+# CHAT_LOG_DIRECTORY, split into segments of CHAT_LOG_SEGMENT_SIZE bytes and
+# fsynced after every batch if CHAT_LOG_FSYNC.  The log is local to one server
+# process, so multi-process servers need the database.  Past CHAT_LOG_MAX_SIZE
+# bytes the oldest segments are deleted once their messages are delivered.
+CHAT_STORAGE_BACKEND = "storage.DjangoStore"
+CHAT_LOG_DIRECTORY = os.path.join(BASE_DIR, "messages")
+CHAT_LOG_SEGMENT_SIZE = 64 * 1024 * 1024
+CHAT_LOG_FSYNC = False
+CHAT_LOG_MAX_SIZE = 16 * CHAT_LOG_SEGMENT_SIZE
+
+# Offline messages are replayed at login in frames of at most
+# CHAT_OFFLINE_CHUNK_SIZE messages.
+CHAT_OFFLINE_CHUNK_SIZE = 500
+
+# On SIGTERM a server drains: it stops accepting connections, gives the
+# outboxes of its sockets up to CHAT_DRAIN_TIMEOUT seconds to be written and
+# tells every client to reconnect after a random delay of up to
+# CHAT_DRAIN_RECONNECT_SPREAD seconds, so they do not all log in at once.
+CHAT_DRAIN_TIMEOUT = 5
+CHAT_DRAIN_RECONNECT_SPREAD = 10
+
+# '/history @user' returns pages of CHAT_HISTORY_PAGE_SIZE messages, a client
+# can ask for at most CHAT_HISTORY_MAX_PAGE_SIZE.
+CHAT_HISTORY_PAGE_SIZE = 50
+CHAT_HISTORY_MAX_PAGE_SIZE = 500
+
+# Frames to a socket wait in an outbox of at most CHAT_OUTBOX_SIZE frames and
+# are coalesced into frames of up to CHAT_OUTBOX_COALESCE_BYTES.  When the
+# outbox of a slow client is full the oldest frame is dropped ("drop_oldest"),
+# the new one is ("offline") or the client is disconnected ("disconnect").
+# The messages of a dropped frame are not confirmed, so they are replayed at
+# the next login.
+CHAT_OUTBOX_SIZE = 1000
+CHAT_OUTBOX_COALESCE_BYTES = 65536
+CHAT_OUTBOX_WHEN_FULL = "offline"
+
+# Clients that offer the "chat.ack" subprotocol acknowledge the messages they
+# receive.  At most CHAT_ACK_WINDOW messages to a socket are unacknowledged
+# at a time, up to CHAT_OUTBOX_SIZE others wait for room and the rest are
+# kept for replay.  Without an acknowledgement for
+# CHAT_ACK_TIMEOUT seconds the unacknowledged messages are sent again, and
+# after CHAT_ACK_RETRIES such timeouts in a row the client is disconnected.
+# The messages left unacknowledged by a closed socket are replayed at the
+# next login.
+CHAT_ACK_WINDOW = 256
+CHAT_ACK_TIMEOUT = 2
+CHAT_ACK_RETRIES = 3
+
+# Clients that offer permessage-deflate get the frames of at least
+# CHAT_DEFLATE_MIN_SIZE bytes compressed at CHAT_DEFLATE_LEVEL (1-9, None
+# disables the extension).  With CHAT_DEFLATE_CONTEXT_TAKEOVER the compression
+# window is kept between the frames of a socket, which compresses chat much
+# better but keeps about 300KB of zlib state for the life of every socket that
+# was sent a compressed frame, as most are at login.  Compressed messages
+# from clients may inflate to at most CHAT_DEFLATE_MAX_MESSAGE_SIZE bytes.
+CHAT_DEFLATE_LEVEL = 1
+CHAT_DEFLATE_MIN_SIZE = 512
+CHAT_DEFLATE_CONTEXT_TAKEOVER = False
+CHAT_DEFLATE_MAX_MESSAGE_SIZE = 1024 * 1024
+
+# Every socket may send CHAT_SOCKET_RATE messages per second, in bursts of up
+# to CHAT_SOCKET_BURST, and every user CHAT_USER_RATE per second, in bursts of
+# up to CHAT_USER_BURST, over all its sockets in the cluster.  Frames over a
+# limit are dropped.  A burst must hold the largest batch a client sends.
+# None disables the limit.  Servers lease the tokens of a user from redis
+# CHAT_USER_RATE_LEASE at a time.
+CHAT_SOCKET_RATE = 100
+CHAT_SOCKET_BURST = 200
+CHAT_USER_RATE = 200
+CHAT_USER_BURST = 400
+CHAT_USER_RATE_LEASE = 10
+
+# A client logging in again with the token of its session is authenticated
+# from redis instead of the database.  Sessions expire CHAT_SESSION_TTL
+# seconds after their last login and every server caches up to
+# CHAT_SESSION_CACHE_SIZE of them for CHAT_SESSION_CACHE_TTL seconds.
+CHAT_SESSION_TTL = 7 * 24 * 3600
+CHAT_SESSION_CACHE_SIZE = 10000
+CHAT_SESSION_CACHE_TTL = 300
+
+# Users are cached by every server in an LRU cache of at most
+# CHAT_USER_CACHE_SIZE entries that expire after CHAT_USER_CACHE_TTL seconds.
+# Unknown usernames are remembered for CHAT_USER_CACHE_NEGATIVE_TTL seconds.
+CHAT_USER_CACHE_SIZE = 10000
+CHAT_USER_CACHE_TTL = 300
+CHAT_USER_CACHE_NEGATIVE_TTL = 5
+
+# The channels and keys of the users and rooms are spread over the redis
+# nodes of CHAT_REDIS_NODES by a consistent hash of the username or room
+# name; the first node also keeps the keys of the whole cluster.  Every
+# server must use the same nodes.  After changing them run
+# 'manage.py rebalance_chat_shards' to move the rooms to their new nodes.
+# Every server connects to every node with a pool of at most
+# CHAT_REDIS_MAX_CONNECTIONS connections.  A command waits up to
+# CHAT_REDIS_POOL_TIMEOUT seconds for a free connection, then fails.  The
+# nodes are pinged every CHAT_REDIS_HEALTH_INTERVAL seconds; the commands to
+# a node that did not answer fail at once until it answers again.
+CHAT_REDIS_NODES = ["redis://localhost:6379/0"]
+CHAT_REDIS_MAX_CONNECTIONS = 50
+CHAT_REDIS_POOL_TIMEOUT = 5
+CHAT_REDIS_HEALTH_INTERVAL = 1
+
+# Publishes issued within CHAT_REDIS_PIPELINE_WINDOW seconds of each other are
+# sent to redis in one pipeline.  0 pipelines those of the same hub tick.
+CHAT_REDIS_PIPELINE_WINDOW = 0
+
+# Users stay online in the cluster-wide presence registry for
+# CHAT_PRESENCE_TTL seconds after the last heartbeat of their server.
+CHAT_PRESENCE_TTL = 30
+
+# Metrics are served in the Prometheus text format on
+# http://127.0.0.1:CHAT_METRICS_PORT/metrics, on the following ports for the
+# other worker processes.  None disables them.
+CHAT_METRICS_PORT = None
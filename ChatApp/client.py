@@ -1,24 +1,345 @@
 from gevent import monkey; monkey.patch_socket()
+from collections import deque
 import gevent
+import random
+import socket
+import ssl
 import sys
+from codec import (ACK_PROTOCOL, BATCH_SEPARATOR, COMMAND_PREFIX, RECORD_PREFIX, make_ack, make_batch, make_resume,
+                   make_session, parse_command, parse_delivery, parse_records)
+from deflate import DeflateStream, accept, offer
 from gevent import select
 from ws4py.client.geventclient import WebSocketClient
+from ws4py.exc import HandshakeError
 from ws4py import configure_logger
 
 logger = configure_logger()
 
+class ReconnectPolicy(object):
+    """
+    Exponential backoff with full jitter: after the n-th failed attempt in a
+    row a client waits a random time of up to min(max_delay, base_delay *
+    2 ** n).  The first attempt waits the delay a draining server asked for.
+    """
+
+    def __init__(self, base_delay=0.5, max_delay=30, max_attempts=None):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+
+    def delay(self, attempt, hint=None):
+        if attempt == 0 and hint is not None:
+            return hint
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class RecentIds(object):
+    """ The last size ids added, to recognise the messages received twice."""
+
+    def __init__(self, size):
+        self.order = deque()
+        self.ids = set()
+        self.size = size
+
+    def __contains__(self, message_id):
+        return message_id in self.ids
+
+    def add(self, message_id):
+        if len(self.order) >= self.size:
+            self.ids.discard(self.order.popleft())
+        self.order.append(message_id)
+        self.ids.add(message_id)
+
+
 class ChatWebsocketClient(WebSocketClient):
-    def __init__(self, url, event_listeners, protocols=None, extensions=None, ssl_options=None, headers=None):
+    def __init__(self, url, event_listeners, protocols=None, extensions=None, ssl_options=None, headers=None,
+                 batch_size=100, batch_bytes=65536, batch_delay=0.005,
+                 deflate_level=None, deflate_min_size=512, deflate_context_takeover=True,
+                 acks=False, ack_every=32, ack_delay=0.5, dedupe_size=4096):
+        """
+        With deflate_level the client offers permessage-deflate and, if the
+        server accepts, compresses the messages of at least deflate_min_size
+        bytes it sends.  With acks it offers the acknowledgement subprotocol,
+        drops the messages among the last dedupe_size it has received
+        already, on this connection or the ones it resumes, and acknowledges
+        every ack_every frames, or ack_delay seconds after the first one it
+        has not acknowledged.
+        """
+
+        self.options = dict(protocols=protocols, extensions=extensions, ssl_options=ssl_options, headers=headers,
+                            batch_size=batch_size, batch_bytes=batch_bytes, batch_delay=batch_delay,
+                            deflate_level=deflate_level, deflate_min_size=deflate_min_size,
+                            deflate_context_takeover=deflate_context_takeover,
+                            acks=acks, ack_every=ack_every, ack_delay=ack_delay, dedupe_size=dedupe_size)
+        if deflate_level is not None:
+            headers = (headers or []) + [("Sec-WebSocket-Extensions", offer(deflate_context_takeover))]
+        if acks:
+            protocols = list(protocols or []) + [ACK_PROTOCOL]
         WebSocketClient.__init__(self, url, protocols, extensions, ssl_options=ssl_options, headers=headers)
         self.listeners = event_listeners
+        self.deflate_level = deflate_level
+        self.deflate_min_size = deflate_min_size
+        self.deflate = None
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.batch_delay = batch_delay
+        self._batch = []
+        self._batch_length = 0
+        self._flusher = None
+        self.username = None
+        self.cursor = "0"
+        self.session = None
+        self.reconnect_delay = None
+        self._login = None
+        self.received = RecentIds(dedupe_size) if acks else None
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        self.duplicates = 0
+        self.acks_sent = 0
+        # every frame up to acked has been received, those up to ack_sent acknowledged, and ids after acked
+        self.acked = 0
+        self.ack_sent = 0
+        self.ids = set()
+        self._acker = None
+
+    def login(self, username):
+        """
+        Authenticates as username, resuming the offline backlog after the
+        last chunk this client or the one it replaces has received.  With
+        the token of a session it logs in with the session, which the server
+        checks without querying its database.
+        """
+
+        self._login = username
+        if self.session is not None:
+            self.send("%s %s" % (make_session(self.session), self.cursor))
+        else:
+            self.send("%s %s" % (username, self.cursor))
+
+    def reconnected(self):
+        """
+        Returns a new, unconnected client like this one, which resumes where
+        this one stopped.  It drops the messages this one has received, which
+        the server replays when they were not acknowledged.
+        """
+
+        client = ChatWebsocketClient(self.url, self.listeners, **self.options)
+        client.username = self.username
+        client.cursor = self.cursor
+        client.session = self.session
+        if self.received is not None:
+            client.received = self.received
+        return client
+
+    def received_message(self, message):
+        """
+        Handles the commands of the server: keeps the token of the session,
+        confirms the chunks of the offline backlog and keeps the reconnect
+        delay of a draining server.  The other lines are queued for receive().
+        """
+
+        if self.received is not None and message.data[:1] == RECORD_PREFIX:
+            message.data = self._unframe(message.data)
+            if not message.data:
+                return
+
+        data = message.data
+        if self.username is None and self._login is not None and "Authentication successful." in data:
+            self.username = self._login
+        if self.session is not None and self._login is not None and "Invalid session." in data.split("\n"):
+            # the session expired, log in by username
+            self.session = None
+            self.login(self._login)
+        if data[:1] != COMMAND_PREFIX and "\n" + COMMAND_PREFIX not in data:
+            return WebSocketClient.received_message(self, message)
+
+        lines = []
+        for line in data.split("\n"):
+            try:
+                command, arguments = parse_command(line)
+            except Exception:
+                command, arguments = None, None
+            if command == "resume" and len(arguments) == 1:
+                self.cursor = arguments[0]
+                self.send(make_resume(self.cursor))
+            elif command == "session" and len(arguments) == 1:
+                self.session = arguments[0]
+            elif command == "reconnect" and len(arguments) == 1 and arguments[0].isdigit():
+                self.reconnect_delay = int(arguments[0]) / 1000.0
+                if self.acked > self.ack_sent:
+                    # the server waits for them before it closes the socket
+                    self.send_ack()
+            else:
+                lines.append(line)
+
+        if lines:
+            message.data = "\n".join(lines)
+            WebSocketClient.received_message(self, message)
+
+    def send_ack(self):
+        """ Acknowledges every frame received so far."""
+
+        acker, self._acker = self._acker, None
+        if acker is not None and acker is not gevent.getcurrent():
+            acker.kill(block=False)
+        if not self.terminated:
+            self.ack_sent = self.acked
+            self.acks_sent += 1
+            self.send(make_ack(self.acked))
+
+    def _unframe(self, data):
+        """
+        Returns the text of the records of data, without the chat messages
+        received already, which are recognised by their room, sender and
+        seq.  The server sends a frame again when it is not acknowledged in
+        time, so a frame received twice means the acknowledgement is late
+        and it is sent at once.
+        """
+
+        try:
+            records = parse_records(bytes(data))
+        except Exception:
+            return data
+
+        ids = set(message_id for message_id, _, _ in records if message_id)
+        duplicate = any(message_id <= self.acked or message_id in self.ids for message_id in ids)
+        self.ids.update(message_id for message_id in ids if message_id > self.acked)
+
+        lines = []
+        for message_id, seq, text in records:
+            key = None
+            if seq:
+                try:
+                    key = parse_delivery(text)[:2] + (seq,)
+                except Exception:
+                    pass
+            if (message_id and message_id <= self.acked) or key in self.received:
+                self.duplicates += 1
+                continue
+            if key is not None:
+                self.received.add(key)
+            lines.append(text)
+
+        while self.acked + 1 in self.ids:
+            self.acked += 1
+            self.ids.discard(self.acked)
+        if duplicate or self.acked - self.ack_sent >= self.ack_every:
+            self.send_ack()
+        elif self.acked > self.ack_sent and self._acker is None:
+            self._acker = gevent.spawn_later(self.ack_delay, self.send_ack)
+        return "\n".join(lines)
+
+    def send_batched(self, message):
+        """
+        Queues message to be sent in one frame with the messages that follow
+        it.  The frame is sent when batch_size messages or batch_bytes are
+        queued, or batch_delay seconds after its first message.  The server
+        reports the errors of a frame in one reply, a 'position: error' line
+        for each failed message.
+        """
+
+        if BATCH_SEPARATOR in message:
+            raise ValueError("Message contains the batch separator.")
+
+        self._batch.append(message)
+        self._batch_length += len(message) + 1
+        if len(self._batch) >= self.batch_size or self._batch_length >= self.batch_bytes:
+            self.flush()
+        elif self._flusher is None:
+            self._flusher = gevent.spawn_later(self.batch_delay, self.flush)
+
+    def flush(self):
+        """ Sends the queued messages now."""
+
+        flusher, self._flusher = self._flusher, None
+        if flusher is not None and flusher is not gevent.getcurrent():
+            flusher.kill(block=False)
+
+        if self._batch:
+            batch, self._batch, self._batch_length = self._batch, [], 0
+            self.send(make_batch(batch))
+
+    def send(self, payload, binary=False):
+        """ Compresses payload if the server accepted permessage-deflate."""
+
+        if self.deflate is not None and isinstance(payload, basestring):
+            self._write(self.deflate.frame(payload, binary, mask=True))
+        else:
+            WebSocketClient.send(self, payload, binary)
+
+    def close(self, code=1000, reason=''):
+        """ Sends the queued messages and acknowledgements before closing."""
+
+        if not self.terminated:
+            self.flush()
+            if self.acked > self.ack_sent:
+                self.send_ack()
+        WebSocketClient.close(self, code, reason)
+
+    def connect(self):
+        """
+        Same as WebSocketClient.connect, but never reads past the handshake
+        response.  The ws4py parser drops whatever follows the first frame of a
+        read, so the frames the server sends right after the handshake were
+        sometimes lost and the connection closed with a protocol error.
+        """
+
+        if self.scheme == "wss":
+            self.sock = ssl.wrap_socket(self.sock, **self.ssl_options)
+
+        self.sock.connect(self.bind_addr)
+        self._write(self.handshake_request)
+
+        response = b''
+        while True:
+            peeked = self.sock.recv(1024, socket.MSG_PEEK)
+            if not peeked:
+                break
+
+            end = (response + peeked).find(self.end_of_headers)
+            if end == -1:
+                response += self.sock.recv(len(peeked))
+            else:
+                response += self.sock.recv(end + len(self.end_of_headers) - len(response))
+                break
+
+        if not response:
+            self.close_connection()
+            raise HandshakeError("Invalid response")
+
+        response_line, _, headers = response[:-len(self.end_of_headers)].partition(b'\r\n')
+        try:
+            self.process_response_line(response_line)
+            self.protocols, _ = self.process_handshake_header(headers)
+            # ws4py garbles the extensions header, it is read here
+            lines = [line.partition(b':') for line in headers.split(b'\r\n')]
+            self.extensions = [value.strip() for name, _, value in lines
+                               if name.strip().lower() == b'sec-websocket-extensions']
+            if self.deflate_level is not None:
+                self.deflate = accept(",".join(self.extensions), self.deflate_level, self.deflate_min_size, None)
+        except (HandshakeError, ValueError):
+            self.close_connection()
+            raise
+
+        if self.deflate is not None:
+            self.stream = DeflateStream(self.deflate, always_mask=True, expect_masking=False)
+        self.handshake_ok()
+
+    end_of_headers = b'\r\n\r\n'
 
 
 class UIController(object):
     errors = {"connect": "There was an error connecting to the ChatServer:"}
 
-    def __init__(self, ws_client, ui):
+    def __init__(self, ws_client, ui, policy=None):
+        """
+        With a ReconnectPolicy the first line the user enters logs in, and a
+        lost connection is replaced by a new one logged in as the same user.
+        """
+
         self.ui = ui
         self.ws_client = ws_client
+        self.policy = policy
 
     def run(self):
         try:
@@ -39,7 +360,6 @@ class UIController(object):
             if self.ui.is_closed():
                 break
             self.send_message(m)
-            gevent.sleep(0)
 
         self.ws_client.close()
 
@@ -49,13 +369,42 @@ class UIController(object):
 
             #msg is None iff ws_client is closed
             if msg is None:
-                break
+                if self.policy is None or self.ui.is_closed() or self.ws_client.username is None:
+                    break
+                self.ws_client = self.reconnect()
+                if self.ws_client is None:
+                    break
+                continue
 
             self.ui.show_message(msg)
-            gevent.sleep(0)
 
     def send_message(self, msg):
-        self.ws_client.send(msg)
+        if self.policy is not None and self.ws_client.username is None:
+            self.ws_client.login(msg)
+        else:
+            self.ws_client.send(msg)
+
+    def reconnect(self):
+        """ Connects a client replacing ws_client as the policy says.  Returns None if it gives up."""
+
+        old = self.ws_client
+        attempt = 0
+        while not self.ui.is_closed():
+            gevent.sleep(self.policy.delay(attempt, old.reconnect_delay))
+            client = old.reconnected()
+            try:
+                client.connect()
+            except Exception, e:
+                attempt += 1
+                if self.policy.max_attempts is not None and attempt >= self.policy.max_attempts:
+                    self.ui.show_message(self.errors["connect"])
+                    self.ui.show_message(e)
+                    return None
+                continue
+
+            client.login(client.username)
+            return client
+        return None
 
 
 class ChatConsoleUI(object):
@@ -90,5 +439,5 @@ if __name__ == "__main__":
     ui = ChatConsoleUI()
     client = ChatWebsocketClient(WEBSOCKET_URL, PROTOCOLS)
 
-    controller = UIController(client, ui)
+    controller = UIController(client, ui, ReconnectPolicy())
     controller.run()
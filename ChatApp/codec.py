@@ -0,0 +1,218 @@
+"""
+Text protocol of the chat server.  The functions are stateless and work on
+the payload of the ws4py message directly, so nothing is instantiated or
+copied per message.
+
+    @username text      message to a user
+    #room text          message to the members of a room
+    /command arguments  command, e.g. '/join #room', '/leave #room' or
+                        '/history @username [before-seq] [limit]'
+
+A frame starting with BATCH_SEPARATOR carries several of these messages,
+each one preceded by the separator.
+
+The server sends three commands of its own.  A client that logs in with
+'username cursor' gets every chunk of its offline backlog followed by
+'/resume cursor', which it sends back once it has the chunk and uses as the
+cursor of its next login.  After a login by username the server sends
+'/session token'; the client logs in again with '/session token cursor',
+which skips the user lookup.  A draining server sends
+'/reconnect milliseconds' before it closes the socket.
+
+A client that offers the ACK_PROTOCOL subprotocol gets every frame as
+records, '!id seq length text', separated by newlines.  length is the size
+of text in bytes, so a text holding newlines or '!' never reads as another
+record.  The client acknowledges the ids with '/ack id'; id 0 is not
+acknowledged and seq, 0 for the lines of the server, tells the chat
+messages received twice apart.
+"""
+
+ROOM_PREFIX = "#"
+COMMAND_PREFIX = "/"
+BATCH_SEPARATOR = "\x1e"
+ACK_PROTOCOL = "chat.ack"
+ACK_COMMAND = COMMAND_PREFIX + "ack "
+RECORD_PREFIX = "!"
+
+
+def make_message(username, message_text):
+    """ Given a username and text, this formats the message to be sent to the user."""
+
+    if username and message_text:
+        # CPython grows the temporary string in place, which is cheaper than a join here
+        return "@" + str(username) + " >> " + message_text
+
+    raise Exception("Trying to create message with invalid username.")
+
+
+def make_room_message(room, username, message_text):
+    """ Formats a message sent by username to the members of room."""
+
+    return str(room) + " " + make_message(username, message_text)
+
+
+def make_delivery(room, username, message_text):
+    """ Formats a direct message, or a room message when room is set."""
+
+    if room:
+        return make_room_message(room, username, message_text)
+    return make_message(username, message_text)
+
+
+def make_history_message(seq, username, message_text):
+    """ Formats a message of a conversation history, preceded by its seq."""
+
+    return str(seq) + " " + make_message(username, message_text)
+
+
+def make_resume(cursor):
+    """ Formats the command that ends a chunk of offline messages, and confirms it."""
+
+    return COMMAND_PREFIX + "resume " + cursor
+
+
+def make_session(token):
+    """ Formats the command giving a client the token of its session, which it logs in again with."""
+
+    return COMMAND_PREFIX + "session " + token
+
+
+def make_reconnect(delay):
+    """ Formats the command telling a client to reconnect after delay seconds."""
+
+    return COMMAND_PREFIX + "reconnect %d" % (delay * 1000)
+
+
+def make_record(message_id, seq, text):
+    """ Frames text with the id the client acknowledges and the seq of its chat message."""
+
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    return "%s%d %d %d %s" % (RECORD_PREFIX, message_id, seq, len(text), text)
+
+
+def make_ack(message_id):
+    """ Formats the command acknowledging the messages up to message_id."""
+
+    return ACK_COMMAND + str(message_id)
+
+
+def parse_delivery(message):
+    """
+    Inverse of make_delivery: returns the room (None for a direct message),
+    the username of the sender and the text of a delivered message.
+    """
+
+    room = None
+    if message[:1] == ROOM_PREFIX:
+        room, _, message = message.partition(" ")
+
+    username, separator, message_text = message.partition(" >> ")
+    if len(username) > 1 and username[0] == "@" and separator and message_text:
+        return room, username[1:], message_text
+
+    raise Exception("Message could not be parsed.")
+
+
+def is_room(address):
+    return len(address) > 1 and address[0] == ROOM_PREFIX
+
+
+def is_command(message):
+    return getattr(message, "data", message)[:1] == COMMAND_PREFIX
+
+
+def is_ack(message):
+    return getattr(message, "data", message)[:len(ACK_COMMAND)] == ACK_COMMAND
+
+
+def is_batch(message):
+    return getattr(message, "data", message)[:1] == BATCH_SEPARATOR
+
+
+def make_batch(messages):
+    """ Packs messages into the payload of a single frame."""
+
+    return BATCH_SEPARATOR + BATCH_SEPARATOR.join(messages)
+
+
+def count_messages(message):
+    """ Returns the number of messages in a frame, without parsing it."""
+
+    payload = getattr(message, "data", message)
+    if payload[:1] == BATCH_SEPARATOR:
+        return payload.count(BATCH_SEPARATOR)
+    return 1
+
+
+def parse_batch(message):
+    """ Returns the messages packed by make_batch."""
+
+    return getattr(message, "data", message)[1:].split(BATCH_SEPARATOR)
+
+
+def parse_message(message):
+    """
+    Given a text message including the username and actual message, parses
+    the message into username and actual message_text.  message is a ws4py
+    message or its payload.  Rooms are returned with their '#' prefix.
+    """
+
+    tokens = getattr(message, "data", message).split(None, 1)
+
+    if len(tokens) == 2:
+        address, message_text = tokens
+
+        if address[:1] == '@' and message_text:
+            return address[1:], message_text
+
+        if is_room(address) and message_text:
+            return address, message_text
+
+    raise Exception("Message could not be parsed.")
+
+
+def parse_records(frame):
+    """ Inverse of make_record over the records of a frame: returns their (id, seq, text)."""
+
+    records = []
+    start = 0
+    while start < len(frame):
+        if frame[start:start + 1] != RECORD_PREFIX:
+            raise Exception("Record could not be parsed.")
+        fields = []
+        for i in range(3):
+            end = frame.find(" ", start + 1)
+            if end == -1:
+                raise Exception("Record could not be parsed.")
+            fields.append(int(frame[start + 1:end]))
+            start = end
+        message_id, seq, length = fields
+        text = frame[start + 1:start + 1 + length]
+        if len(text) != length:
+            raise Exception("Record could not be parsed.")
+        records.append((message_id, seq, text))
+        # the newline separating the records
+        start += length + 2
+    return records
+
+
+def parse_ack(message):
+    """ Returns the id acknowledged by an '/ack id' command."""
+
+    message_id = getattr(message, "data", message)[len(ACK_COMMAND):].strip()
+    if is_ack(message) and message_id.isdigit():
+        return int(message_id)
+
+    raise Exception("Usage: /ack id")
+
+
+def parse_command(message):
+    """ Parses '/command arguments' into the command name and its arguments."""
+
+    tokens = getattr(message, "data", message).split()
+
+    if tokens and len(tokens[0]) > 1 and tokens[0][0] == COMMAND_PREFIX:
+        return tokens[0][1:], tokens[1:]
+
+    raise Exception("Command could not be parsed.")
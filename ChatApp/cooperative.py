@@ -0,0 +1,85 @@
+"""
+Cooperative I/O for the chat server.
+
+With CHAT_COOPERATIVE the server patches the standard library with gevent
+before it imports anything else, so the sockets of redis-py, the DNS lookups
+and the sleeps yield to the hub instead of blocking every connected user.
+Threads are not patched: database drivers are C code that gevent cannot
+make cooperative, so the queries run on a pool of at most CHAT_DB_THREADS
+real threads, each with its own connection, while the hub serves the other
+sockets.  An in-memory sqlite database only exists in the connection that
+created it, so its queries always run in the calling greenlet.
+"""
+import os; os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chat_app.settings")
+import sys
+from django.conf import settings
+from gevent import monkey
+from gevent.threadpool import ThreadPool
+
+_END = object()
+
+
+def patch():
+    """ Patches the standard library if CHAT_COOPERATIVE is set.  Runs before the other imports of the server."""
+
+    if settings.CHAT_COOPERATIVE:
+        monkey.patch_all(thread=False)
+
+
+def _in_memory_database():
+    from django.db import connection
+
+    name = connection.settings_dict["NAME"]
+    return connection.vendor == "sqlite" and (not name or name == ":memory:" or "mode=memory" in name)
+
+
+def _capture(function, args, kwargs):
+    # the pool would also print the exceptions raised on its threads
+    try:
+        return True, function(*args, **kwargs)
+    except Exception:
+        return False, sys.exc_info()
+
+
+class DatabaseThreads(object):
+    def __init__(self, size=None):
+        """ size defaults to CHAT_DB_THREADS; 0 runs every call in the calling greenlet."""
+
+        self.size = size
+        self.pool = None
+
+    def call(self, function, *args, **kwargs):
+        """ Runs function on a database thread, waiting for it without blocking the hub."""
+
+        if self.pool is None:
+            size = settings.CHAT_DB_THREADS if self.size is None else self.size
+            if not size or _in_memory_database():
+                return function(*args, **kwargs)
+            self.pool = ThreadPool(size)
+
+        ok, result = self.pool.apply(_capture, (function, args, kwargs))
+        if not ok:
+            raise result[0], result[1], result[2]
+        return result
+
+    def iterate(self, iterator):
+        """ Advances iterator on the database threads, one item per call."""
+
+        while True:
+            item = self.call(next, iterator, _END)
+            if item is _END:
+                return
+            yield item
+
+    def run(self, function):
+        """ Decorates a function to be called on the database threads."""
+
+        def call(*args, **kwargs):
+            return self.call(function, *args, **kwargs)
+
+        call.__name__ = function.__name__
+        call.__doc__ = function.__doc__
+        return call
+
+
+database = DatabaseThreads()
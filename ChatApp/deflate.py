@@ -0,0 +1,295 @@
+"""
+permessage-deflate (RFC 7692) for the ws4py sockets, which support no
+extension themselves.
+
+During the handshake the server answers the offer of a client with
+negotiate() and the client reads the answer with accept(); both get a
+PerMessageDeflate that compresses the messages they send and inflates the
+ones they receive.  The first frame of a compressed message has its RSV1 bit
+set, which the ws4py parser rejects, so a socket that negotiated the
+extension reads its frames through a DeflateStream.
+
+Compressing a message costs CPU, so only messages of at least min_size bytes
+are compressed.  With context takeover the compression window is kept
+between the messages of a socket and the repeated '@user >> ' prefixes of a
+chat compress to almost nothing, at the price of about 300KB of zlib state
+per socket once it sent a compressed message.
+"""
+import os
+import zlib
+from struct import unpack
+
+from ws4py.exc import ProtocolException, FrameTooLargeException
+from ws4py.framing import Frame, OPCODE_CONTINUATION, OPCODE_TEXT, OPCODE_BINARY, OPCODE_CLOSE, OPCODE_PING, \
+    OPCODE_PONG
+from ws4py.messaging import TextMessage, BinaryMessage, CloseControlMessage, PingControlMessage, \
+    PongControlMessage
+from ws4py.streaming import Stream, VALID_CLOSING_CODES
+
+EXTENSION = "permessage-deflate"
+# a compressed message ends with an empty stored block, left out on the wire
+TAIL = "\x00\x00\xff\xff"
+
+
+class MessageTooLarge(Exception):
+    pass
+
+
+class PerMessageDeflate(object):
+    def __init__(self, level=6, min_size=0, compress_takeover=True, decompress_takeover=True,
+                 window_bits=15, max_size=None):
+        self.level = level
+        self.min_size = min_size
+        self.compress_takeover = compress_takeover
+        self.decompress_takeover = decompress_takeover
+        self.window_bits = window_bits
+        self.max_size = max_size
+        self._compressor = None
+        self._decompressor = None
+
+    def compress(self, data):
+        """ Returns the compressed payload of a message, without the tail the receiver adds back."""
+
+        compressor = self._compressor
+        if compressor is None:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -self.window_bits)
+            if self.compress_takeover:
+                self._compressor = compressor
+
+        return (compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-len(TAIL)]
+
+    def decompress(self, data):
+        """ Inflates the payload of a message.  Raises MessageTooLarge past max_size bytes."""
+
+        decompressor = self._decompressor
+        if decompressor is None:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            if self.decompress_takeover:
+                self._decompressor = decompressor
+
+        data = decompressor.decompress(data + TAIL, self.max_size or 0)
+        if decompressor.unconsumed_tail:
+            self._decompressor = None
+            raise MessageTooLarge("Message larger than %d bytes." % self.max_size)
+        return data
+
+    def frame(self, data, binary=False, mask=False):
+        """ Returns the bytes of a single frame carrying data, compressed if it is at least min_size bytes."""
+
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+        masking_key = os.urandom(4) if mask else None
+        if len(data) < self.min_size:
+            return Frame(opcode, data, masking_key, fin=1).build()
+        return Frame(opcode, self.compress(data), masking_key, fin=1, rsv1=1).build()
+
+
+def parse_extensions(header):
+    """ Parses a Sec-WebSocket-Extensions header into a list of (name, {parameter: value or None})."""
+
+    extensions = []
+    for extension in (header or "").split(","):
+        tokens = [token.strip() for token in extension.split(";")]
+        if not tokens[0]:
+            continue
+        parameters = {}
+        for token in tokens[1:]:
+            name, _, value = token.partition("=")
+            parameters[name.strip().lower()] = value.strip().strip('"') or None
+        extensions.append((tokens[0].lower(), parameters))
+    return extensions
+
+
+def _window_bits(value):
+    bits = int(value)
+    # zlib cannot make a raw deflate stream with a 256 byte window
+    if not 9 <= bits <= 15:
+        raise ValueError(value)
+    return bits
+
+
+def negotiate(header, level, min_size, context_takeover, max_size):
+    """
+    Server side: answers the first permessage-deflate offer of header the
+    server supports.  Returns the Sec-WebSocket-Extensions value of the
+    response and the PerMessageDeflate of the socket, or (None, None).
+    Without context_takeover the server asks for no context takeover in
+    both directions, so no zlib state is kept between messages.
+    """
+
+    for name, parameters in parse_extensions(header):
+        if name != EXTENSION:
+            continue
+        try:
+            if set(parameters) - set(["server_no_context_takeover", "client_no_context_takeover",
+                                      "server_max_window_bits", "client_max_window_bits"]):
+                raise ValueError(parameters)
+            window_bits = _window_bits(parameters.get("server_max_window_bits") or 15)
+            if parameters.get("client_max_window_bits"):
+                _window_bits(parameters["client_max_window_bits"])
+        except ValueError:
+            continue
+
+        response = [EXTENSION]
+        compress_takeover = context_takeover and "server_no_context_takeover" not in parameters
+        decompress_takeover = context_takeover and "client_no_context_takeover" not in parameters
+        if not compress_takeover:
+            response.append("server_no_context_takeover")
+        if not decompress_takeover:
+            response.append("client_no_context_takeover")
+        if "server_max_window_bits" in parameters:
+            response.append("server_max_window_bits=%d" % window_bits)
+
+        return "; ".join(response), PerMessageDeflate(level, min_size, compress_takeover, decompress_takeover,
+                                                      window_bits, max_size)
+
+    return None, None
+
+
+def offer(context_takeover):
+    """ Client side: the Sec-WebSocket-Extensions value offering permessage-deflate."""
+
+    if context_takeover:
+        return EXTENSION
+    return EXTENSION + "; client_no_context_takeover; server_no_context_takeover"
+
+
+def accept(header, level, min_size, max_size):
+    """
+    Client side: reads the answer of the server to offer().  Returns the
+    PerMessageDeflate of the socket, or None if the server declined.
+    """
+
+    for name, parameters in parse_extensions(header):
+        if name != EXTENSION:
+            continue
+        window_bits = _window_bits(parameters.get("client_max_window_bits") or 15)
+        return PerMessageDeflate(level, min_size, "client_no_context_takeover" not in parameters,
+                                 "server_no_context_takeover" not in parameters, window_bits, max_size)
+
+    return None
+
+
+class DeflateFrame(Frame):
+    """ Frame whose parser accepts RSV1, the bit of the first frame of a compressed message."""
+
+    def _parsing(self):
+        parser = Frame._parsing(self)
+        some_bytes = yield next(parser)
+        while not some_bytes:
+            some_bytes = yield parser.send(some_bytes)
+
+        first_byte = some_bytes[0] if isinstance(some_bytes, bytearray) else ord(some_bytes[0])
+        rsv1 = (first_byte >> 6) & 1
+        try:
+            wanted = parser.send(chr(first_byte & 0xbf) + bytes(some_bytes[1:]))
+            self.rsv1 = rsv1
+            while True:
+                some_bytes = yield wanted
+                wanted = parser.send(some_bytes)
+        except StopIteration:
+            self.rsv1 = rsv1
+
+
+class DeflateStream(Stream):
+    """
+    ws4py stream of a socket that negotiated permessage-deflate.  Messages
+    are inflated once complete, and text messages validated after that.
+    """
+
+    def __init__(self, deflate, always_mask=False, expect_masking=True):
+        Stream.__init__(self, always_mask, expect_masking)
+        self.deflate = deflate
+        self.compressed = False
+
+    def receiver(self):
+        while True:
+            frame = DeflateFrame()
+            try:
+                while True:
+                    some_bytes = yield next(frame.parser)
+                    frame.parser.send(some_bytes)
+            except GeneratorExit:
+                break
+            except StopIteration:
+                self._received(frame)
+            except ProtocolException:
+                self.errors.append(CloseControlMessage(code=1002))
+            except FrameTooLargeException:
+                self.errors.append(CloseControlMessage(code=1002, reason="Frame was too large"))
+            frame._cleanup()
+
+        self._cleanup()
+
+    def _received(self, frame):
+        body = frame.body or b""
+        if body:
+            if bool(frame.masking_key) != self.expect_masking:
+                self.errors.append(CloseControlMessage(code=1002, reason="Unexpected masking"))
+                return
+            if frame.masking_key:
+                body = bytes(frame.unmask(body))
+
+        if frame.rsv1 and frame.opcode not in (OPCODE_TEXT, OPCODE_BINARY):
+            self.errors.append(CloseControlMessage(code=1002, reason="RSV1 set on a non data frame"))
+        elif frame.opcode in (OPCODE_TEXT, OPCODE_BINARY):
+            if self.message is not None and not self.message.completed:
+                self.errors.append(CloseControlMessage(code=1002,
+                                                       reason="Received a new message before completing previous"))
+                return
+            self.message = TextMessage(body) if frame.opcode == OPCODE_TEXT else BinaryMessage(body)
+            self.compressed = bool(frame.rsv1)
+            self._completed(frame)
+        elif frame.opcode == OPCODE_CONTINUATION:
+            if self.message is None or self.message.completed:
+                self.errors.append(CloseControlMessage(code=1002, reason="Message not started yet"))
+                return
+            self.message.extend(body)
+            self._completed(frame)
+        elif frame.opcode == OPCODE_CLOSE:
+            self.closing = self._closing(body)
+        elif frame.opcode == OPCODE_PING:
+            self.pings.append(PingControlMessage(body))
+        elif frame.opcode == OPCODE_PONG:
+            self.pongs.append(PongControlMessage(body))
+        else:
+            self.errors.append(CloseControlMessage(code=1003))
+
+    def _completed(self, frame):
+        if not frame.fin:
+            return
+
+        message = self.message
+        if self.compressed:
+            try:
+                message.data = self.deflate.decompress(message.data)
+            except MessageTooLarge, e:
+                self.errors.append(CloseControlMessage(code=1009, reason=str(e)))
+                return
+            except zlib.error:
+                self.errors.append(CloseControlMessage(code=1007, reason="Invalid compressed data"))
+                return
+
+        if message.is_text:
+            try:
+                message.data.decode("utf-8")
+            except UnicodeDecodeError:
+                self.errors.append(CloseControlMessage(code=1007, reason="Invalid UTF-8 bytes"))
+                return
+        message.completed = True
+
+    def _closing(self, body):
+        if not body:
+            return CloseControlMessage(code=1000)
+        if len(body) == 1:
+            return CloseControlMessage(code=1002, reason="Payload has invalid length")
+
+        code = unpack("!H", body[:2])[0]
+        if code not in VALID_CLOSING_CODES and not 2999 < code < 5000:
+            return CloseControlMessage(code=1002, reason="Invalid Closing Frame Code: %d" % code)
+        try:
+            body[2:].decode("utf-8")
+        except UnicodeDecodeError:
+            return CloseControlMessage(code=1007, reason="Invalid UTF-8 bytes")
+        return CloseControlMessage(code=code, reason=body[2:])
@@ -1,67 +1,237 @@
+"""
+Load generator and benchmark for the chat server.
+
+Connects and authenticates --users clients at --ramp connections per second,
+then sends --rate messages per second of --size bytes between random pairs of
+users for --duration seconds.  Every message carries its send time, so the
+receivers measure the end to end latency.  Prints the results as JSON.
+With --batch the clients coalesce their messages into multi-message frames,
+with --deflate they offer permessage-deflate at that compression level,
+with --acks they acknowledge the messages they receive.
+
+Usage to run 1000 users against a server already listening on port 9000:
+    load_tester.py 1000
+
+Usage to start a local server with 4 workers on port 9100 and benchmark it:
+    load_tester.py 1000 --rate 2000 --spawn-server --port 9100 --workers 4
+"""
+from gevent import monkey; monkey.patch_socket()
+import argparse
+import json
+import os
 import random
+import subprocess
 import sys
+import time
 import gevent
 from client import ChatWebsocketClient
-WEBSOCKET_URL = 'ws://127.0.0.1:9000'
+WEBSOCKET_URL = 'ws://127.0.0.1:%d'
 PROTOCOLS = ['http-only', 'chat']
+AUTHENTICATED = "Authentication successful."
 
 
 class Connection:
     """
     Simulates a connection with a username
     """
-    def __init__(self, username):
-        self.client = ChatWebsocketClient(WEBSOCKET_URL, PROTOCOLS)
+    def __init__(self, username, url, stats, batch=False, deflate=None, acks=False):
+        self.client = ChatWebsocketClient(url, PROTOCOLS, deflate_level=deflate, acks=acks)
         self.username = username
+        self.stats = stats
+        self.send = self.client.send_batched if batch else self.client.send
 
     def close(self):
         self.client.close()
 
-    def authenticate(self):
+    def authenticate(self, timeout=10):
+        """ Connects and waits until the server accepts the username."""
+
+        self.client.connect()
         self.client.send(self.username)
+        with gevent.Timeout(timeout):
+            while True:
+                message = self.client.receive()
+                if message is None:
+                    raise Exception("Connection closed while authenticating %s." % self.username)
+                # the server may coalesce the reply with the frames before it
+                if any(line.startswith(AUTHENTICATED) for line in str(message).split("\n")):
+                    return
 
     def send_message_to_username(self, message, to_username):
-        self.client.send("@%s %s" % (to_username, message))
+        self.send("@%s %s" % (to_username, message))
 
     def receive(self):
         while True:
             message = self.client.receive()
-            print "%s: %s" % (self.username, message)
-
-
-if __name__ == "__main__":
-    random.seed(111)
-    users_num = 0
-    if len(sys.argv) == 2:
-        users_num = int(sys.argv[1])
-    else:
-        print "Usage to start 1000 connections : load_tester.py 1000"
-        exit()
-
-
-    #create some usernames
-    usernames = []
-    for i in range(0, users_num):
-        usernames.append("user_%d" % i)
-
-    #create one connection for each user
+            if message is None:
+                return
+
+            self.stats.received_frame(str(message))
+
+
+class Stats(object):
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.sent = 0
+        self.received = 0
+        self.latencies = []
+
+    def payload(self, size):
+        """ Message text with the send time, padded to size bytes."""
+
+        self.sent += 1
+        text = "%s %.6f" % (self.run_id, time.time())
+        return text + " " + "x" * max(0, size - len(text) - 1)
+
+    def received_frame(self, frame):
+        now = time.time()
+        for line in frame.split("\n"):
+            tokens = line.split(None, 4)
+            # @from_user >> run_id send_time padding
+            if len(tokens) >= 4 and tokens[1] == ">>" and tokens[2] == self.run_id:
+                try:
+                    self.latencies.append(now - float(tokens[3]))
+                    self.received += 1
+                except ValueError:
+                    pass
+
+    def results(self, duration):
+        latencies = sorted(self.latencies)
+        results = {
+            "sent": self.sent,
+            "received": self.received,
+            "lost": self.sent - self.received,
+            "messages_per_second": self.received / duration,
+        }
+        for name, p in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999)):
+            results["latency_%s_ms" % name] = percentile(latencies, p) * 1000
+        results["latency_max_ms"] = latencies[-1] * 1000 if latencies else 0
+        return results
+
+
+def percentile(values, p):
+    """ Nearest rank percentile of a sorted list."""
+
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def connect_users(usernames, url, ramp, stats, batch=False, deflate=None, acks=False):
     connections = []
-    for i in range(0, users_num):
-        connections.append(Connection(usernames[i]))
-
     greenlets = []
-    #spawn receivers' micro threads
-    for i in range(0, users_num):
-        gevent.spawn(connections[i].receive),
 
-    #randomly send messages from one user to another
-    for i in range(0, 10):
-        from_connection = connections[random.randrange(0, users_num)]
-        to_connection = connections[random.randrange(0, users_num)]
+    def connect(username):
+        connection = Connection(username, url, stats, batch, deflate, acks)
+        connection.authenticate()
+        connections.append(connection)
+        gevent.spawn(connection.receive)
 
+    for username in usernames:
+        greenlets.append(gevent.spawn(connect, username))
+        gevent.sleep(1.0 / ramp)
 
     gevent.joinall(greenlets)
-
-    gevent.sleep(10)
+    errors = len([g for g in greenlets if not g.successful()])
+    return connections, errors
+
+
+def send_messages(connections, rate, size, duration, stats, tick=0.005):
+    """ Sends rate messages per second between random pairs of users."""
+
+    start = time.time()
+    sent = 0
+    while time.time() - start < duration:
+        due = int((time.time() - start) * rate) + 1
+        while sent < due:
+            from_connection = random.choice(connections)
+            to_connection = random.choice(connections)
+            from_connection.send_message_to_username(stats.payload(size), to_connection.username)
+            sent += 1
+
+        gevent.sleep(tick)
+
+    return time.time() - start
+
+
+def spawn_server(port, workers):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"), str(port)]
+    if workers:
+        command += ["--workers", str(workers)]
+
+    server = subprocess.Popen(command, stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+    time.sleep(2)
+    return server
+
+
+def run(args):
+    random.seed(args.seed)
+    run_id = "load%d" % os.getpid()
+    stats = Stats(run_id)
+    url = WEBSOCKET_URL % args.port
+
+    server = spawn_server(args.port, args.workers) if args.spawn_server else None
+    try:
+        connect_start = time.time()
+        usernames = ["%s_%d" % (args.prefix, i) for i in range(args.users)]
+        connections, connect_errors = connect_users(usernames, url, args.ramp, stats, args.batch,
+                                                      args.deflate, args.acks)
+        connect_time = time.time() - connect_start
+        if not connections:
+            raise Exception("No user could connect to %s." % url)
+
+        duration = send_messages(connections, args.rate, args.size, args.duration, stats)
+        for connection in connections:
+            connection.client.flush()
+        gevent.sleep(args.drain)
+
+        results = stats.results(duration)
+        results.update({
+            "users": args.users,
+            "connected": len(connections),
+            "connect_errors": connect_errors,
+            "connect_seconds": connect_time,
+            "rate": args.rate,
+            "size": args.size,
+            "batch": args.batch,
+            "deflate": args.deflate,
+            "acks": args.acks,
+            "ack_frames": sum(connection.client.acks_sent for connection in connections),
+            "duplicates": sum(connection.client.duplicates for connection in connections),
+            "duration": duration,
+        })
+
+        for connection in connections:
+            connection.close()
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    return results
 
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat server load tester.")
+    parser.add_argument("users", type=int, nargs="?", default=100, help="number of connected users")
+    parser.add_argument("--ramp", type=float, default=100, help="new connections per second")
+    parser.add_argument("--rate", type=float, default=100, help="messages per second")
+    parser.add_argument("--size", type=int, default=64, help="message size in bytes")
+    parser.add_argument("--batch", action="store_true", help="send the messages in multi-message frames")
+    parser.add_argument("--deflate", type=int, metavar="LEVEL", help="offer permessage-deflate")
+    parser.add_argument("--acks", action="store_true", help="acknowledge the received messages")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to send messages for")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for the last messages")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--prefix", default="user", help="prefix of the usernames")
+    parser.add_argument("--seed", type=int, default=111)
+    parser.add_argument("--spawn-server", action="store_true", help="start a local server for the run")
+    parser.add_argument("--workers", type=int, default=0, help="worker processes of the spawned server")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    results = json.dumps(run(args), indent=2, sort_keys=True)
+    print results
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(results + "\n")
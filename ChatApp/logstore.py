@@ -0,0 +1,442 @@
+"""
+Append-only message log, a store for the messages that does not go through
+the database.
+
+Records are appended to segment files named after the log position of their
+first byte ('00000000000000000000.log'), and a new segment is started once
+the current one reaches CHAT_LOG_SEGMENT_SIZE bytes.  Segments are read
+through memory maps.
+
+Records are appended in the order the messages were sent, each with its
+seq and the recipients that have not received the message yet; the
+recipients of a room message are '#' and its room seq instead.  When the
+log is opened it is scanned once to build, for every recipient, the ordered
+positions of its undelivered messages, so an offline backlog is replayed by
+reading forward through the segments.  Once a chunk of the
+backlog has been sent, or confirmed, the position of its last message is
+appended to 'delivered.log' and those messages are not replayed again after a
+restart.  The cursor of a chunk is that position plus one, so '0' confirms
+nothing.  A live message confirmed by the socket that received it leaves the
+index on its own, and unless it was the first undelivered message of the
+user its position is appended to 'delivered.log' as '+position'.
+The scan also indexes the seqs and positions of the direct messages of every
+conversation, and the room seqs and positions of the messages of every room,
+so a page of history or the backlog of a room is found by bisection.
+
+Once the log grows past CHAT_LOG_MAX_SIZE bytes its oldest segments are
+deleted, with the history and room messages they hold, unless they still hold undelivered
+messages: the log then keeps growing until those are delivered.  The
+positions of delivered messages leave the index as they are confirmed, and
+'delivered.log' is rewritten with the latest mark of every user, and the
+single positions past it, when the log is opened.
+
+A log belongs to one server process: multi-process servers should keep the
+database store.
+"""
+import bisect
+import mmap
+import os
+import struct
+from django.conf import settings
+
+from storage import Chunk
+
+# seq, then the lengths of the text, recipients, to, room and from fields that follow
+HEADER = struct.Struct(">QIIBBB")
+MAX_NAME_LENGTH = 255
+SEGMENT_NAME = "%020d.log"
+DELIVERED_NAME = "delivered.log"
+
+
+def _bytes(value):
+    if value is None:
+        return ""
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+
+def _conversation(username, other):
+    return (username, other) if username <= other else (other, username)
+
+
+class Segment(object):
+    def __init__(self, path, base):
+        self.path = path
+        self.base = base
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.file = None
+        self.map = None
+
+    def read(self, offset, length):
+        if self.map is None or len(self.map) < offset + length:
+            self._remap()
+        return self.map[offset:offset + length]
+
+    def truncate(self, size):
+        self.close()
+        with open(self.path, "r+b") as segment:
+            segment.truncate(size)
+        self.size = size
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _remap(self):
+        if self.map is not None:
+            self.map.close()
+        if self.file is None:
+            self.file = open(self.path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class LogStore(object):
+    def __init__(self, directory=None, segment_size=None, fsync=None, max_size=None):
+        self.directory = directory or settings.CHAT_LOG_DIRECTORY
+        self.segment_size = segment_size or settings.CHAT_LOG_SEGMENT_SIZE
+        self.fsync = settings.CHAT_LOG_FSYNC if fsync is None else fsync
+        self.max_size = settings.CHAT_LOG_MAX_SIZE if max_size is None else max_size
+        self.segments = []
+        self.bases = []
+        self.index = {}
+        self.conversations = {}
+        self.rooms = {}
+        self.delivered = {}
+        self.confirmed = {}
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self._load()
+        self.active = open(self.segments[-1].path, "ab")
+        self.delivered_log = None
+        self._rewrite_delivered()
+
+    def save(self, messages):
+        # encoded first, so a message that cannot be written fails the batch before any is written
+        encoded = [self._encode(msg) for msg in messages]
+        segment = self.segments[-1]
+        rolled = False
+        buffered = []
+        length = 0
+        positions = []
+        sent = []
+        room_messages = []
+
+        for msg, (record, recipients) in zip(messages, encoded):
+            if segment.size + length and segment.size + length + len(record) > self.segment_size:
+                self._write(buffered)
+                segment.size += length
+                segment = self._roll(segment.base + segment.size)
+                rolled = True
+                buffered, length = [], 0
+
+            position = segment.base + segment.size + length
+            for recipient in recipients:
+                positions.append((recipient, position))
+            if msg.to_user is not None:
+                sent.append((_bytes(msg.from_user.username), _bytes(msg.to_user.username), msg.seq, position))
+            elif msg.room_seq:
+                room_messages.append((_bytes(msg.room), msg.room_seq, position))
+            buffered.append(record)
+            length += len(record)
+
+        self._write(buffered)
+        segment.size += length
+        for recipient, position in positions:
+            self.index.setdefault(recipient, []).append(position)
+        for from_username, to_username, seq, position in sent:
+            self._add_to_conversation(from_username, to_username, seq, position)
+        for room, room_seq, position in room_messages:
+            self._add_to_room(room, room_seq, position)
+        if rolled:
+            self._compact()
+
+    def undelivered(self, user, chunk_size, mark=True):
+        """ Reads the backlog of user forward through the log, in the order the messages were saved."""
+
+        username = _bytes(user.username)
+        positions = self.index.get(username, [])
+        last = -1
+        while True:
+            # confirm() may drop positions meanwhile
+            start = bisect.bisect_right(positions, last)
+            chunk = positions[start:start + chunk_size]
+            if not chunk:
+                return
+            yield Chunk([self.read(position) for position in chunk], str(chunk[-1] + 1),
+                        [HEADER.unpack(self._read_header(position))[0] for position in chunk])
+
+            last = chunk[-1]
+            if mark:
+                self._confirm(username, last)
+
+    def confirm(self, user, cursor):
+        position = int(cursor) - 1
+        if position >= 0:
+            self._confirm(_bytes(user.username), position)
+
+    def mark_delivered(self, deliveries):
+        """
+        Drops the confirmed messages from the index.  This process saved them
+        before they could be received, so one that is not in the index was
+        confirmed already and nothing is returned.
+        """
+
+        for delivery in deliveries:
+            username = _bytes(delivery.user.username)
+            positions = self.index.get(username, ())
+            # live messages are the latest of the backlog
+            for i in range(len(positions) - 1, -1, -1):
+                if HEADER.unpack(self._read_header(positions[i]))[0] == delivery.seq:
+                    self._confirm_one(username, i)
+                    break
+        return []
+
+    def history(self, user, other, before_seq, limit):
+        seqs, positions = self.conversations.get(_conversation(_bytes(user.username), _bytes(other.username)),
+                                                 ((), ()))
+        end = len(seqs) if before_seq is None else bisect.bisect_left(seqs, before_seq)
+        return [(seqs[i],) + self.read(positions[i])[1:] for i in range(max(0, end - limit), end)]
+
+    def room_backlog(self, room, after, chunk_size):
+        room_seqs, positions = self.rooms.get(_bytes(room), ((), ()))
+        for start in range(bisect.bisect_right(room_seqs, after), len(room_seqs), chunk_size):
+            yield [(room_seqs[i],) + self.read(positions[i])[1:]
+                   for i in range(start, min(start + chunk_size, len(room_seqs)))]
+
+    def read(self, position):
+        """ Returns the room, the sender and the text of the record at position."""
+
+        segment = self.segments[bisect.bisect_right(self.bases, position) - 1]
+        offset = position - segment.base
+        _, text_length, recipients_length, to_length, room_length, from_length = \
+            HEADER.unpack(segment.read(offset, HEADER.size))
+
+        offset += HEADER.size + to_length
+        room = segment.read(offset, room_length) or None
+        offset += room_length
+        from_username = segment.read(offset, from_length)
+        offset += from_length + recipients_length
+        return room, from_username, segment.read(offset, text_length)
+
+    def _read_header(self, position):
+        segment = self.segments[bisect.bisect_right(self.bases, position) - 1]
+        return segment.read(position - segment.base, HEADER.size)
+
+    def close(self):
+        self.active.close()
+        self.delivered_log.close()
+        for segment in self.segments:
+            segment.close()
+
+    def _encode(self, msg):
+        if msg.to_user is not None and not msg.delivered:
+            recipients = [_bytes(msg.to_user.username)]
+        else:
+            recipients = []
+
+        to = _bytes(msg.to_user.username if msg.to_user is not None else None)
+        room = _bytes(msg.room)
+        from_username = _bytes(msg.from_user.username)
+        joined = "#%d" % msg.room_seq if msg.room_seq else " ".join(recipients)
+        text = _bytes(msg.message_text)
+        for name in (to, room, from_username):
+            if len(name) > MAX_NAME_LENGTH:
+                raise ValueError("Name longer than %d bytes: %r" % (MAX_NAME_LENGTH, name))
+
+        header = HEADER.pack(msg.seq, len(text), len(joined), len(to), len(room), len(from_username))
+        return "".join((header, to, room, from_username, joined, text)), recipients
+
+    def _write(self, records):
+        if not records:
+            return
+
+        self.active.write("".join(records))
+        self.active.flush()
+        if self.fsync:
+            os.fsync(self.active.fileno())
+
+    def _roll(self, base):
+        self.active.close()
+        segment = self._add_segment(base)
+        self.active = open(segment.path, "ab")
+        return segment
+
+    def _add_segment(self, base):
+        segment = Segment(os.path.join(self.directory, SEGMENT_NAME % base), base)
+        self.segments.append(segment)
+        self.bases.append(base)
+        return segment
+
+    def _compact(self):
+        """ Deletes the oldest segments past max_size that hold no undelivered message."""
+
+        undelivered = min(positions[0] for positions in self.index.values()) if self.index else None
+        end_of_log = self.segments[-1].base + self.segments[-1].size
+        while len(self.segments) > 1 and end_of_log - self.bases[0] > self.max_size:
+            end = self.bases[1]
+            if undelivered is not None and undelivered < end:
+                break
+
+            segment = self.segments.pop(0)
+            del self.bases[0]
+            segment.close()
+            os.remove(segment.path)
+            self._forget_before(end)
+
+    def _forget_before(self, position):
+        """ Drops the history, the room messages and the delivery marks of the records before position."""
+
+        for conversation, (seqs, positions) in self.conversations.items():
+            deleted = bisect.bisect_left(positions, position)
+            if deleted == len(positions):
+                del self.conversations[conversation]
+            else:
+                del seqs[:deleted], positions[:deleted]
+
+        for room, (room_seqs, positions) in self.rooms.items():
+            # in room seq order, which is not quite the order of the log
+            kept = [i for i, kept_position in enumerate(positions) if kept_position >= position]
+            if kept:
+                room_seqs[:] = [room_seqs[i] for i in kept]
+                positions[:] = [positions[i] for i in kept]
+            else:
+                del self.rooms[room]
+
+        forgotten = [username for username, mark in self.delivered.items() if mark < position]
+        for username in forgotten:
+            del self.delivered[username]
+        for username in self.confirmed.keys():
+            self._forget_confirmed(username, position - 1)
+        if forgotten:
+            self._rewrite_delivered()
+
+    def _rewrite_delivered(self):
+        """ Replaces 'delivered.log' with the latest mark of every user."""
+
+        if self.delivered_log is not None:
+            self.delivered_log.close()
+        path = os.path.join(self.directory, DELIVERED_NAME)
+        with open(path + ".tmp", "wb") as delivered_log:
+            for username, position in self.delivered.items():
+                delivered_log.write("%s %d\n" % (username, position))
+            for username, confirmed in self.confirmed.items():
+                for position in sorted(confirmed):
+                    delivered_log.write("%s +%d\n" % (username, position))
+            delivered_log.flush()
+            os.fsync(delivered_log.fileno())
+        os.rename(path + ".tmp", path)
+        self.delivered_log = open(path, "ab")
+
+    def _add_to_conversation(self, from_username, to_username, seq, position):
+        seqs, positions = self.conversations.setdefault(_conversation(from_username, to_username), ([], []))
+        seqs.append(seq)
+        positions.append(position)
+
+    def _add_to_room(self, room, room_seq, position):
+        room_seqs, positions = self.rooms.setdefault(room, ([], []))
+        # messages sent at the same time may be saved out of room seq order
+        i = bisect.bisect_right(room_seqs, room_seq)
+        room_seqs.insert(i, room_seq)
+        positions.insert(i, position)
+
+    def _confirm(self, username, position):
+        positions = self.index.get(username)
+        if positions is not None:
+            del positions[:bisect.bisect_right(positions, position)]
+            if not positions:
+                del self.index[username]
+        if position > self.delivered.get(username, -1):
+            self._mark_delivered(username, position)
+
+    def _confirm_one(self, username, i):
+        """ Drops the i-th position of the index of username, confirmed on its own."""
+
+        positions = self.index[username]
+        position = positions.pop(i)
+        if i == 0:
+            # the messages of the user before the next undelivered one are delivered
+            self._mark_delivered(username, positions[0] - 1 if positions else position)
+        else:
+            self.confirmed.setdefault(username, set()).add(position)
+            self.delivered_log.write("%s +%d\n" % (username, position))
+            self.delivered_log.flush()
+        if not positions:
+            del self.index[username]
+
+    def _mark_delivered(self, username, position):
+        self.delivered[username] = position
+        self.delivered_log.write("%s %d\n" % (username, position))
+        self.delivered_log.flush()
+        self._forget_confirmed(username, position)
+
+    def _forget_confirmed(self, username, position):
+        """ Drops the single positions of username up to position, which the mark covers or that were deleted."""
+
+        confirmed = self.confirmed.get(username)
+        if confirmed is not None:
+            confirmed.difference_update([kept for kept in confirmed if kept <= position])
+            if not confirmed:
+                del self.confirmed[username]
+
+    def _load(self):
+        """ Reads the delivery marks, then scans the segments to index the undelivered messages."""
+
+        path = os.path.join(self.directory, DELIVERED_NAME)
+        if os.path.exists(path):
+            with open(path) as delivered_log:
+                for line in delivered_log:
+                    username, _, position = line.rstrip("\n").rpartition(" ")
+                    if username and position.isdigit():
+                        self.delivered[username] = max(self.delivered.get(username, -1), int(position))
+                    elif username and position[:1] == "+" and position[1:].isdigit():
+                        self.confirmed.setdefault(username, set()).add(int(position[1:]))
+
+        bases = sorted(int(name[:-len(".log")]) for name in os.listdir(self.directory)
+                       if name.endswith(".log") and name[:-len(".log")].isdigit())
+        for base in bases or [0]:
+            self._add_segment(base)
+        for username, position in self.delivered.items():
+            # the records up to the mark were deleted with their segments
+            if position < self.bases[0]:
+                del self.delivered[username]
+        for username in self.confirmed.keys():
+            self._forget_confirmed(username, max(self.delivered.get(username, -1), self.bases[0] - 1))
+
+        for segment in self.segments:
+            self._scan(segment, segment is self.segments[-1])
+
+    def _scan(self, segment, last):
+        offset = 0
+        while offset + HEADER.size <= segment.size:
+            header = HEADER.unpack(segment.read(offset, HEADER.size))
+            seq, lengths = header[0], header[1:]
+            end = offset + HEADER.size + sum(lengths)
+            if end > segment.size:
+                break
+
+            to_length, room_length, from_length = lengths[2:]
+            start = offset + HEADER.size + to_length + room_length + from_length
+            position = segment.base + offset
+            for recipient in segment.read(start, lengths[1]).split():
+                if recipient[:1] == "#":
+                    room = segment.read(offset + HEADER.size + to_length, room_length)
+                    self._add_to_room(room, int(recipient[1:]), position)
+                elif (position > self.delivered.get(recipient, -1) and
+                      position not in self.confirmed.get(recipient, ())):
+                    self.index.setdefault(recipient, []).append(position)
+            if to_length:
+                to_username = segment.read(offset + HEADER.size, to_length)
+                from_username = segment.read(start - from_length, from_length)
+                self._add_to_conversation(from_username, to_username, seq, position)
+            offset = end
+
+        if offset < segment.size and last:
+            # a record was cut short by a crash, the next one overwrites it
+            segment.truncate(offset)
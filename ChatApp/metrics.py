@@ -0,0 +1,176 @@
+"""
+Metrics of the chat server, exposed in the Prometheus text format on a
+separate local HTTP port.
+
+Metrics are enabled by setting CHAT_METRICS_PORT.  When it is None every
+metric is the same no-op object, so the instrumented code does not count,
+time or allocate anything.
+"""
+import os; os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chat_app.settings")
+import time
+from bisect import bisect_left
+from django.conf import settings
+from gevent.pywsgi import WSGIServer
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+class Counter(object):
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class Gauge(object):
+    """
+    Metric whose value is computed by function when the metrics are read,
+    or kept up to date with inc() and dec() when function is None.
+    metric_type is "counter" for values that only grow.
+    """
+
+    def __init__(self, name, help, function=None, metric_type="gauge"):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.type = metric_type
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def samples(self):
+        yield self.name, self.value if self.function is None else self.function()
+
+
+class Histogram(object):
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self):
+        """ Context manager that observes the time spent in its block."""
+
+        return _Timer(self)
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield '%s_bucket{le="%s"}' % (self.name, bound), cumulative
+        cumulative += self.counts[-1]
+        yield '%s_bucket{le="+Inf"}' % self.name, cumulative
+        yield self.name + "_sum", self.sum
+        yield self.name + "_count", cumulative
+
+
+class _Timer(object):
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start)
+
+
+class NullMetric(object):
+    """ Stands for every metric while the metrics are disabled."""
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def time(self):
+        return self
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_METRIC = NullMetric()
+
+
+class Registry(object):
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.metrics = []
+
+    def counter(self, name, help):
+        return self._register(Counter, name, help)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram, name, help, buckets)
+
+    def gauge(self, name, help, function=None, metric_type="gauge"):
+        return self._register(Gauge, name, help, function, metric_type)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for name, value in metric.samples():
+                lines.append("%s %s" % (name, value))
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port):
+        """ Starts serving the metrics on http://127.0.0.1:port/metrics."""
+
+        server = WSGIServer(("127.0.0.1", port), self._application, log=None)
+        server.start()
+        return server
+
+    def _register(self, cls, name, *args):
+        if not self.enabled:
+            return NULL_METRIC
+
+        metric = cls(name, *args)
+        self.metrics.append(metric)
+        return metric
+
+    def _application(self, environ, start_response):
+        if environ["PATH_INFO"] != "/metrics":
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return ["Not found.\n"]
+
+        body = self.render()
+        start_response("200 OK", [("Content-Type", "text/plain; version=0.0.4"),
+                                  ("Content-Length", str(len(body)))])
+        return [body]
+
+
+registry = Registry(settings.CHAT_METRICS_PORT is not None)
+counter = registry.counter
+histogram = registry.histogram
+gauge = registry.gauge
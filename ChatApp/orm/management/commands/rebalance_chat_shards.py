@@ -0,0 +1,23 @@
+"""
+Moves the rooms to their redis nodes after a change of CHAT_REDIS_NODES.
+The consistent hash moves only the rooms and users that belong to another
+node now; their sets are copied to that node and deleted from the old one.
+Presence and rate limits expire on their own and are not moved.
+
+    manage.py rebalance_chat_shards
+
+Run it once every server uses the new nodes.
+"""
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+
+from rooms import Rooms
+from sharding import Shards
+
+
+class Command(NoArgsCommand):
+    help = "Moves the chat rooms to their redis nodes after a change of CHAT_REDIS_NODES."
+
+    def handle_noargs(self, **options):
+        moved = Rooms(Shards(settings.CHAT_REDIS_NODES)).rebalance()
+        self.stdout.write("Moved %d sets." % moved)
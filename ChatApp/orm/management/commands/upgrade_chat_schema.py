@@ -0,0 +1,56 @@
+"""
+Upgrades the chat tables of a database made by an older version of the
+server to the current models: adds the room, seq and room_seq columns,
+makes to_user nullable and creates the (to_user, delivered, seq) and (room,
+room_seq) indexes.  Old messages get their id as seq, which keeps their order
+and sorts them before the messages sent after the upgrade.
+
+    manage.py upgrade_chat_schema
+
+syncdb only creates missing tables, and Django 1.6 has no migrations.
+"""
+from django.core.management.base import CommandError, NoArgsCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+from orm.models import MessageModel
+
+
+class Command(NoArgsCommand):
+    help = "Upgrades the chat tables of an older database to the current schema."
+
+    def handle_noargs(self, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("Only sqlite databases can be upgraded with this command.")
+
+        with transaction.atomic():
+            self._upgrade(connection.cursor(), MessageModel, {"room": "NULL", "seq": "id", "room_seq": "0"})
+
+    def _upgrade(self, cursor, model, defaults):
+        """ Rebuilds the table of model if it lacks columns, copying the rows with defaults for the new ones."""
+
+        qn = connection.ops.quote_name
+        table = model._meta.db_table
+        columns = [field.column for field in model._meta.local_fields]
+
+        if table not in connection.introspection.table_names(cursor):
+            self._create_table(cursor, model)
+            self.stdout.write("Created %s." % table)
+        else:
+            existing = set(row[0] for row in connection.introspection.get_table_description(cursor, table))
+            if not existing.issuperset(columns):
+                old = table + "_old"
+                cursor.execute("ALTER TABLE %s RENAME TO %s" % (qn(table), qn(old)))
+                self._create_table(cursor, model)
+                values = [qn(column) if column in existing else defaults[column] for column in columns]
+                cursor.execute("INSERT INTO %s (%s) SELECT %s FROM %s" % (
+                    qn(table), ", ".join(qn(column) for column in columns), ", ".join(values), qn(old)))
+                cursor.execute("DROP TABLE %s" % qn(old))
+                self.stdout.write("Upgraded %s." % table)
+
+        for sql in connection.creation.sql_indexes_for_model(model, no_style()):
+            cursor.execute(sql.replace("CREATE INDEX", "CREATE INDEX IF NOT EXISTS", 1))
+
+    def _create_table(self, cursor, model):
+        for sql in connection.creation.sql_create_model(model, no_style())[0]:
+            cursor.execute(sql)
@@ -5,13 +5,17 @@ from django.db import models
 class UserModel(models.Model):
     username = models.CharField(max_length = 30, unique=True)
 
-
-    def __init__(self, *args, **kwargs):
-        models.Model.__init__(self, *args, **kwargs)
-        self.sockets = []
-
 class MessageModel(models.Model):
+    """ seq is the time the message was sent in microseconds and the node id of its server, see next_seq()."""
+
     from_user = models.ForeignKey(to=UserModel, related_name = "sent_messages")
-    to_user = models.ForeignKey(to = UserModel, related_name = "received_messages")
+    to_user = models.ForeignKey(to = UserModel, related_name = "received_messages", null = True)
+    room = models.CharField(max_length = 31, null = True)
     message_text = models.TextField()
-    delivered = models.BooleanField(default=False)
\ No newline at end of file
+    delivered = models.BooleanField(default=False)
+    seq = models.BigIntegerField(default=0)
+    # order of the message in its room, 0 for a direct message
+    room_seq = models.BigIntegerField(default=0)
+
+    class Meta:
+        index_together = [("to_user", "delivered", "seq"), ("from_user", "to_user", "seq"), ("room", "room_seq")]
@@ -0,0 +1,123 @@
+"""
+Outbound queue of a websocket.  Frames are queued by whoever sends them and
+written by a greenlet of the socket, so a slow client only slows down its
+own writer.  Frames that pile up while the client is slow are coalesced
+into fewer, larger frames, one message per line.  The writer greenlet only
+runs while there is something to write, so an idle socket costs no
+greenlet.
+
+A frame of chat messages is queued with the messages it carries, which are
+handed to written once the frame is written.  The messages of a frame that
+is dropped or left unwritten are never confirmed, so they are replayed at
+the next login.
+"""
+from collections import deque
+from gevent.event import Event
+from gevent.greenlet import Greenlet
+from django.conf import settings
+
+import metrics
+
+FRAMES_DROPPED = metrics.counter("chat_outbox_dropped_total", "Frames dropped from a full outbox.")
+FRAMES_DEFERRED = metrics.counter("chat_outbox_deferred_total", "Frames left for offline replay on a full outbox.")
+SLOW_CONSUMERS = metrics.counter("chat_slow_consumers_total", "Sockets disconnected on a full outbox.")
+COALESCED = metrics.histogram("chat_outbox_coalesced_frames", "Queued frames written as one frame.",
+                              (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+
+class Outbox(object):
+    __slots__ = ("write", "written", "disconnect", "when_full", "coalesce_bytes", "max_size", "queue",
+                 "writer", "idle")
+
+    DROP_OLDEST = "drop_oldest"
+    OFFLINE = "offline"
+    DISCONNECT = "disconnect"
+
+    def __init__(self, write, written, disconnect, max_size=None, when_full=None, coalesce_bytes=None):
+        """
+        write sends a frame on the socket, written confirms the messages of
+        the frames it has sent and disconnect closes the socket.
+        """
+
+        self.write = write
+        self.written = written
+        self.disconnect = disconnect
+        self.when_full = when_full or settings.CHAT_OUTBOX_WHEN_FULL
+        self.coalesce_bytes = coalesce_bytes or settings.CHAT_OUTBOX_COALESCE_BYTES
+        self.max_size = max_size or settings.CHAT_OUTBOX_SIZE
+        # only the writer takes from it and it never waits, a deque is enough
+        self.queue = deque()
+        self.writer = None
+        self.idle = Event()
+        self.idle.set()
+
+        if self.when_full not in (self.DROP_OLDEST, self.OFFLINE, self.DISCONNECT):
+            raise ValueError("Unknown CHAT_OUTBOX_WHEN_FULL policy: %s" % self.when_full)
+
+    def put(self, frame, messages=()):
+        """
+        Queues frame, which carries messages.  Applies the when_full policy if
+        the outbox is full.
+        """
+
+        self._start_writer()
+        self.idle.clear()
+        if len(self.queue) < self.max_size:
+            self.queue.append((frame, messages))
+        else:
+            if self.when_full == self.DROP_OLDEST:
+                FRAMES_DROPPED.inc()
+                self.queue.popleft()
+                self.queue.append((frame, messages))
+            elif self.when_full == self.OFFLINE:
+                FRAMES_DEFERRED.inc()
+            else:
+                SLOW_CONSUMERS.inc()
+                self.stop()
+                self.disconnect()
+
+    def qsize(self):
+        return len(self.queue)
+
+    def flush(self, timeout=None):
+        """
+        Waits until every queued frame is written.  After timeout seconds the
+        frames still queued are left for replay instead and False is returned.
+        """
+
+        if self.idle.wait(timeout):
+            return True
+
+        FRAMES_DEFERRED.inc(len(self.queue))
+        self.queue.clear()
+        return False
+
+    def stop(self):
+        if self.writer is not None:
+            self.writer.kill(block=False)
+            self.writer = None
+
+    def _start_writer(self):
+        if self.writer is None or self.writer.dead:
+            self.writer = Greenlet(self._run)
+            self.writer.start()
+
+    def _run(self):
+        """ Writes until the outbox is empty.  It returns then, so an idle socket keeps no greenlet."""
+
+        while self.queue:
+            frame, messages = self.queue.popleft()
+            frames, written = [frame], list(messages)
+            length = len(frame)
+            while length < self.coalesce_bytes and self.queue:
+                frame, messages = self.queue.popleft()
+                frames.append(frame)
+                written.extend(messages)
+                length += len(frame) + 1
+
+            COALESCED.observe(len(frames))
+            self.write(frames[0] if len(frames) == 1 else "\n".join(frames))
+            if written:
+                self.written(written)
+        self.idle.set()
+        self.writer = None
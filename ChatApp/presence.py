@@ -0,0 +1,141 @@
+"""
+Cluster-wide presence of users, kept in redis.
+
+Every node records the users it holds sockets for in two sorted sets:
+'chat:presence:<username>' maps node ids to the time their entry expires,
+and 'chat:online' maps usernames to the latest expiry of any of their nodes.
+Nodes refresh their entries with a heartbeat, so users of a node that dies
+go offline when the entries expire.  A user is online iff its 'chat:online'
+score is in the future, which needs no scanning.
+
+With several redis nodes the presence of a user is kept on the node of the
+user only, next to its channel, so joining and the heartbeat write one node
+per user and the scripts publishing to the user read it locally.
+"""
+import os
+import socket
+import time
+import gevent
+from redis.exceptions import ConnectionError
+
+ONLINE_KEY = "chat:online"
+USER_KEY = "chat:presence:%s"
+
+# KEYS: user key, online key  ARGV: node id, username, expires, ttl, now
+# Returns 1 if the user was online before.
+JOIN_SCRIPT = """
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+local expires = redis.call('ZSCORE', KEYS[2], ARGV[2])
+if not expires or tonumber(expires) < tonumber(ARGV[3]) then
+    redis.call('ZADD', KEYS[2], ARGV[3], ARGV[2])
+end
+if expires and tonumber(expires) >= tonumber(ARGV[5]) then
+    return 1
+end
+return 0
+"""
+
+# KEYS: user key, online key  ARGV: node id, username, now
+LEAVE_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+local latest = redis.call('ZREVRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if #latest == 0 or tonumber(latest[2]) < tonumber(ARGV[3]) then
+    redis.call('DEL', KEYS[1])
+    redis.call('ZREM', KEYS[2], ARGV[2])
+else
+    redis.call('ZADD', KEYS[2], latest[2], ARGV[2])
+end
+"""
+
+# KEYS: online key  ARGV: channel, now, message
+PUBLISH_IF_ONLINE_SCRIPT = """
+local expires = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not expires or tonumber(expires) < tonumber(ARGV[2]) then
+    return 0
+end
+return redis.call('PUBLISH', ARGV[1], ARGV[3])
+"""
+
+
+class Presence(object):
+    def __init__(self, shards, ttl, local_users):
+        """ local_users returns the usernames that have sockets on this node."""
+
+        self.shards = shards
+        self.ttl = ttl
+        self.local_users = local_users
+        self.node_id = "%s:%d" % (socket.gethostname(), os.getpid())
+        self.heartbeat = None
+        redis = shards.home.redis
+        self._join = redis.register_script(JOIN_SCRIPT)
+        self._leave = redis.register_script(LEAVE_SCRIPT)
+        self._publish_if_online = redis.register_script(PUBLISH_IF_ONLINE_SCRIPT)
+
+    def join(self, username):
+        """ Marks username online on this node.  Returns True if it was online before, on this node or another."""
+
+        now = time.time()
+        online = self._join([USER_KEY % username, ONLINE_KEY], [self.node_id, username, now + self.ttl, self.ttl, now],
+                            client=self.shards.get(username).redis)
+        self._start_heartbeat()
+        return bool(online)
+
+    def leave(self, username):
+        self._leave([USER_KEY % username, ONLINE_KEY], [self.node_id, username, time.time()],
+                    client=self.shards.get(username).redis)
+
+    def is_online(self, username):
+        expires = self.shards.get(username).redis.zscore(ONLINE_KEY, username)
+        return expires is not None and expires >= time.time()
+
+    def online_users(self):
+        """ Returns the users online on some node, read from every redis node that is up."""
+
+        now = time.time()
+        users = []
+        for shard in self.shards:
+            try:
+                users.extend(shard.redis.zrangebyscore(ONLINE_KEY, now, "+inf"))
+            except ConnectionError:
+                pass
+        return users
+
+    def publish_if_online(self, channel, message, client=None):
+        """
+        Publishes message on the channel of a user that is online on some node.
+        Returns the number of receivers, 0 without publishing if the user is offline.
+        """
+
+        return self._publish_if_online([ONLINE_KEY], [channel, time.time(), message],
+                                       client=client or self.shards.get(channel).redis)
+
+    def refresh(self):
+        """
+        Extends the presence of the local users on their nodes and forgets the
+        expired users, on every node that is up.
+        """
+
+        now = time.time()
+        pipes = dict((shard, shard.redis.pipeline(transaction=False)) for shard in self.shards)
+        for username in list(self.local_users()):
+            self._join([USER_KEY % username, ONLINE_KEY], [self.node_id, username, now + self.ttl, self.ttl, now],
+                       client=pipes[self.shards.get(username)])
+        for pipe in pipes.values():
+            pipe.zremrangebyscore(ONLINE_KEY, "-inf", now)
+            try:
+                pipe.execute()
+            except ConnectionError:
+                pass
+
+    def _start_heartbeat(self):
+        if self.heartbeat is None or self.heartbeat.dead:
+            self.heartbeat = gevent.spawn(self._run_heartbeat)
+
+    def _run_heartbeat(self):
+        while True:
+            gevent.sleep(self.ttl / 3.0)
+            try:
+                self.refresh()
+            except Exception:
+                pass
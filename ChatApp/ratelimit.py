@@ -0,0 +1,93 @@
+"""
+Token bucket rate limits on the messages clients send.
+
+A bucket holds at most burst tokens and gains rate tokens per second; every
+message takes one and is dropped when there is none left.  TokenBucket
+limits one socket in the memory of its server.  UserRateLimit limits a user
+over all its sockets in the cluster with a bucket kept in the redis hash
+'chat:ratelimit:<username>', refilled and taken from by a Lua script so
+concurrent servers cannot both spend the last token.  A server leases up to
+lease tokens at a time and spends them locally, so it asks redis once every
+lease messages of a user instead of for every message; a user can exceed
+its burst by the tokens leased and not yet spent, at most lease per server.
+The bucket of a user is on the redis node of the user.
+"""
+import time
+
+RATE_LIMIT_KEY = "chat:ratelimit:%s"
+
+# KEYS: bucket key  ARGV: rate, burst, now, tokens needed, tokens wanted
+# Takes as many of the wanted tokens as there are, or none if there are fewer
+# than needed, and returns how many were taken.
+LEASE_SCRIPT = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+local tokens = burst
+if bucket[1] then
+    tokens = math.min(burst, tonumber(bucket[1]) + math.max(0, now - tonumber(bucket[2])) * rate)
+end
+local taken = 0
+if tokens >= tonumber(ARGV[4]) then
+    taken = math.min(tonumber(ARGV[5]), math.floor(tokens))
+    tokens = tokens - taken
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'stamp', ARGV[3])
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return taken
+"""
+
+
+class TokenBucket(object):
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.time()
+
+    def take(self, count=1):
+        """ Takes count tokens.  Returns False, taking none, if there are not enough."""
+
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < count:
+            return False
+
+        self.tokens -= count
+        return True
+
+
+class UserRateLimit(object):
+    def __init__(self, shards, rate, burst, lease=1):
+        """ The script calls go through the auto pipeline of the node of the user."""
+
+        self.shards = shards
+        self.rate = rate
+        self.burst = burst
+        self.lease = lease
+        self.leased = {}
+        self._lease = shards.home.redis.register_script(LEASE_SCRIPT)
+
+    def take(self, username, count=1):
+        """ Takes count tokens of username.  Returns False, taking none, if there are not enough."""
+
+        needed = count - self.leased.get(username, 0)
+        if needed > 0:
+            taken = self.shards.get(username).pipeline.call(
+                self._lease, [RATE_LIMIT_KEY % username],
+                [self.rate, self.burst, repr(time.time()), needed, max(needed, self.lease)])
+            # other sockets of the user may have spent or leased tokens meanwhile
+            self.leased[username] = self.leased.get(username, 0) + taken
+
+        leased = self.leased.get(username, 0)
+        if leased < count:
+            return False
+        self.leased[username] = leased - count
+        return True
+
+    def forget(self, username):
+        """ Drops the tokens leased for username, once it has no socket left on this server."""
+
+        self.leased.pop(username, None)
@@ -0,0 +1,178 @@
+"""
+Chat rooms, kept in redis.
+
+'chat:room:<room>' is the set of the members of a room and
+'chat:rooms:<username>' the set of the rooms of a user.  A message to a room
+is published once on the channel of the room.  Every node with a member
+online is subscribed to that channel and fans the message out to the local
+sockets of the members, so sending costs one publish and one delivery per
+node whatever the size of the room.
+
+Publishing numbers the messages of a room from 'chat:roomseq:<room>', the
+room seq, which orders them as the members receive them.  Nothing is written
+per member when a message is sent: 'chat:reads:<username>' maps each room of
+a user to the room seq up to which the user has read it, and a user that
+logs in while offline everywhere is sent the messages of its rooms after
+that.  A socket records the room seqs it reads and saves them when it
+closes.
+
+With several redis nodes the set, the seq and the channel of a room are on
+the node of the room, the set of the rooms and the reads of a user on the
+node of the user.
+"""
+
+ROOM_KEY = "chat:room:%s"
+ROOM_SEQ_KEY = "chat:roomseq:%s"
+USER_ROOMS_KEY = "chat:rooms:%s"
+READS_KEY = "chat:reads:%s"
+
+# KEYS: room seq key  ARGV: channel, message
+PUBLISH_TO_ROOM_SCRIPT = """
+local room_seq = redis.call('INCR', KEYS[1])
+redis.call('PUBLISH', ARGV[1], room_seq .. ' ' .. ARGV[2])
+return room_seq
+"""
+
+# KEYS: reads key, user rooms key
+# ARGV: for each room, the room, its number of runs and the first and last room seq of each run
+SAVE_READS_SCRIPT = """
+local i = 1
+while i <= #ARGV do
+    local room, count = ARGV[i], tonumber(ARGV[i + 1])
+    if redis.call('SISMEMBER', KEYS[2], room) == 1 then
+        local read = tonumber(redis.call('HGET', KEYS[1], room) or (tonumber(ARGV[i + 2]) - 1))
+        for run = 0, count - 1 do
+            local first, last = tonumber(ARGV[i + 2 + 2 * run]), tonumber(ARGV[i + 3 + 2 * run])
+            if read >= first - 1 and read < last then
+                read = last
+            end
+        end
+        redis.call('HSET', KEYS[1], room, read)
+    end
+    i = i + 2 + 2 * count
+end
+"""
+
+
+class RoomReads(object):
+    """
+    The room seqs a socket has read, as a few runs of consecutive seqs per
+    room.  A message the socket missed splits a run, and only the runs that
+    continue the read seq of the user advance it.  Past MAX_RUNS runs in a
+    room the latest are forgotten, which only replays more at the next login.
+    """
+
+    __slots__ = ("runs",)
+
+    MAX_RUNS = 8
+
+    def __init__(self):
+        self.runs = {}
+
+    def read(self, room, room_seq):
+        runs = self.runs.setdefault(room, [])
+        for i, run in enumerate(runs):
+            if room_seq < run[0] - 1:
+                runs.insert(i, [room_seq, room_seq])
+                break
+            if room_seq <= run[1] + 1:
+                if room_seq == run[0] - 1:
+                    run[0] = room_seq
+                elif room_seq == run[1] + 1:
+                    run[1] = room_seq
+                    if i + 1 < len(runs) and runs[i + 1][0] == room_seq + 1:
+                        run[1] = runs.pop(i + 1)[1]
+                return
+        else:
+            runs.append([room_seq, room_seq])
+        del runs[self.MAX_RUNS:]
+
+    def arguments(self):
+        """ The runs as the arguments of SAVE_READS_SCRIPT."""
+
+        arguments = []
+        for room, runs in self.runs.items():
+            arguments.extend((room, len(runs)))
+            for first, last in runs:
+                arguments.extend((first, last))
+        return arguments
+
+
+class Rooms(object):
+    def __init__(self, shards):
+        self.shards = shards
+        self._publish = shards.home.redis.register_script(PUBLISH_TO_ROOM_SCRIPT)
+        self._save_reads = shards.home.redis.register_script(SAVE_READS_SCRIPT)
+
+    def join(self, username, room):
+        """ Adds username to the members of room, which it has read up to the latest message."""
+
+        # the room and the user may be on different nodes
+        pipe = self.shards.get(room).redis.pipeline()
+        _, read = pipe.sadd(ROOM_KEY % room, username).get(ROOM_SEQ_KEY % room).execute()
+        pipe = self.shards.get(username).redis.pipeline()
+        pipe.sadd(USER_ROOMS_KEY % username, room).hsetnx(READS_KEY % username, room, read or 0).execute()
+
+    def leave(self, username, room):
+        self.shards.get(room).redis.srem(ROOM_KEY % room, username)
+        pipe = self.shards.get(username).redis.pipeline()
+        pipe.srem(USER_ROOMS_KEY % username, room).hdel(READS_KEY % username, room).execute()
+
+    def members(self, room):
+        return self.shards.get(room).redis.smembers(ROOM_KEY % room)
+
+    def rooms_of(self, username):
+        return self.shards.get(username).redis.smembers(USER_ROOMS_KEY % username)
+
+    def reads(self, username):
+        """ Returns the room seq up to which username has read each of its rooms."""
+
+        reads = self.shards.get(username).redis.hgetall(READS_KEY % username)
+        return dict((room, int(read)) for room, read in reads.items())
+
+    def save_reads(self, username, room_reads):
+        """ Advances the reads of username with the RoomReads of one of its sockets."""
+
+        arguments = room_reads.arguments()
+        if arguments:
+            redis = self.shards.get(username).redis
+            self._save_reads([READS_KEY % username, USER_ROOMS_KEY % username], arguments, client=redis)
+
+    def publish(self, room, message, client=None):
+        """
+        Publishes message on the channel of room, preceded by its room seq.
+        Returns the room seq.
+        """
+
+        return self._publish([ROOM_SEQ_KEY % room], [room, message], client=client or self.shards.get(room).redis)
+
+    def rebalance(self):
+        """
+        Moves the sets that a change of the redis nodes left on a node they no
+        longer belong to.  Run it once every server uses the new nodes.
+        Returns the number of sets moved.
+        """
+
+        moved = 0
+        for shard in self.shards:
+            for prefix, move in ((ROOM_KEY % "", self._move_set), (USER_ROOMS_KEY % "", self._move_set),
+                                 (ROOM_SEQ_KEY % "", self._move_seq), (READS_KEY % "", self._move_reads)):
+                for key in shard.redis.scan_iter(match=prefix + "*"):
+                    owner = self.shards.get(key[len(prefix):])
+                    if owner is not shard:
+                        move(key, shard.redis, owner.redis)
+                        shard.redis.delete(key)
+                        moved += 1
+        return moved
+
+    def _move_set(self, key, source, target):
+        target.sadd(key, *source.smembers(key))
+
+    def _move_seq(self, key, source, target):
+        # the owner may have numbered messages already
+        target.set(key, max(int(source.get(key) or 0), int(target.get(key) or 0)))
+
+    def _move_reads(self, key, source, target):
+        for room, read in source.hgetall(key).items():
+            if int(read) > int(target.hget(key, room) or -1):
+                target.hset(key, room, read)
@@ -1,95 +1,281 @@
-#from gevent import monkey; monkey.patch_all(socket=True, dns=True, time=True, select=True,thread=False,
-#    os=True, ssl=True, httplib=False, aggressive=True)
+import cooperative; cooperative.patch()
+import argparse
 import gevent
 from gevent.greenlet import Greenlet
+from gevent.lock import RLock
+from gevent.socket import wait_read
+import json
+import os
+import random
 import redis
+import signal
+import socket
 import sys
-
-from orm.models import UserModel, MessageModel
+import time
+
+from acks import AckWindow
+from cache import LRUCache, MISSING
+from cooperative import database
+from codec import (ACK_PROTOCOL, COMMAND_PREFIX, count_messages, is_ack, is_batch, is_command, is_room, make_delivery,
+                   make_history_message, make_message, make_reconnect, make_record, make_resume, make_room_message,
+                   make_session, parse_ack, parse_batch, parse_command, parse_message)
+from deflate import DeflateStream, negotiate
+from django.conf import settings
+import metrics
+from orm.models import UserModel
+from outbox import Outbox
+from presence import Presence
+from ratelimit import TokenBucket, UserRateLimit
+from rooms import RoomReads, Rooms
+from sessions import Sessions
+from sharding import Shards
+from storage import Message, MessageWriter, ROOM_NAME_LENGTH, UserRecord, set_node_id
+from workers import Arbiter, WorkerHealth, has_reported, reuseport_listener, worker_status
 from ws4py.websocket import WebSocket
-from ws4py.server.geventserver import WSGIServer
+from ws4py.server.geventserver import GEventWebSocketPool, WSGIServer
 from ws4py.server.wsgiutils import WebSocketWSGIApplication
 
 
-class MessageUtils:
-    def make_message(self, username, message_text):
-        """ Given a username and text, this formats the message to be sent to the user."""
+CONNECTIONS = metrics.counter("chat_connections_total", "WebSocket connections opened.")
+DISCONNECTIONS = metrics.counter("chat_disconnections_total", "WebSocket connections closed.")
+AUTH_FAILURES = metrics.counter("chat_auth_failures_total", "Authentications rejected.")
+MESSAGES_ROUTED = metrics.counter("chat_messages_routed_total", "Messages published to an online recipient.")
+MESSAGES_OFFLINE = metrics.counter("chat_messages_offline_total", "Messages kept for an offline recipient.")
+MESSAGE_ERRORS = metrics.counter("chat_message_errors_total", "Messages rejected with an error.")
+RECEIVE_LATENCY = metrics.histogram("chat_receive_seconds", "Time spent handling a received frame.")
+PARSE_LATENCY = metrics.histogram("chat_parse_seconds", "Time spent parsing a message.")
+ROUTE_LATENCY = metrics.histogram("chat_route_seconds", "Time spent routing a message.")
+PUBLISH_LATENCY = metrics.histogram("chat_redis_publish_seconds", "Redis round-trip of a publish.")
+OFFLINE_LATENCY = metrics.histogram("chat_offline_flush_seconds", "Time spent replaying offline messages at login.")
+CONNECTION_GREENLETS = metrics.gauge("chat_connection_greenlets", "Greenlets serving a WebSocket connection.")
+SOCKET_THROTTLED = metrics.counter("chat_socket_throttled_total", "Messages dropped by the rate limit of a socket.")
+USER_THROTTLED = metrics.counter("chat_user_throttled_total", "Messages dropped by the rate limit of a user.")
+DEFLATE_INPUT = metrics.counter("chat_deflate_input_bytes_total",
+                                "Bytes of the frames sent with permessage-deflate, before compression.")
+DEFLATE_OUTPUT = metrics.counter("chat_deflate_output_bytes_total",
+                                 "Bytes of the frames sent with permessage-deflate, after compression.")
+
+# counts the server processes started, which take their node id from it
+NODE_ID_KEY = "chat:node_id"
+
 
-        if username and message_text:
-            return "@" + str(username) + " >> " + message_text
+class RedisAdapter():
+    def __init__(self):
+        self.subscriptions = {}
+        self.user_rooms = {}
+        self.users = LRUCache(settings.CHAT_USER_CACHE_SIZE, settings.CHAT_USER_CACHE_TTL)
+        self.shards = Shards(settings.CHAT_REDIS_NODES, settings.CHAT_REDIS_MAX_CONNECTIONS,
+                             settings.CHAT_REDIS_POOL_TIMEOUT, settings.CHAT_REDIS_PIPELINE_WINDOW)
+        self.redis = self.shards.home.redis
+        # redis calls yield to the hub, the subscriptions change under this lock
+        self.lock = RLock()
+        self.listeners = {}
+        self.reconnect_delay = 1
+        self.presence = Presence(self.shards, settings.CHAT_PRESENCE_TTL, self.user_rooms.keys)
+        self.rooms = Rooms(self.shards)
+        self.sessions = Sessions(self.shards, settings.CHAT_SESSION_TTL,
+                                 LRUCache(settings.CHAT_SESSION_CACHE_SIZE, settings.CHAT_SESSION_CACHE_TTL))
+        self.user_rate_limit = UserRateLimit(self.shards, settings.CHAT_USER_RATE, settings.CHAT_USER_BURST,
+                                             settings.CHAT_USER_RATE_LEASE)
 
-        raise Exception("Trying to create message with invalid username.")
+    def store_user(self, user):
+        self.users.set(user.username, user)
 
-    def parse_message(self, message):
+    def get_user(self, username):
         """
-        Given a text message including the username and actual message, parses
-        the message into username and actual message_text
+        Returns the UserRecord of username from the cache, loading it from the
+        database on a miss.  Unknown usernames are cached as well, so they do
+        not hit the database again until CHAT_USER_CACHE_NEGATIVE_TTL expires.
         """
 
-        tokens = str(message).split(None, 1)
-
-        if len(tokens) == 2:
-            user = tokens[0]
-            message_text = tokens[1]
+        user = self.users.get(username, MISSING)
+        if user is MISSING:
+            try:
+                user = UserRecord(*database.call(UserModel.objects.values_list("id", "username").get,
+                                                 username = username))
+                self.users.set(username, user)
+            except UserModel.DoesNotExist:
+                user = None
+                self.users.set(username, user, settings.CHAT_USER_CACHE_NEGATIVE_TTL)
 
-            if user.startswith('@') and message_text:
-                return user[1:], message_text
+        if user is None:
+            raise UserModel.DoesNotExist("UserModel matching query does not exist.")
 
-        raise Exception("Message could not be parsed.")
+        return user
 
+    def add_connection(self, username, ws):
+        """
+        Ads ws to the key username and to the rooms of the user.  The shared
+        pubsub connection of the redis node of a channel is subscribed to it
+        only when the first local socket of the channel is added.  If a node
+        fails meanwhile ws is taken out of every channel again.  Returns True
+        if the user was online before, on this node or another.
+        """
 
-class RedisAdapter():
-    def __init__(self):
-        self.subscriptions = {}
-        self.users = {}
-        self.redis = redis.StrictRedis(host='localhost', port=6379, db=0)
+        online = True
+        with self.lock:
+            try:
+                if self._subscribe(username, ws):
+                    self.user_rooms[username] = set(self.rooms.rooms_of(username))
+                    online = self.presence.join(username)
 
-    def is_user_stored(self, username):
-        return username in self.users
+                for room in self.user_rooms[username]:
+                    self._subscribe(room, ws)
+            except redis.ConnectionError:
+                self._forget(username, ws)
+                raise
 
-    def store_user(self, user):
-        if not self.is_user_stored(user.username):
-            self.users[user.username] = user
+        self._start_listeners()
+        return online
 
-    def get_user(self, username):
-        return self.users[username]
+    def remove_connection(self, username, ws):
+        with self.lock:
+            if ws not in self.subscriptions.get(username, ()):
+                # already removed by a drain
+                return
 
-    def add_connection(self, username, ws):
+            for room in self.user_rooms[username]:
+                self._unsubscribe(room, ws)
+
+            if self._unsubscribe(username, ws):
+                del self.user_rooms[username]
+                self.presence.leave(username)
+                self.user_rate_limit.forget(username)
+
+    def join_room(self, username, room):
+        """ Makes username a member of room and subscribes its local sockets to the room."""
+
+        self.rooms.join(username, room)
+        with self.lock:
+            rooms = self.user_rooms.get(username)
+            if rooms is not None and room not in rooms:
+                rooms.add(room)
+                for ws in self.subscriptions[username]:
+                    self._subscribe(room, ws)
+        self._start_listeners()
+
+    def leave_room(self, username, room):
+        self.rooms.leave(username, room)
+        with self.lock:
+            rooms = self.user_rooms.get(username)
+            if rooms is not None and room in rooms:
+                rooms.remove(room)
+                for ws in self.subscriptions[username]:
+                    self._unsubscribe(room, ws)
+
+    def stats(self):
+        return {"users": len(self.user_rooms),
+                "sockets": sum(len(self.subscriptions[username]) for username in self.user_rooms)}
+
+    def send_message_to_channel(self, channel, message, seq):
         """
-        Ads ws to the key username.
+        Publishes message, whose seq the sockets confirm, to the sockets of
+        channel anywhere in the cluster.  Returns 0 without publishing when the
+        user is offline everywhere.
         """
 
-        subscriber = self.redis.pubsub()
-        subscriber.subscribe(username)
-        g_listener = Greenlet(self._listen_to_channel, subscriber, ws)
-        g_listener.start()
-        ws.greenlet_listener = g_listener
-
-        if username in self.subscriptions:
-            self.subscriptions[username].append(ws)
-        else:
-            self.subscriptions[username] = [ws]
+        with PUBLISH_LATENCY.time():
+            return self.shards.get(channel).pipeline.call(self.presence.publish_if_online, channel,
+                                                          "%d %s" % (seq, message))
+
+    def send_message_to_room(self, room, message):
+        """ Publishes message once to the members of room on every node.  Returns its room seq."""
+
+        with PUBLISH_LATENCY.time():
+            return self.shards.get(room).pipeline.call(self.rooms.publish, room, message)
+
+    def take_user_tokens(self, username, count):
+        """ Takes count tokens from the cluster-wide bucket of username.  Returns False if the user is over its rate limit."""
+
+        if self.user_rate_limit.rate is None:
+            return True
+        return self.user_rate_limit.take(username, count)
+
+    def _subscribe(self, channel, ws):
+        """ Adds ws to channel.  Returns True if it is the first local socket of the channel."""
+
+        sockets = self.subscriptions.setdefault(channel, [])
+        sockets.append(ws)
+        if len(sockets) == 1:
+            self.shards.get(channel).pubsub.subscribe(channel)
+            return True
+        return False
+
+    def _unsubscribe(self, channel, ws):
+        """ Removes ws from channel.  Returns True if it was the last local socket of the channel."""
+
+        sockets = self.subscriptions[channel]
+        sockets.remove(ws)
+        if not sockets:
+            del self.subscriptions[channel]
+            self.shards.get(channel).pubsub.unsubscribe(channel)
+            return True
+        return False
+
+    def _forget(self, username, ws):
+        for channel in [channel for channel, sockets in self.subscriptions.items() if ws in sockets]:
+            sockets = self.subscriptions[channel]
+            sockets.remove(ws)
+            if not sockets:
+                del self.subscriptions[channel]
+                pubsub = self.shards.get(channel).pubsub
+                if channel in pubsub.channels:
+                    try:
+                        pubsub.unsubscribe(channel)
+                    except redis.ConnectionError:
+                        pass
+        if username not in self.subscriptions and self.user_rooms.pop(username, None) is not None:
+            try:
+                self.presence.leave(username)
+            except redis.ConnectionError:
+                pass
+
+    def _start_listeners(self):
+        for shard in self.shards:
+            listener = self.listeners.get(shard)
+            if shard.pubsub.subscribed and (listener is None or listener.dead):
+                self.listeners[shard] = Greenlet(self._listen, shard.pubsub)
+                self.listeners[shard].start()
+
+    def _listen(self, pubsub):
+        """
+        Single listener for every channel of this process on a redis node. It
+        sleeps on the pubsub socket until redis sends something, so idle
+        sockets cost no CPU.  It returns once all the channels of the node
+        have been unsubscribed and is restarted by add_connection.
+        """
 
-    def remove_connection(self, username, ws):
-        self.subscriptions[username].remove(ws)
-        if not self.subscriptions[username]:
-            self.subscriptions.pop(username, None)
+        while pubsub.subscribed:
+            try:
+                connection = pubsub.connection
+                if connection._sock is None:
+                    connection.connect()
 
-    def send_message_to_channel(self, channel, message):
-        return self.redis.publish(channel, message)
+                wait_read(connection._sock.fileno())
+                self._drain_messages(pubsub)
+            except redis.ConnectionError:
+                gevent.sleep(self.reconnect_delay)
 
+    def _drain_messages(self, pubsub):
+        """ Dispatches every message already received or buffered by the parser."""
 
-    def _listen_to_channel(self, subscriber, ws):
-        while True:
-            message = subscriber.get_message()
+        connection = pubsub.connection
+        while connection.can_read(timeout=0):
+            message = pubsub.get_message()
             if message and message["type"] == "message":
-                ws.send(message["data"])
+                self._dispatch(message["channel"], message["data"])
 
-            if not ws.is_open:
-                subscriber.unsubscribe()
-                return
+    def _dispatch(self, channel, data):
+        # preceded by its seq, or by its room seq in a room
+        seq, _, data = data.partition(" ")
+        messages = ((channel if is_room(channel) else None, int(seq)),)
 
-            gevent.sleep(0)
+        for ws in self.subscriptions.get(channel, ()):
+            try:
+                ws.deliver([data], messages)
+            except Exception:
+                # the socket is being closed, the other sockets still get the message
+                pass
 
 
 
@@ -97,114 +283,609 @@ class ChatMessageController(object):
     def process_message(self, message, ws):
         """
         Takes a message from a websocket and tries to send the message to destination.
+        The messages of a batch are processed in order and their errors are
+        sent back together, one 'position: error' line each.
         """
 
-        try:
-            to_username, message_text = MessageUtils().parse_message(message)
-            if redis_adapter.is_user_stored(to_username):
-                to_user = redis_adapter.get_user(to_username)
-            else:
-                to_user = UserModel.objects.get(username = to_username)
+        if is_batch(message):
+            errors = []
+            for position, part in enumerate(parse_batch(message)):
+                try:
+                    self._process(part, ws)
+                except Exception, e:
+                    MESSAGE_ERRORS.inc()
+                    errors.append("%d: %s" % (position, e))
 
-            msg = MessageModel(from_user=ws.user, to_user=to_user, message_text=message_text)
-            msg.delivered = self._route_message(msg)
-            msg.save()
+            if errors:
+                ws.send("\n".join(errors))
+            return
 
+        try:
+            self._process(message, ws)
         except Exception, e:
+            MESSAGE_ERRORS.inc()
             ws.send(str(e))
 
+    def _process(self, message, ws):
+        if is_command(message):
+            self._run_command(message, ws)
+            return
+
+        with PARSE_LATENCY.time():
+            to_username, message_text = parse_message(message)
+
+        if is_room(to_username):
+            message_writer.put(self._send_to_room(ws, to_username, message_text))
+            return
+
+        to_user = redis_adapter.get_user(to_username)
+        msg = Message(from_user=ws.user, to_user=to_user, message_text=message_text)
+        # queued undelivered before the recipient can confirm it
+        message_writer.put(msg)
+        with ROUTE_LATENCY.time():
+            routed = self._route_message(msg)
+        (MESSAGES_ROUTED if routed else MESSAGES_OFFLINE).inc()
+
     def socket_closed(self, ws):
         if ws.user:
             redis_adapter.remove_connection(ws.user.username, ws)
 
     def _route_message(self, msg):
-        message = MessageUtils().make_message(msg.from_user.username, msg.message_text)
-        delivered = redis_adapter.send_message_to_channel(msg.to_user.username, message)
-        return delivered
+        message = make_message(msg.from_user.username, msg.message_text)
+        try:
+            return redis_adapter.send_message_to_channel(msg.to_user.username, message, msg.seq)
+        except redis.ConnectionError:
+            # the node of the recipient is down, it gets the message at its next login
+            return 0
+
+    def _send_to_room(self, ws, room, message_text):
+        """
+        Publishes a message to the members of room.  It is saved once, with its
+        room seq; the members that are offline read it at their next login.
+        """
+
+        if room not in redis_adapter.user_rooms.get(ws.user.username, ()):
+            raise Exception("You are not a member of %s." % room)
+
+        msg = Message(from_user=ws.user, room=room, message_text=message_text, delivered=True)
+        with ROUTE_LATENCY.time():
+            message = make_room_message(room, ws.user.username, message_text)
+            msg.room_seq = redis_adapter.send_message_to_room(room, message)
+        MESSAGES_ROUTED.inc()
+        return msg
+
+    def _run_command(self, message, ws):
+        command, arguments = parse_command(message)
+        if command == "history":
+            self._send_history(ws, arguments)
+            return
+        if command == "resume":
+            self._confirm(ws, arguments)
+            return
+        if command not in ("join", "leave"):
+            raise Exception("Unknown command /%s." % command)
+
+        if len(arguments) != 1 or not is_room(arguments[0]) or len(arguments[0]) > ROOM_NAME_LENGTH:
+            raise Exception("Usage: /%s #room" % command)
+
+        room = arguments[0]
+        if command == "join":
+            redis_adapter.join_room(ws.user.username, room)
+            ws.send("Joined %s." % room)
+        else:
+            redis_adapter.leave_room(ws.user.username, room)
+            ws.send("Left %s." % room)
+
+    def _confirm(self, ws, arguments):
+        """ Marks delivered the chunks of the offline backlog the client confirms it has received."""
+
+        if len(arguments) != 1:
+            raise Exception("Usage: /resume cursor")
+        try:
+            message_writer.store.confirm(ws.user, arguments[0])
+        except ValueError:
+            raise Exception("Invalid resume cursor.")
+
+    def _send_history(self, ws, arguments):
+        """
+        Sends a page of the conversation of ws.user with another user, oldest
+        message first.  A full page ends with the command that fetches the
+        page before it, the seq of its first message being the cursor.
+        """
+
+        usage = "Usage: /history @user [before-seq] [limit]"
+        if not 1 <= len(arguments) <= 3 or len(arguments[0]) < 2 or arguments[0][0] != "@":
+            raise Exception(usage)
+        try:
+            before_seq = int(arguments[1]) if len(arguments) > 1 else None
+            limit = int(arguments[2]) if len(arguments) > 2 else settings.CHAT_HISTORY_PAGE_SIZE
+        except ValueError:
+            raise Exception(usage)
+        if not 0 < limit <= settings.CHAT_HISTORY_MAX_PAGE_SIZE:
+            raise Exception(usage)
+
+        address = arguments[0]
+        other = redis_adapter.get_user(address[1:])
+        # messages still queued for the store belong to the page too
+        message_writer.flush()
+        page = message_writer.store.history(ws.user, other, before_seq, limit)
+
+        lines = ["History with %s:" % address] + [make_history_message(*message) for message in page]
+        if len(page) == limit:
+            lines.append("More: /history %s %d %d" % (address, page[0][0], limit))
+        ws.send("\n".join(lines))
 
 
 class AuthenticateMessageController(object):
     def process_message(self, message, ws):
         """
-        It uses a websocket message to authenticate the ws.
+        It uses a websocket message to authenticate the ws.  A client that
+        logs in with 'username cursor' resumes its offline backlog after the
+        chunks the cursor confirms, and gets the token of a session it can
+        log in again with as '/session token cursor'.
         """
 
-        self._authenticate_socket(message, ws)
+        tokens = str(message).split()
+        login, cursor = message, None
+        if tokens[:1] == [COMMAND_PREFIX + "session"] and len(tokens) in (2, 3):
+            cursor = tokens[2] if len(tokens) == 3 else "0"
+            online = self._resume_session(tokens[1], ws)
+        else:
+            if len(tokens) == 2 and tokens[1].replace(".", "").isdigit():
+                login, cursor = tokens
+            online = self._authenticate_socket(login, ws)
+            if ws.user:
+                try:
+                    ws.send(make_session(redis_adapter.sessions.create(ws.user)))
+                except redis.ConnectionError:
+                    # the client logs in by username next time
+                    pass
         if ws.user:
-            offline_messages = MessageModel.objects.filter(to_user = ws.user, delivered = False)
-            self._send_offline_messages(offline_messages, ws)
+            if cursor is not None:
+                try:
+                    message_writer.store.confirm(ws.user, cursor)
+                except ValueError:
+                    # the backlog is replayed from its first undelivered message
+                    pass
+            with OFFLINE_LATENCY.time():
+                self._send_offline_messages(ws, cursor is not None)
+                if not online:
+                    self._send_room_backlog(ws)
             ws.send("Authentication successful.  Write a message like this: '@username your message' ")
             ws.set_authenticated()
 
 
     def socket_closed(self, ws):
-        pass
+        if ws.user:
+            redis_adapter.remove_connection(ws.user.username, ws)
 
 
     def _authenticate_socket(self, message, ws):
         username = Authentication().authenticate(username = message)
         if username:
-            user, _ = UserModel.objects.get_or_create(username = username)
-            ws.authenticated = True
-            ws.user = user
-            redis_adapter.add_connection(username, ws)
-            redis_adapter.store_user(user)
-        else:
-            ws.send("Invalid username.")
+            user, _ = database.call(UserModel.objects.get_or_create, username = username)
+            return self._add_socket(UserRecord(user.id, user.username), ws)
+
+        AUTH_FAILURES.inc()
+        ws.send("Invalid username.")
+
+
+    def _resume_session(self, token, ws):
+        """ Authenticates ws by the token of a session, from the caches or redis without querying the database."""
+
+        try:
+            session = redis_adapter.sessions.resume(token)
+        except redis.ConnectionError:
+            ws.send("Chat server unavailable, try again later.")
+            return
+        if session is None:
+            AUTH_FAILURES.inc()
+            ws.send("Invalid session.")
+            return
+
+        user = redis_adapter.users.get(session.username)
+        if user is None or user.id != session.user_id:
+            user = UserRecord(session.user_id, session.username)
+        return self._add_socket(user, ws)
+
+
+    def _add_socket(self, user, ws):
+        """ Authenticates ws as user.  Returns True if the user was online before."""
+
+        try:
+            online = redis_adapter.add_connection(user.username, ws)
+        except redis.ConnectionError:
+            # a redis node of the user or of one of its rooms is down
+            ws.send("Chat server unavailable, try again later.")
+            return
+        ws.authenticated = True
+        ws.user = user
+        redis_adapter.store_user(user)
+        return online
+
+
+    def _send_offline_messages(self, ws, resumable=False):
+        """
+        Streams the messages received by ws.user while offline from the store,
+        one frame per chunk of CHAT_OFFLINE_CHUNK_SIZE messages.  The chunks
+        of a resumable replay end with their cursor and stay undelivered
+        until the client confirms them, so a connection lost while they are
+        queued or on the wire does not lose them.
+
+        The messages the writer has not saved yet follow in a frame of their
+        own, confirmed like live messages once the socket has received them,
+        so a login does not wait for the writer to save those of other users.
+        """
+
+        pending = message_writer.pending(ws.user)
+        # saved since they were read from the queue
+        skipped = set(msg.seq for msg in pending)
+        for chunk in message_writer.store.undelivered(ws.user, settings.CHAT_OFFLINE_CHUNK_SIZE, not resumable):
+            lines = [make_delivery(*message) for message, seq in zip(chunk, chunk.seqs) if seq not in skipped]
+            seqs = [seq for seq in chunk.seqs if seq not in skipped]
+            if resumable:
+                lines.append(make_resume(chunk.cursor))
+                seqs.append(0)
+            if lines:
+                ws.send_lines(lines, seqs)
+
+        if pending:
+            ws.deliver([make_message(msg.from_user.username, msg.message_text) for msg in pending],
+                       [(None, msg.seq) for msg in pending])
+
 
+    def _send_room_backlog(self, ws):
+        """
+        Streams the messages sent to the rooms of ws.user after the room seqs
+        it has read, one frame per chunk of CHAT_OFFLINE_CHUNK_SIZE messages.
+        Only a user that was offline everywhere gets them: the sockets of a
+        user that is online elsewhere get the live messages, as that one does.
+        """
+
+        try:
+            reads = redis_adapter.rooms.reads(ws.user.username)
+        except redis.ConnectionError:
+            # nothing is marked read, they are sent at the next login
+            return
 
-    def _send_offline_messages(self, offline_messages, ws):
-        for message in offline_messages:
-            username = message.from_user.username
-            text = message.message_text
-            message_text = MessageUtils().make_message(username, text)
-            ws.send(message_text)
-            message.delivered = True
-            message.save()
+        for room in list(redis_adapter.user_rooms.get(ws.user.username, ())):
+            if room not in reads:
+                continue
+            for chunk in message_writer.store.room_backlog(room, reads[room], settings.CHAT_OFFLINE_CHUNK_SIZE):
+                ws.deliver([make_room_message(room, username, text) for _, username, text in chunk],
+                           [(room, room_seq) for room_seq, _, _ in chunk])
 
 
 class Authentication(object):
     def authenticate(self, username):
         username = str(username)
-        if len(username.split()) == 1:
+        if len(username.split()) == 1 and not is_room(username):
             return username
 
         return None
 
+# the controllers keep no state of their own, every socket shares them
+chat_controller = ChatMessageController()
+authenticate_controller = AuthenticateMessageController()
+
+
+class ChatWSGIApplication(WebSocketWSGIApplication):
+    """ Adds permessage-deflate to the handshake, ws4py does not negotiate it."""
+
+    def __call__(self, environ, start_response):
+        if settings.CHAT_DEFLATE_LEVEL is None:
+            return WebSocketWSGIApplication.__call__(self, environ, start_response)
+
+        extension, deflate = negotiate(environ.get("HTTP_SEC_WEBSOCKET_EXTENSIONS"), settings.CHAT_DEFLATE_LEVEL,
+                                       settings.CHAT_DEFLATE_MIN_SIZE, settings.CHAT_DEFLATE_CONTEXT_TAKEOVER,
+                                       settings.CHAT_DEFLATE_MAX_MESSAGE_SIZE)
+        if deflate is None:
+            return WebSocketWSGIApplication.__call__(self, environ, start_response)
+
+        def start_deflate_response(status, headers):
+            return start_response(status, headers + [("Sec-WebSocket-Extensions", extension)])
+
+        environ["chat.deflate"] = deflate
+        return WebSocketWSGIApplication.__call__(self, environ, start_deflate_response)
+
+
+class ChatWebSocketPool(GEventWebSocketPool):
+    def add(self, greenlet):
+        GEventWebSocketPool.add(self, greenlet)
+        CONNECTION_GREENLETS.inc()
+
+    def _discard(self, greenlet):
+        # discard() may be called for a greenlet that has finished and left the pool
+        if greenlet in self.greenlets:
+            CONNECTION_GREENLETS.dec()
+        GEventWebSocketPool._discard(self, greenlet)
+
+    def clear(self):
+        """ Closes the remaining sockets on shutdown; the ws4py pool discards from the set it iterates."""
+
+        for greenlet in list(self):
+            # finished greenlets have no _run
+            websocket = getattr(getattr(greenlet, "_run", None), "im_self", None)
+            if websocket is not None and not websocket.terminated:
+                websocket.close(1001, "Server is shutting down")
+            self.discard(greenlet)
+
+
 class ChatWebSocketServer(WebSocket):
+    # ws4py keeps its own state in a __dict__, the state of the chat server is kept in slots
+    __slots__ = ("deflate", "controller", "user", "is_open", "authenticated", "outbox", "acks", "rate_limit",
+                 "room_reads")
+
     def __init__(self, *args, **kwargs):
         WebSocket.__init__(self, *args, **kwargs)
-        self.controller = AuthenticateMessageController()
+        self.deflate = self.environ.pop("chat.deflate", None) if self.environ else None
+        if self.deflate is not None:
+            self.stream = DeflateStream(self.deflate)
+        self.controller = authenticate_controller
         self.user = None
-        self.greenlet_listener = None
         self.is_open= False
+        self.authenticated = False
+        self.outbox = Outbox(self._write_frame, self._confirm, self._disconnect)
+        self.acks = (AckWindow(self.outbox.put, self._confirm, self._disconnect, settings.CHAT_ACK_WINDOW,
+                               settings.CHAT_ACK_TIMEOUT, settings.CHAT_ACK_RETRIES, settings.CHAT_OUTBOX_SIZE)
+                     if ACK_PROTOCOL in (self.protocols or ()) else None)
+        self.rate_limit = (TokenBucket(settings.CHAT_SOCKET_RATE, settings.CHAT_SOCKET_BURST)
+                           if settings.CHAT_SOCKET_RATE is not None else None)
+        self.room_reads = None
 
     def opened(self):
+        CONNECTIONS.inc()
         self.send("Welcome to ChatServer.")
         self.send("To authenticate enter your username.")
         self.is_open = True
 
     def closed(self, code, reason=None):
+        DISCONNECTIONS.inc()
         self.is_open = False
-        if self.greenlet_listener:
-            self.greenlet_listener.kill()
+        self.outbox.stop()
+        if self.acks is not None:
+            self.acks.close()
+        if self.user and self.room_reads is not None:
+            try:
+                redis_adapter.rooms.save_reads(self.user.username, self.room_reads)
+            except redis.ConnectionError:
+                # the next login sends the messages again
+                pass
         self.controller.socket_closed(self)
 
     def received_message(self, message):
-        self.controller.process_message(message, self)
+        with RECEIVE_LATENCY.time():
+            if self.acks is not None and is_ack(message):
+                self._ack(message)
+                return
+            if self._over_rate_limit(message):
+                self.send("Rate limit exceeded, the message was dropped.")
+                return
+            self.controller.process_message(message, self)
 
     def set_authenticated(self):
-        self.controller = ChatMessageController()
+        self.controller = chat_controller
+
+    def send(self, payload, binary=False):
+        """
+        Queues a text frame on the outbox of the socket.  The outbox greenlet
+        writes it, so the redis listener never waits for a slow client.  A
+        client that acknowledges messages gets it as a single record.
+        """
+
+        if self.terminated:
+            raise RuntimeError("Cannot send on a terminated websocket")
+
+        if binary or not isinstance(payload, basestring):
+            return WebSocket.send(self, payload, binary)
+
+        self.outbox.put(payload if self.acks is None else make_record(0, 0, payload))
+
+    def send_lines(self, lines, seqs):
+        """
+        Sends lines in a frame, each as a record with its seq, the seq of a
+        direct message or 0, if the client acknowledges messages.  The client
+        does not acknowledge them and drops the messages it has already.
+        """
+
+        if self.terminated:
+            raise RuntimeError("Cannot send on a terminated websocket")
+
+        if self.acks is None:
+            self.outbox.put("\n".join(lines))
+        else:
+            self.outbox.put("\n".join([make_record(0, seq, line) for line, seq in zip(lines, seqs)]))
+
+    def deliver(self, lines, messages):
+        """
+        Sends a frame of chat messages, through the acknowledgement window if
+        the client acknowledges them.  messages are the (room, seq) of lines,
+        room None and seq the seq of a direct message or the room and its
+        room seq, confirmed once the client has received them.
+        """
+
+        if self.terminated:
+            raise RuntimeError("Cannot send on a terminated websocket")
+
+        if self.acks is None:
+            self.outbox.put("\n".join(lines), messages)
+        else:
+            self.acks.send(lines, messages)
+
+    def read_room(self, room, room_seq):
+        """ Records that the socket has read the message room_seq of room, saved when it closes."""
+
+        if self.room_reads is None:
+            self.room_reads = RoomReads()
+        self.room_reads.read(room, room_seq)
+
+    def _ack(self, message):
+        """ Handles '/ack id'.  Acknowledgements are not chat messages and skip the rate limits."""
+
+        try:
+            self.acks.ack(parse_ack(message))
+        except Exception, e:
+            self.send(str(e))
+
+    def _over_rate_limit(self, message):
+        """
+        Takes a token per message of the frame from the bucket of the socket,
+        then from the bucket of the user.  Runs before the frame is parsed, so
+        a throttled client costs no database or routing work.  The user is not
+        limited while its redis node is down, the socket bucket still is.
+        """
+
+        count = count_messages(message)
+        if self.rate_limit is not None and not self.rate_limit.take(count):
+            SOCKET_THROTTLED.inc(count)
+            return True
+        if not self.user:
+            return False
+        try:
+            allowed = redis_adapter.take_user_tokens(self.user.username, count)
+        except redis.ConnectionError:
+            return False
+        if not allowed:
+            USER_THROTTLED.inc(count)
+            return True
+        return False
+
+    def _write_frame(self, frame):
+        if self.terminated:
+            return
+
+        if self.deflate is None:
+            WebSocket.send(self, frame)
+        else:
+            data = self.deflate.frame(frame)
+            DEFLATE_INPUT.inc(len(frame))
+            DEFLATE_OUTPUT.inc(len(data))
+            self._write(data)
+
+    def _confirm(self, messages):
+        """ Saves delivered the direct messages the client has received and reads its room messages."""
+
+        for room, seq in messages:
+            if room is None:
+                message_writer.confirm(self.user, seq)
+            else:
+                self.read_room(room, seq)
+
+    def _disconnect(self):
+        """ Shuts the socket down; the read loop then closes the websocket."""
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
 
 
 redis_adapter = RedisAdapter()
+message_writer = MessageWriter()
+
+metrics.gauge("chat_local_users", "Users with a socket on this server.",
+              lambda: len(redis_adapter.user_rooms))
+metrics.gauge("chat_local_sockets", "Authenticated sockets on this server.",
+              lambda: redis_adapter.stats()["sockets"])
+metrics.gauge("chat_user_cache_hits_total", "User cache hits.",
+              lambda: redis_adapter.users.hits, "counter")
+metrics.gauge("chat_user_cache_misses_total", "User cache misses.",
+              lambda: redis_adapter.users.misses, "counter")
+metrics.gauge("chat_user_cache_evictions_total", "Users evicted from the cache.",
+              lambda: redis_adapter.users.evictions, "counter")
+metrics.gauge("chat_redis_shards_down", "Redis nodes that did not answer the last health check.",
+              lambda: len(redis_adapter.shards.down()))
+metrics.gauge("chat_persist_queue_depth", "Messages waiting to be saved.",
+              lambda: message_writer.queue.qsize())
+
+def outbox_sizes():
+    return [ws.outbox.qsize() for username in redis_adapter.user_rooms
+            for ws in redis_adapter.subscriptions[username]]
+
+metrics.gauge("chat_outbox_frames", "Frames waiting in the outboxes of the local sockets.",
+              lambda: sum(outbox_sizes()))
+metrics.gauge("chat_outbox_max_frames", "Frames waiting in the fullest outbox.",
+              lambda: max(outbox_sizes() or [0]))
+
+def drain(server, timeout=None, spread=None):
+    """
+    Stops server without losing messages.  It stops accepting connections
+    and unsubscribes the local sockets, so the messages sent from now on are
+    kept for replay, then gives the outboxes up to timeout seconds to be
+    written, keeping what is left for replay as well.  Every client is told
+    to reconnect after a random delay of up to spread seconds, so the clients
+    of a restarted server do not all log in again at once.
+    """
+
+    timeout = settings.CHAT_DRAIN_TIMEOUT if timeout is None else timeout
+    spread = settings.CHAT_DRAIN_RECONNECT_SPREAD if spread is None else spread
+
+    server.stop_accepting()
+    sockets = [ws for username in list(redis_adapter.user_rooms) for ws in redis_adapter.subscriptions[username]]
+    for ws in sockets:
+        redis_adapter.remove_connection(ws.user.username, ws)
+        # the redis calls yield, the client may have closed meanwhile
+        if not ws.terminated:
+            ws.send(make_reconnect(random.uniform(0, spread)))
+
+    deadline = time.time() + timeout
+    for ws in sockets:
+        ws.outbox.flush(max(0, deadline - time.time()))
+        if ws.acks is not None:
+            # what is still unacknowledged at the deadline is replayed at the next login
+            ws.acks.wait(max(0, deadline - time.time()))
+        ws.close(1001, "Server restarting")
+    server.stop(max(0, deadline - time.time()))
+
+
+def serve(listener, health=None, metrics_port=None):
+    """ Runs the chat server on listener until SIGTERM drains it, then saves the queued messages."""
+
+    server = WSGIServer(listener, ChatWSGIApplication(protocols=[ACK_PROTOCOL], handler_cls=ChatWebSocketServer))
+    server.pool = ChatWebSocketPool()
+    gevent.signal(signal.SIGTERM, drain, server)
+    set_node_id(redis_adapter.redis.incr(NODE_ID_KEY))
+    redis_adapter.shards.start_health_checks(settings.CHAT_REDIS_HEALTH_INTERVAL)
+    if metrics_port is not None and metrics.registry.enabled:
+        metrics.registry.serve(metrics_port)
+    server.start()
+    if health:
+        # the first report tells the arbiter that the worker accepts connections
+        health.start()
+
+    try:
+        server.serve_forever()
+    finally:
+        if health:
+            health.stop()
+        message_writer.stop()
+
 
 if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        port = int(sys.argv[1])
+    parser = argparse.ArgumentParser(description="Chat server.")
+    parser.add_argument("port", nargs="?", type=int, default=9000)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of worker processes sharing the port")
+    parser.add_argument("--status", action="store_true",
+                        help="print the health reports of the running workers")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--index", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    address = ('127.0.0.1', args.port)
+    metrics_port = settings.CHAT_METRICS_PORT
+    if metrics_port is not None:
+        metrics_port += args.index
+
+    if args.status:
+        for worker_id, health in sorted(worker_status(redis_adapter.redis).items()):
+            print worker_id, json.dumps(health) if health else "not reporting"
+    elif args.workers:
+        command = [sys.executable, os.path.abspath(__file__), str(args.port), "--worker"]
+        Arbiter(command, args.workers, settings.CHAT_DRAIN_TIMEOUT + 5,
+                lambda worker: has_reported(redis_adapter.redis, worker.pid)).run()
+    elif args.worker:
+        worker_id = "%s:%d:%d" % (socket.gethostname(), args.port, os.getpid())
+        health = WorkerHealth(redis_adapter.redis, worker_id, redis_adapter.stats)
+        serve(reuseport_listener(address), health, metrics_port)
     else:
-        port = 9000
-
-    server = WSGIServer(('127.0.0.1', port), WebSocketWSGIApplication(handler_cls=ChatWebSocketServer))
-    server.serve_forever()
-
+        serve(address, metrics_port=metrics_port)
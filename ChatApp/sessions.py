@@ -0,0 +1,68 @@
+"""
+Sessions of the authenticated clients, kept in redis.
+
+After a login by username the server sends the client '/session token', a
+random session id signed with the SECRET_KEY.  A client that logs in again
+with '/session token [cursor]' is authenticated from the hash
+'chat:session:<id>', which holds the id and the username of its user,
+instead of from the database.  Every server keeps the sessions it has seen
+in an LRU cache, so a client reconnecting to the same server is
+authenticated without leaving the process, and a token with a bad signature
+is rejected before any lookup.  A session expires ttl seconds after the
+login that created or last resumed it from redis.
+"""
+import base64
+import os
+from django.core import signing
+
+from cache import MISSING
+
+SESSION_KEY = "chat:session:%s"
+
+
+class Session(object):
+    __slots__ = ("id", "user_id", "username")
+
+    def __init__(self, id, user_id, username):
+        self.id = id
+        self.user_id = user_id
+        self.username = username
+
+
+class Sessions(object):
+    def __init__(self, shards, ttl, cache):
+        """ cache is the LRUCache of the sessions seen by this server."""
+
+        self.shards = shards
+        self.ttl = ttl
+        self.cache = cache
+        self.signer = signing.Signer(salt="chat.session")
+
+    def create(self, user):
+        """ Starts a session of user.  Returns its token."""
+
+        session = Session(base64.urlsafe_b64encode(os.urandom(12)), user.id, user.username)
+        pipe = self.shards.get(session.id).redis.pipeline()
+        pipe.hset(SESSION_KEY % session.id, mapping={"user_id": session.user_id, "username": session.username})
+        pipe.expire(SESSION_KEY % session.id, self.ttl)
+        pipe.execute()
+        self.cache.set(session.id, session)
+        return self.signer.sign(session.id)
+
+    def resume(self, token):
+        """ Returns the session of token, None if the token is forged or the session expired."""
+
+        try:
+            session_id = self.signer.unsign(token)
+        except signing.BadSignature:
+            return None
+
+        session = self.cache.get(session_id, MISSING)
+        if session is MISSING:
+            pipe = self.shards.get(session_id).redis.pipeline()
+            pipe.hgetall(SESSION_KEY % session_id)
+            pipe.expire(SESSION_KEY % session_id, self.ttl)
+            fields, _ = pipe.execute()
+            session = Session(session_id, int(fields["user_id"]), fields["username"]) if fields else None
+            self.cache.set(session_id, session)
+        return session
@@ -0,0 +1,150 @@
+"""
+Sharding of the chat channels and keys over several redis nodes.
+
+The nodes of CHAT_REDIS_NODES are placed on a consistent hash ring, each at
+REPLICAS points, and a key belongs to the node of the first point after the
+hash of the key.  The channel and the keys of a user are placed by its
+username and those of a room by its name, so every server finds them on the
+same node without asking anyone.  Adding a node only moves the keys that
+hash between its points and the points before them, about 1/N of the keys,
+all of them to the new node.
+
+Every node has its own connection pool, auto pipeline and pubsub connection.
+The health check pings the nodes every interval seconds; the commands sent
+to a node that did not answer fail at once with ShardDown instead of waiting
+for the pool timeout, until the node answers again.
+"""
+import bisect
+import hashlib
+import gevent
+import redis
+
+from autopipeline import AutoPipeline
+
+# changing it moves keys between the nodes like a change of the nodes
+REPLICAS = 100
+
+
+class ShardDown(redis.ConnectionError):
+    pass
+
+
+def _hash(key):
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    def __init__(self, nodes=(), replicas=REPLICAS):
+        self.replicas = replicas
+        self.points = []
+        self.owners = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            point = _hash("%s#%d" % (node, i))
+            index = bisect.bisect(self.points, point)
+            self.points.insert(index, point)
+            self.owners.insert(index, node)
+
+    def remove(self, node):
+        kept = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != node]
+        self.points = [point for point, owner in kept]
+        self.owners = [owner for point, owner in kept]
+
+    def get(self, key):
+        """ Returns the node of key."""
+
+        index = bisect.bisect(self.points, _hash(key))
+        return self.owners[index % len(self.owners)]
+
+
+class ShardPool(redis.BlockingConnectionPool):
+    """ Connection pool of a shard, which fails at once while the shard is down."""
+
+    def __init__(self, shard, **kwargs):
+        self.shard = shard
+        redis.BlockingConnectionPool.__init__(self, **kwargs)
+
+    def get_connection(self, command_name, *keys, **options):
+        if not self.shard.up:
+            raise ShardDown("Redis node %s is down." % self.shard.url)
+        return redis.BlockingConnectionPool.get_connection(self, command_name, *keys, **options)
+
+
+class Shard(object):
+    def __init__(self, url, max_connections=50, timeout=5, pipeline_window=0):
+        self.url = url
+        self.pool = ShardPool.from_url(url, shard=self, max_connections=max_connections, timeout=timeout)
+        self.redis = redis.StrictRedis(connection_pool=self.pool)
+        self.pipeline = AutoPipeline(self.redis, pipeline_window)
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self.up = True
+        self.failures = 0
+        self._probe = None
+
+    def check(self, timeout):
+        """
+        Pings the node on a connection of its own, which the pool of a node
+        that is down would refuse, and marks the node up or down.
+        """
+
+        if self._probe is None:
+            self._probe = self.pool.connection_class(**dict(self.pool.connection_kwargs, socket_timeout=timeout,
+                                                            socket_connect_timeout=timeout))
+        try:
+            self._probe.send_command("PING")
+            self._probe.read_response()
+            self.up = True
+        except redis.RedisError:
+            self._probe.disconnect()
+            self.failures += 1
+            self.up = False
+        return self.up
+
+    def __repr__(self):
+        return "Shard(%r)" % self.url
+
+
+class Shards(object):
+    def __init__(self, urls, max_connections=50, timeout=5, pipeline_window=0):
+        """ max_connections, timeout and pipeline_window apply to the pool and pipeline of every node."""
+
+        if not urls or len(set(urls)) != len(urls):
+            raise ValueError("The redis nodes must be distinct and at least one: %r" % (urls,))
+
+        self.nodes = [Shard(url, max_connections, timeout, pipeline_window) for url in urls]
+        # the keys of the whole cluster, like the worker reports, live on the first node
+        self.home = self.nodes[0]
+        self.ring = HashRing(urls)
+        self._by_url = dict((shard.url, shard) for shard in self.nodes)
+        self.health_check = None
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get(self, key):
+        """ Returns the shard of key, a username or a room."""
+
+        return self._by_url[self.ring.get(key)]
+
+    def down(self):
+        return [shard for shard in self.nodes if not shard.up]
+
+    def check(self, timeout):
+        gevent.joinall([gevent.spawn(shard.check, timeout) for shard in self.nodes])
+
+    def start_health_checks(self, interval):
+        if self.health_check is None or self.health_check.dead:
+            self.health_check = gevent.spawn(self._check_health, interval)
+
+    def _check_health(self, interval):
+        while True:
+            self.check(interval)
+            gevent.sleep(interval)
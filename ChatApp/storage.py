@@ -0,0 +1,518 @@
+"""
+Persistence of chat messages.
+
+The server hands Message records to the MessageWriter, which saves them in
+the background through the store named by CHAT_STORAGE_BACKEND.  Direct
+messages are saved undelivered and the sockets that receive them confirm
+them through the MessageWriter as well, as Delivery records.  A store
+implements:
+
+    save(messages)                 saves a batch of Message records
+    mark_delivered(deliveries)     marks delivered the direct messages that
+                                   Delivery records confirm; returns the
+                                   deliveries of messages it has not saved
+    undelivered(user, chunk_size, mark=True)
+                                   yields the undelivered messages of user in
+                                   seq order, as Chunks of (room,
+                                   from_username, text); a chunk is marked
+                                   delivered when the next one is requested,
+                                   or only by confirm() without mark
+    confirm(user, cursor)          marks delivered the chunks up to the one
+                                   whose cursor is given; '0' confirms nothing
+    history(user, other, before_seq, limit)
+                                   returns the last limit messages between
+                                   user and other sent before before_seq (None
+                                   for the latest), as (seq, from_username,
+                                   text) in seq order
+    room_backlog(room, after, chunk_size)
+                                   yields the messages of room after the room
+                                   seq after in room seq order, as lists of
+                                   (room_seq, from_username, text)
+
+The users are UserRecords, or anything else with an id and a username.
+DjangoStore keeps the messages in the database, logstore.LogStore in a
+local append-only log.  The queries of DjangoStore run on the database
+threads of cooperative.
+"""
+import logging
+import time
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils.module_loading import import_by_path
+import gevent
+from gevent.greenlet import Greenlet
+from gevent.lock import RLock
+from gevent.queue import Queue, Full, Empty
+
+from cooperative import database
+import metrics
+from django.db import connection
+from orm.models import MessageModel
+
+logger = logging.getLogger(__name__)
+
+MESSAGES_PERSISTED = metrics.counter("chat_messages_persisted_total", "Messages saved to the store.")
+PERSIST_ERRORS = metrics.counter("chat_persist_errors_total", "Messages whose save failed and was retried.")
+PERSIST_DROPPED = metrics.counter("chat_persist_dropped_total", "Messages given up on after failed saves.")
+PERSIST_LATENCY = metrics.histogram("chat_persist_seconds", "Time spent saving a batch of messages.")
+DELIVERIES_EXPIRED = metrics.counter("chat_deliveries_expired_total",
+                                     "Delivery confirmations given up on, their messages are replayed at login.")
+
+ROOM_NAME_LENGTH = MessageModel._meta.get_field("room").max_length
+
+# the low bits of a seq hold the node id of the process that made it
+NODE_BITS = 10
+_node_id = 0
+_last_time = 0
+
+
+def set_node_id(node_id):
+    """
+    Sets the node id of the process, which differs from those of the other
+    running servers as long as fewer than 2 ** NODE_BITS of them run.
+    """
+
+    global _node_id
+    _node_id = node_id % (1 << NODE_BITS)
+
+
+def next_seq():
+    """
+    Microseconds since the epoch, made strictly increasing within the
+    process, followed by the node id.  Processes on the same clock make
+    the same microseconds, their node ids keep the seqs apart.
+    """
+
+    global _last_time
+    _last_time = max(int(time.time() * 1000000), _last_time + 1)
+    return _last_time << NODE_BITS | _node_id
+
+
+class UserRecord(object):
+    """
+    The id and username of a user, all the server keeps of it.  It is
+    cached and referenced by every socket of the user, so it is much
+    smaller than a UserModel with its model state.
+    """
+
+    __slots__ = ("id", "username")
+
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+
+class Message(object):
+    """
+    A chat message on its way to the store.  to_user is None for a room
+    message, whose room_seq numbers it among the messages of the room.  seq
+    orders the messages by the time they were sent and tells them apart.
+    """
+
+    __slots__ = ("from_user", "to_user", "room", "message_text", "delivered", "room_seq", "seq")
+
+    def __init__(self, from_user, message_text, to_user=None, room=None, delivered=False, room_seq=0):
+        self.from_user = from_user
+        self.to_user = to_user
+        self.room = room
+        self.message_text = message_text
+        self.delivered = delivered
+        self.room_seq = room_seq
+        self.seq = next_seq()
+
+
+class Delivery(object):
+    """
+    The confirmation that a socket of user has received the direct message
+    seq.  The message may be saved by another server after the confirmation
+    arrives, so it is retried until expires.
+    """
+
+    __slots__ = ("user", "seq", "expires")
+
+    def __init__(self, user, seq, expires):
+        self.user = user
+        self.seq = seq
+        self.expires = expires
+
+
+class Chunk(list):
+    """
+    A chunk of the backlog of a user.  cursor is a string without spaces
+    that the client echoes to confirm it has received the chunk and those
+    before it, and seqs are the seqs of the messages.
+    """
+
+    __slots__ = ("cursor", "seqs")
+
+    def __init__(self, messages, cursor, seqs):
+        list.__init__(self, messages)
+        self.cursor = cursor
+        self.seqs = seqs
+
+
+def get_store():
+    """ Returns a new instance of the CHAT_STORAGE_BACKEND store."""
+
+    return import_by_path(settings.CHAT_STORAGE_BACKEND)()
+
+
+class DjangoStore(object):
+    """ Stores the messages with the Django ORM."""
+
+    def __init__(self, threads=None):
+        """ The queries run on threads, a cooperative.DatabaseThreads, by default the shared one."""
+
+        self.threads = threads or database
+
+    def save(self, messages):
+        self.threads.call(self._save, messages)
+
+    def mark_delivered(self, deliveries):
+        return self.threads.call(self._mark_confirmed, deliveries)
+
+    def undelivered(self, user, chunk_size, mark=True):
+        return self.threads.iterate(self._undelivered(user, chunk_size, mark))
+
+    def confirm(self, user, cursor):
+        self.threads.call(self._confirm, user, cursor)
+
+    def history(self, user, other, before_seq, limit):
+        return self.threads.call(self._history, user, other, before_seq, limit)
+
+    def room_backlog(self, room, after, chunk_size):
+        return self.threads.iterate(self._room_backlog(room, after, chunk_size))
+
+    @transaction.atomic
+    def _save(self, messages):
+        MessageModel.objects.bulk_create([self._model(msg) for msg in messages])
+
+    def _mark_confirmed(self, deliveries):
+        """
+        Looks the messages up in the (to_user, delivered, seq) index, the
+        undelivered ones first.  Those not found there may have been confirmed
+        by another socket of the user already, and the deliveries of the
+        messages found in neither place are returned.
+        """
+
+        seqs = {}
+        for delivery in deliveries:
+            seqs.setdefault(delivery.user.id, set()).add(delivery.seq)
+
+        found = set()
+        for user_id, user_seqs in seqs.items():
+            user_seqs = sorted(user_seqs)
+            # sqlite allows 999 variables per query
+            for i in range(0, len(user_seqs), 500):
+                page = user_seqs[i:i + 500]
+                rows = list(MessageModel.objects.filter(to_user_id = user_id, delivered = False, seq__in = page)
+                            .values_list("id", "seq"))
+                MessageModel.objects.filter(id__in = [row_id for row_id, _ in rows]).update(delivered = True)
+                missing = set(page) - set(seq for _, seq in rows)
+                if missing:
+                    rows.extend(MessageModel.objects.filter(to_user_id = user_id, delivered = True,
+                                                            seq__in = list(missing)).values_list("id", "seq"))
+                found.update((user_id, seq) for _, seq in rows)
+
+        return [delivery for delivery in deliveries if (delivery.user.id, delivery.seq) not in found]
+
+    def _undelivered(self, user, chunk_size, mark):
+        """
+        Pages through the (to_user, delivered, seq) index in (seq, id) order,
+        a chunk per query continuing after the last row of the previous one,
+        and one update marks a sent chunk as delivered, so the cost of a
+        login does not grow with the table.
+
+        The cursor of a chunk is the (seq, id) of its last row and the highest
+        id of the table when the first chunk was read: messages saved later
+        may have a lower seq, since servers save them in the background, but
+        never a lower id, so confirm() cannot mark one the client has not
+        received.
+        """
+
+        undelivered = MessageModel.objects.filter(to_user_id = user.id, delivered = False)
+        fields = ("seq", "id", "room", "from_user__username", "message_text")
+        table = connection.ops.quote_name(MessageModel._meta.db_table)
+        rows = list(undelivered.extra(select = {"snapshot": "SELECT MAX(id) FROM %s" % table})
+                    .order_by("seq", "id").values_list("snapshot", *fields)[:chunk_size])
+        snapshot = rows[0][0] if rows else 0
+        rows = [row[1:] for row in rows]
+
+        while rows:
+            yield self._chunk(rows, snapshot)
+            if mark:
+                self._mark_delivered(rows)
+
+            if len(rows) < chunk_size:
+                return
+            seq, last_id = rows[-1][:2]
+            page = undelivered.filter(seq__gte = seq).exclude(seq = seq, id__lte = last_id)
+            rows = list(page.order_by("seq", "id").values_list(*fields)[:chunk_size])
+
+    def _confirm(self, user, cursor):
+        if cursor == "0":
+            return
+
+        seq, last_id, snapshot = [int(value) for value in cursor.split(".")]
+        MessageModel.objects.filter(Q(seq__lt = seq) | Q(seq = seq, id__lte = last_id), to_user_id = user.id,
+                                    id__lte = snapshot, delivered = False).update(delivered = True)
+
+    def _history(self, user, other, before_seq, limit):
+        """
+        Reads the page from the (from_user, to_user, seq) index, once in each
+        direction, so a page costs the same however far back it is.
+        """
+
+        pairs = [(user.id, other.id), (other.id, user.id)] if user.id != other.id else [(user.id, user.id)]
+        rows = []
+        for from_user_id, to_user_id in pairs:
+            sent = MessageModel.objects.filter(from_user_id = from_user_id, to_user_id = to_user_id)
+            if before_seq is not None:
+                sent = sent.filter(seq__lt = before_seq)
+            rows.extend(sent.order_by("-seq", "-id").values_list("seq", "id", "from_user__username",
+                                                                 "message_text")[:limit])
+
+        rows.sort(reverse = True)
+        return [(seq, from_username, text) for seq, _, from_username, text in reversed(rows[:limit])]
+
+    def _room_backlog(self, room, after, chunk_size):
+        """ Pages through the (room, room_seq) index, so a login reads only the messages it sends."""
+
+        while True:
+            chunk = list(MessageModel.objects.filter(room = room, room_seq__gt = after).order_by("room_seq")
+                         .values_list("room_seq", "from_user__username", "message_text")[:chunk_size])
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_size:
+                return
+            after = chunk[-1][0]
+
+    def _chunk(self, rows, snapshot):
+        seq, last_id = rows[-1][:2]
+        return Chunk([row[2:] for row in rows], "%d.%d.%d" % (seq, last_id, snapshot), [row[0] for row in rows])
+
+    def _mark_delivered(self, rows):
+        ids = [row[1] for row in rows]
+        # sqlite allows 999 variables per query
+        for i in range(0, len(ids), 500):
+            MessageModel.objects.filter(id__in = ids[i:i + 500]).update(delivered = True)
+
+    def _model(self, msg):
+        to_user_id = msg.to_user.id if msg.to_user is not None else None
+        return MessageModel(from_user_id = msg.from_user.id, to_user_id = to_user_id, room = msg.room,
+                            message_text = msg.message_text, delivered = msg.delivered, room_seq = msg.room_seq,
+                            seq = msg.seq)
+
+
+class MessageWriter(object):
+    """
+    Write-behind persistence of chat messages.  Messages are put on a bounded
+    queue and a background greenlet saves them in batches to the store.
+
+    A batch that fails to save is kept and retried, after retry_delay seconds
+    and twice as long after every further failure, up to retry_max_delay.
+    At that delay its messages are saved one by one and those that still
+    fail while others succeed are dropped, so a message the store rejects
+    does not hold back the others.
+
+    The saves yield while the database threads run them, so a lock lets one
+    batch be saved at a time: flush() returns only once the batch the worker
+    was saving is saved as well, and stop() never kills the worker in the
+    middle of a save.
+
+    Deliveries are queued with the messages and applied after the messages
+    of their batch are saved.  Those whose message the store has not saved,
+    because another server has not yet, are retried with the following
+    batches, or every retry_delay seconds when idle, until they expire.
+    """
+
+    BLOCK = "block"
+    FLUSH = "flush"
+
+    def __init__(self, batch_size=None, flush_interval=None, max_size=None, when_full=None, store=None,
+                 retry_delay=None, retry_max_delay=None, confirm_timeout=None):
+        self.store = store or get_store()
+        self.batch_size = batch_size or settings.CHAT_PERSIST_BATCH_SIZE
+        self.flush_interval = settings.CHAT_PERSIST_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.retry_delay = settings.CHAT_PERSIST_RETRY_DELAY if retry_delay is None else retry_delay
+        self.retry_max_delay = settings.CHAT_PERSIST_RETRY_MAX_DELAY if retry_max_delay is None else retry_max_delay
+        self.confirm_timeout = settings.CHAT_DELIVERY_CONFIRM_TIMEOUT if confirm_timeout is None else confirm_timeout
+        self.when_full = when_full or settings.CHAT_PERSIST_WHEN_FULL
+        self.queue = Queue(max_size or settings.CHAT_PERSIST_QUEUE_SIZE)
+        self.worker = None
+        self.lock = RLock()
+        self._batch = []
+        self._unmatched = []
+
+        if self.when_full not in (self.BLOCK, self.FLUSH):
+            raise ValueError("Unknown CHAT_PERSIST_WHEN_FULL policy: %s" % self.when_full)
+
+    def put(self, msg):
+        """ Queues msg to be saved.  Applies the when_full policy if the queue is full."""
+
+        self._start_worker()
+        try:
+            self.queue.put_nowait(msg)
+        except Full:
+            if self.when_full == self.FLUSH:
+                self.flush()
+                self.queue.put_nowait(msg)
+            else:
+                self.queue.put(msg)
+
+    def confirm(self, user, seq):
+        """ Queues the confirmation that a socket of user has received the direct message seq."""
+
+        self.put(Delivery(user, seq, time.time() + self.confirm_timeout))
+
+    def flush(self):
+        """ Saves every queued message now.  Returns False if they could not be saved, the worker retries them."""
+
+        while True:
+            try:
+                self._batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+
+        if self._write():
+            return True
+        self._start_worker()
+        return False
+
+    def pending(self, user):
+        """
+        Returns the direct messages to user that are queued and not saved
+        yet.  Waits for the batch being saved, which the store has then, but
+        never for the rest of the queue.
+        """
+
+        with self.lock:
+            return [item for item in list(self._batch) + list(self.queue.queue)
+                    if isinstance(item, Message) and item.to_user is not None and item.to_user.id == user.id and
+                    not item.delivered]
+
+    def stop(self):
+        """
+        Shutdown hook: stops the worker and saves what is still queued,
+        retrying until the delay between the attempts would exceed
+        retry_max_delay.
+        """
+
+        with self.lock:
+            if self.worker is not None:
+                self.worker.kill()
+                self.worker = None
+
+        delay = self.retry_delay
+        while not self.flush():
+            # the retries are made here rather than by the worker flush() started
+            self.worker.kill()
+            self.worker = None
+            if delay > self.retry_max_delay:
+                PERSIST_DROPPED.inc(len(self._batch))
+                logger.error("Dropped %d chat messages that could not be saved.", len(self._batch))
+                self._batch = []
+                return
+            gevent.sleep(delay)
+            delay *= 2
+
+    def _start_worker(self):
+        if self.worker is None or self.worker.dead:
+            self.worker = Greenlet(self._run)
+            self.worker.start()
+
+    def _run(self):
+        delay = self.retry_delay
+        while True:
+            if not self._batch:
+                try:
+                    self._batch.append(self.queue.get(timeout=self.retry_delay if self._unmatched else None))
+                except Empty:
+                    pass
+            deadline = time.time() + self.flush_interval
+
+            while len(self._batch) < self.batch_size:
+                try:
+                    self._batch.append(self.queue.get(timeout=max(0, deadline - time.time())))
+                except Empty:
+                    break
+            self._batch.extend(self._unmatched)
+            self._unmatched = []
+
+            if self._write():
+                delay = self.retry_delay
+                continue
+
+            if delay >= self.retry_max_delay:
+                self._write_one_by_one()
+            gevent.sleep(delay)
+            delay = min(delay * 2, self.retry_max_delay)
+
+    def _write(self):
+        """ Saves the batch.  Returns False if it failed, the batch is then kept for the next attempt."""
+
+        with self.lock:
+            return self._save()
+
+    def _save(self):
+        batch, self._batch = self._batch, []
+        deliveries = [item for item in batch if isinstance(item, Delivery)]
+        messages = [item for item in batch if not isinstance(item, Delivery)]
+
+        if messages:
+            try:
+                with PERSIST_LATENCY.time():
+                    self.store.save(messages)
+                MESSAGES_PERSISTED.inc(len(messages))
+            except Exception:
+                PERSIST_ERRORS.inc(len(messages))
+                logger.exception("Could not save %d chat messages, they will be retried.", len(messages))
+                self._batch = batch + self._batch
+                return False
+        return self._mark_delivered(deliveries)
+
+    def _mark_delivered(self, deliveries):
+        if not deliveries:
+            return True
+
+        try:
+            unmatched = self.store.mark_delivered(deliveries)
+        except Exception:
+            logger.exception("Could not mark %d chat messages delivered, they will be retried.", len(deliveries))
+            self._batch = deliveries + self._batch
+            return False
+
+        now = time.time()
+        for delivery in unmatched:
+            if delivery.expires > now:
+                self._unmatched.append(delivery)
+            else:
+                DELIVERIES_EXPIRED.inc()
+        return True
+
+    def _write_one_by_one(self):
+        """ Saves the batch message by message, and drops those that fail if any other could be saved."""
+
+        with self.lock:
+            self._save_one_by_one()
+
+    def _save_one_by_one(self):
+        batch, self._batch = self._batch, []
+        deliveries = [item for item in batch if isinstance(item, Delivery)]
+        messages = [item for item in batch if not isinstance(item, Delivery)]
+        failed = []
+        for msg in messages:
+            try:
+                self.store.save([msg])
+                MESSAGES_PERSISTED.inc()
+            except Exception:
+                failed.append(msg)
+
+        if len(failed) < len(messages):
+            if failed:
+                PERSIST_DROPPED.inc(len(failed))
+                logger.error("Dropped %d chat messages the store rejected.", len(failed))
+            self._mark_delivered(deliveries)
+        else:
+            self._batch = failed + deliveries + self._batch
@@ -1,16 +1,51 @@
 import gc
 from greenlet import greenlet
 import gevent
+from gevent import monkey
+import gevent.socket
 from gevent.greenlet import Greenlet
+from gevent.threadpool import ThreadPool
 import os
 from orm.models import MessageModel
-from server import ChatWebSocketServer, ChatMessageController
+from server import ChatWebSocketServer, ChatMessageController, AuthenticateMessageController, ChatWSGIApplication
 import server
+import storage
 from orm.models import UserModel
-from client import UIController
-from server import MessageUtils
-from mock import MagicMock, call
+from client import ChatWebsocketClient, ReconnectPolicy, UIController
+from load_tester import Stats, percentile
+from codec import (ACK_PROTOCOL, count_messages, make_ack, make_batch, make_history_message, make_message,
+                   make_reconnect, make_record, make_resume, make_room_message, make_session, parse_ack, parse_batch,
+                   parse_command, parse_delivery, parse_message, parse_records)
+from storage import DjangoStore, Delivery, Message, MessageWriter, UserRecord, get_store, set_node_id
+from cooperative import DatabaseThreads
+from logstore import LogStore
+from deflate import DeflateStream, accept, negotiate, offer
+from outbox import Outbox
+from acks import AckWindow
+from cache import LRUCache
+from autopipeline import AutoPipeline
+import metrics
+from presence import Presence, ONLINE_KEY, USER_KEY
+from ratelimit import RATE_LIMIT_KEY, TokenBucket, UserRateLimit
+from rooms import READS_KEY, ROOM_KEY, ROOM_SEQ_KEY, USER_ROOMS_KEY, RoomReads, Rooms
+from sessions import SESSION_KEY
+from sharding import HashRing, ShardDown, Shards
+from workers import Arbiter, WorkerHealth, has_reported, reuseport_listener, worker_status
+from redis import StrictRedis, exceptions as redis_exceptions
+import shutil
+import subprocess
+import socket
+import sys
+import tempfile
+import time
+from StringIO import StringIO
+from mock import MagicMock, call, patch
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from ws4py.framing import Frame, OPCODE_CONTINUATION, OPCODE_TEXT
+from ws4py.messaging import TextMessage
+from django.test.utils import override_settings
 
 
 
@@ -59,38 +94,213 @@ class UIControllerTest(TestCase):
         self.controller.run()
         self.ws_client.send.assert_called_with(message)
 
+    def test_lost_connection_replaced_and_logged_in(self):
+        new_client = MagicMock()
+        new_client.receive = MagicMock(side_effect = ["Message", None])
+        self.ws_client.receive = MagicMock(return_value = None)
+        self.ws_client.username = "alice"
+        self.ws_client.reconnect_delay = 0
+        self.ws_client.reconnected = MagicMock(return_value = new_client)
+        self.ui.is_closed = MagicMock(side_effect = [False, False, True])
+
+        controller = UIController(self.ws_client, self.ui, ReconnectPolicy())
+        controller.socket_loop()
+        new_client.connect.assert_called_with()
+        new_client.login.assert_called_with(new_client.username)
+        self.ui.show_message.assert_called_with("Message")
+        self.assertEquals(controller.ws_client, new_client)
+
+    def test_reconnect_gives_up_after_max_attempts(self):
+        new_client = MagicMock()
+        new_client.connect = MagicMock(side_effect = Exception("refused"))
+        self.ws_client.reconnect_delay = None
+        self.ws_client.reconnected = MagicMock(return_value = new_client)
+        self.ui.is_closed = MagicMock(return_value = False)
+
+        controller = UIController(self.ws_client, self.ui, ReconnectPolicy(base_delay=0.001, max_attempts=3))
+        self.assertEquals(controller.reconnect(), None)
+        self.assertEquals(new_client.connect.call_count, 3)
+
+    def test_first_line_logs_in_with_policy(self):
+        self.ws_client.username = None
+        UIController(self.ws_client, self.ui, ReconnectPolicy()).send_message("alice")
+
+        self.ws_client.login.assert_called_with("alice")
+
+
+class ReconnectingClientTest(TestCase):
+    def setUp(self):
+        self.client = ChatWebsocketClient("ws://127.0.0.1:9000", [])
+        self.client.send = MagicMock()
+
+    def _received(self):
+        return [self.client.messages.get_nowait().data for i in range(self.client.messages.qsize())]
+
+    def test_resume_cursor_confirmed_and_kept(self):
+        self.client.received_message(TextMessage("@bob >> hi\n" + make_resume("1.2.3")))
+
+        self.client.send.assert_called_once_with(make_resume("1.2.3"))
+        self.assertEquals(self.client.cursor, "1.2.3")
+        self.assertEquals(self._received(), ["@bob >> hi"])
+
+    def test_reconnect_delay_kept(self):
+        self.client.received_message(TextMessage(make_reconnect(2.5)))
+
+        self.assertEquals(self.client.reconnect_delay, 2.5)
+        self.assertEquals(self._received(), [])
+
+    def test_login_sends_cursor_and_replacement_resumes(self):
+        self.client.cursor = "42"
+        self.client.login("alice")
+        self.client.received_message(TextMessage("Authentication successful."))
+
+        self.client.send.assert_called_once_with("alice 42")
+        self.assertEquals(self.client.username, "alice")
+        replacement = self.client.reconnected()
+        self.assertEquals((replacement.username, replacement.cursor), ("alice", "42"))
+
+    def test_session_kept_and_used_to_login_again(self):
+        self.client.received_message(TextMessage("Authentication successful.\n" + make_session("abc:sig")))
+        self.assertEquals(self.client.session, "abc:sig")
+        self.assertEquals(self._received(), ["Authentication successful."])
+
+        replacement = self.client.reconnected()
+        replacement.send = MagicMock()
+        replacement.login("alice")
+        replacement.send.assert_called_once_with(make_session("abc:sig") + " 0")
+
+    def test_expired_session_falls_back_to_username(self):
+        self.client.session = "abc:sig"
+        self.client.login("alice")
+        self.client.received_message(TextMessage("Invalid session."))
+
+        self.assertEquals(self.client.send.call_args_list, [call(make_session("abc:sig") + " 0"), call("alice 0")])
+        self.assertEquals(self.client.session, None)
+
+    def test_backoff_honours_hint_then_grows_with_jitter(self):
+        policy = ReconnectPolicy(base_delay=1, max_delay=5)
+
+        self.assertEquals(policy.delay(0, 2.5), 2.5)
+        self.assertTrue(all(0 <= policy.delay(2) <= 4 for i in range(100)))
+        self.assertTrue(all(0 <= policy.delay(10) <= 5 for i in range(100)))
+
+
+class BatchingClientTest(TestCase):
+    def setUp(self):
+        kill_greenlets()
+        self.client = ChatWebsocketClient("ws://127.0.0.1:9000", [], batch_size=3, batch_delay=0.01)
+        self.client.send = MagicMock()
+
+    def test_batch_sent_when_full(self):
+        for i in range(4):
+            self.client.send_batched("@user %d" % i)
+
+        self.client.send.assert_called_once_with(make_batch(["@user 0", "@user 1", "@user 2"]))
+
+    def test_batch_sent_after_delay(self):
+        self.client.send_batched("@user first")
+        self.client.send_batched("@user second")
+        self.assertFalse(self.client.send.called)
+
+        gevent.sleep(0.05)
+        self.client.send.assert_called_once_with(make_batch(["@user first", "@user second"]))
 
-class MessageUtilsTest(TestCase):
+    def test_batch_sent_when_too_large(self):
+        self.client.batch_bytes = 10
+        self.client.send_batched("@user " + "x" * 10)
+        self.assertTrue(self.client.send.called)
+
+    def test_separator_rejected(self):
+        self.assertRaises(ValueError, self.client.send_batched, "@user a\x1eb")
+
+
+class LoadTesterStatsTest(TestCase):
+    def test_payload_padded_to_size(self):
+        stats = Stats("run")
+        self.assertEquals(len(stats.payload(64)), 64)
+        self.assertEquals(stats.sent, 1)
+
+    def test_latency_measured_from_payload(self):
+        stats = Stats("run")
+        payload = stats.payload(64)
+        stats.received_frame("\n".join([make_message("user_1", payload),
+                                        make_message("user_2", "message of another run")]))
+
+        self.assertEquals(stats.received, 1)
+        self.assertTrue(0 <= stats.latencies[0] < 1)
+
+    def test_percentile(self):
+        values = range(1000)
+        self.assertEquals(percentile(values, 0.5), 500)
+        self.assertEquals(percentile(values, 0.999), 999)
+        self.assertEquals(percentile([], 0.5), 0)
+
+
+class CodecTest(TestCase):
     def test_make_message_works_with_correct_args(self):
-        message = MessageUtils().make_message("username", "message text")
+        message = make_message("username", "message text")
         self.assertEquals(message, "@username >> message text")
 
     def test_make_message_raises_exception_no_username(self):
-        self.assertRaises(Exception, MessageUtils().make_message, "", "message text")
-        self.assertRaises(Exception, MessageUtils().make_message, None, "message text")
+        self.assertRaises(Exception, make_message, "", "message text")
+        self.assertRaises(Exception, make_message, None, "message text")
 
     def test_make_message_raises_exception_no_message(self):
-        self.assertRaises(Exception, MessageUtils().make_message, "username", "")
-        self.assertRaises(Exception, MessageUtils().make_message, "username", None)
+        self.assertRaises(Exception, make_message, "username", "")
+        self.assertRaises(Exception, make_message, "username", None)
 
     def test_parse_message_works_with_correct_message(self):
         message = "@someuser It's a beautiful day."
-        username, message_text = MessageUtils().parse_message(message)
+        username, message_text = parse_message(message)
         self.assertEquals(username, "someuser")
         self.assertEquals(message_text, "It's a beautiful day.")
 
     def test_parse_message_raises_exception_no_message(self):
         message = "@someuser \t "
-        self.assertRaises(Exception, MessageUtils().parse_message, message)
+        self.assertRaises(Exception, parse_message, message)
 
     def test_parse_message_raises_exception_no_user(self):
         message = "someuser some message"
-        self.assertRaises(Exception, MessageUtils().parse_message, message)
+        self.assertRaises(Exception, parse_message, message)
+
+    def test_parse_message_reads_ws4py_message_payload(self):
+        message = TextMessage("@someuser It's a beautiful day.")
+        self.assertEquals(parse_message(message), ("someuser", "It's a beautiful day."))
+
+    def test_parse_message_keeps_room_prefix(self):
+        self.assertEquals(parse_message("#room hello all"), ("#room", "hello all"))
+        self.assertRaises(Exception, parse_message, "# hello all")
+
+    def test_make_room_message(self):
+        self.assertEquals(make_room_message("#room", "username", "hello"), "#room @username >> hello")
+
+    def test_batch_round_trip(self):
+        messages = ["@user first", "#room second"]
+        self.assertEquals(parse_batch(make_batch(messages)), messages)
+        self.assertEquals(parse_batch(TextMessage(make_batch(messages))), messages)
+
+    def test_parse_delivery(self):
+        self.assertEquals(parse_delivery(make_message("user", "a >> b")), (None, "user", "a >> b"))
+        self.assertEquals(parse_delivery(make_room_message("#room", "user", "hi")), ("#room", "user", "hi"))
+        self.assertRaises(Exception, parse_delivery, "Joined #room.")
+
+    def test_count_messages(self):
+        self.assertEquals(count_messages("@user a\x1eb"), 1)
+        self.assertEquals(count_messages(TextMessage(make_batch(["@user a", "@user b", "#room c"]))), 3)
+
+    def test_make_history_message(self):
+        self.assertEquals(make_history_message(42, "user", "text"), "42 @user >> text")
+
+    def test_parse_command(self):
+        self.assertEquals(parse_command("/join #room"), ("join", ["#room"]))
+        self.assertRaises(Exception, parse_command, "/ #room")
 
 
 class ChatMessageControllerTest(TestCase):
     def setUp(self):
         kill_greenlets()
+        server.redis_adapter = server.RedisAdapter()
+        server.message_writer = MessageWriter()
         self.from_user = UserModel.objects.create(username = "from_user")
         self.to_user = UserModel.objects.create(username = "to_user")
 
@@ -106,12 +316,15 @@ class ChatMessageControllerTest(TestCase):
         controller = ChatMessageController()
 
         controller.process_message("@to_user some message", ws)
+        wait_for_listener()
+        server.message_writer.flush()
 
-        ws1.send.assert_called_with(MessageUtils().make_message("from_user", "some message"))
-        ws2.send.assert_called_with(MessageUtils().make_message("from_user", "some message"))
+        seq = MessageModel.objects.get().seq
+        ws1.deliver.assert_called_with([make_message("from_user", "some message")], ((None, seq),))
+        ws2.deliver.assert_called_with([make_message("from_user", "some message")], ((None, seq),))
 
 
-    def test_send_message_saves_message_when_user_in_pool(self):
+    def test_send_message_saved_undelivered_until_confirmed(self):
         controller = ChatMessageController()
 
         ws = MagicMock()
@@ -121,9 +334,26 @@ class ChatMessageControllerTest(TestCase):
         server.redis_adapter.add_connection("to_user", MagicMock())
 
         controller.process_message("@to_user some message", ws)
+        server.message_writer.flush()
 
         self.assertEquals(MessageModel.objects.count(), 1)
+        self.assertFalse(MessageModel.objects.get().delivered)
+
+        server.message_writer.confirm(self.to_user, MessageModel.objects.get().seq)
+        server.message_writer.flush()
+        self.assertTrue(MessageModel.objects.get().delivered)
+
+    def test_confirmation_before_message_saved_retried(self):
+        writer = MessageWriter(flush_interval=0, retry_delay=0.01)
+        msg = Message(self.from_user, "late", to_user=self.to_user)
+        # saved by another server after the recipient has confirmed it
+        writer.confirm(self.to_user, msg.seq)
+        gevent.sleep(0.02)
+        DjangoStore().save([msg])
+        gevent.sleep(0.05)
+
         self.assertTrue(MessageModel.objects.get().delivered)
+        self.assertEquals(writer._unmatched, [])
 
     def test_send_message_saves_message_when_user_in_database(self):
         controller = ChatMessageController()
@@ -132,6 +362,7 @@ class ChatMessageControllerTest(TestCase):
         ws.user = self.from_user
 
         controller.process_message("@to_user some message", ws)
+        server.message_writer.flush()
         self.assertEquals(MessageModel.objects.count(), 1)
 
 
@@ -151,11 +382,29 @@ class ChatMessageControllerTest(TestCase):
         self.assertEquals(MessageModel.objects.count(), 0)
         ws.send.assert_called_with("Message could not be parsed.")
 
+    def test_batch_messages_processed_and_errors_reported_together(self):
+        ws = MagicMock()
+        ws.user = self.from_user
+        to_ws = MagicMock()
+        server.redis_adapter.add_connection("to_user", to_ws)
+
+        batch = make_batch(["@to_user first", "bad message", "@to_user second", "@wrong_user third"])
+        ChatMessageController().process_message(TextMessage(batch), ws)
+        server.message_writer.flush()
+        wait_for_listener()
+
+        ws.send.assert_called_once_with("1: Message could not be parsed.\n"
+                                        "3: UserModel matching query does not exist.")
+        self.assertEquals([c[0][0] for c in to_ws.deliver.call_args_list],
+                          [[make_message("from_user", "first")], [make_message("from_user", "second")]])
+        self.assertEquals(MessageModel.objects.count(), 2)
+
 
 class ChatWebSocketServerTest(TestCase):
     def setUp(self):
         kill_greenlets()
         server.redis_adapter = server.RedisAdapter()
+        server.message_writer = MessageWriter()
 
     def test_user_created_when_first_auth(self):
         ws = ChatWebSocketServer(MagicMock())
@@ -170,6 +419,20 @@ class ChatWebSocketServerTest(TestCase):
 
         self.assertEquals(UserModel.objects.count(), 0)
 
+    def test_sockets_share_controllers_and_keep_lean_state(self):
+        ws1 = ChatWebSocketServer(MagicMock())
+        ws2 = ChatWebSocketServer(MagicMock())
+        self.assertIs(ws1.controller, ws2.controller)
+
+        ws1.received_message("first_user")
+        ws2.received_message("second_user")
+        self.assertIs(ws1.controller, server.chat_controller)
+        self.assertIs(ws1.controller, ws2.controller)
+        self.assertIsInstance(ws1.user, UserRecord)
+        self.assertEquals(ws1.user.id, UserModel.objects.get(username = "first_user").id)
+        for name in ChatWebSocketServer.__slots__:
+            self.assertNotIn(name, ws1.__dict__)
+
 
     def test_user_receives_message(self):
         #auth from_user
@@ -180,23 +443,25 @@ class ChatWebSocketServerTest(TestCase):
         ws2 = ChatWebSocketServer(MagicMock())
         ws2.opened()
         ws2.send = MagicMock()
+        ws2.outbox.write = MagicMock()
         ws2.received_message("to_user")
 
         #from_user socket received message for to_user
         ws1.received_message("@to_user secret message")
+        wait_for_listener()
+        gevent.sleep(0)
+        server.message_writer.flush()
 
         #message has been saved
         self.assertEquals(MessageModel.objects.count(), 1)
         self.assertEquals(MessageModel.objects.get().message_text, "secret message")
 
-        #message has been saved as delivered
+        #message has been saved as delivered once written to to_user
         self.assertTrue(MessageModel.objects.get().delivered)
 
-        #and indeed the send function for to_user has been called
-        calls = [call("Authentication successful.  Write a message like this: '@username your message' "),
-                 call(MessageUtils().make_message("from_user", "secret message"))]
-
-        ws2.send.assert_has_calls(calls)
+        #and indeed to_user has been authenticated and sent the message
+        ws2.send.assert_called_with("Authentication successful.  Write a message like this: '@username your message' ")
+        ws2.outbox.write.assert_called_with(make_message("from_user", "secret message"))
 
 
     def test_socket_closed_checks_for_un_authenticated_user(self):
@@ -206,6 +471,14 @@ class ChatWebSocketServerTest(TestCase):
         ws1.closed(1000)
 
 
+    def test_socket_closed_during_authentication_removed(self):
+        ws = ChatWebSocketServer(MagicMock())
+        ws.send = MagicMock(side_effect=Exception("Broken pipe"))
+        self.assertRaises(Exception, ws.received_message, "to_user")
+        ws.closed(1000)
+
+        self.assertFalse("to_user" in server.redis_adapter.subscriptions)
+
     def test_user_can_diconnect_and_connect_again(self):
         ws = ChatWebSocketServer(MagicMock())
         ws.received_message("to_user")
@@ -215,6 +488,42 @@ class ChatWebSocketServerTest(TestCase):
         ws.received_message("to_user")
 
 
+    def test_stalled_socket_does_not_block_other_sockets(self):
+        stalled = ChatWebSocketServer(MagicMock())
+        stalled.sock.sendall = MagicMock(side_effect=lambda data: gevent.sleep(10))
+        stalled.received_message("to_user")
+        other = ChatWebSocketServer(MagicMock())
+        other.received_message("to_user")
+        gevent.sleep(0)
+        other.sock.sendall.reset_mock()
+
+        server.redis_adapter.send_message_to_channel("to_user", make_message("from_user", "hello"), 1)
+        wait_for_listener()
+
+        self.assertEquals(other.sock.sendall.call_count, 1)
+        self.assertEquals(stalled.outbox.qsize(), 1)
+
+    @override_settings(CHAT_OUTBOX_SIZE=1, CHAT_OUTBOX_WHEN_FULL="offline")
+    def test_messages_left_undelivered_when_outbox_full(self):
+        sender = MagicMock()
+        sender.user = UserModel.objects.create(username = "from_user")
+        ws = ChatWebSocketServer(MagicMock())
+        ws.sock.sendall = MagicMock(side_effect=lambda data: gevent.sleep(10))
+        ws.received_message("to_user")
+        gevent.sleep(0)
+
+        ChatMessageController().process_message("@to_user first", sender)
+        ChatMessageController().process_message("@to_user second", sender)
+        wait_for_listener()
+        ws.deliver([make_room_message("#room", "from_user", "third")], (("#room", 1),))
+        server.message_writer.flush()
+
+        # neither written, so both replayed at the next login, and neither saved twice
+        self.assertEquals(ws.outbox.qsize(), 1)
+        self.assertEquals(list(MessageModel.objects.order_by("seq").values_list("message_text", "delivered")),
+                          [("first", False), ("second", False)])
+        self.assertEquals(ws.room_reads, None)
+
     def _test_user_receives_offline_messages_when_connecting(self):
         ws1 = ChatWebSocketServer(MagicMock())
         ws1.received_message("from_user")
@@ -228,6 +537,7 @@ class ChatWebSocketServerTest(TestCase):
         #to_user receives a message while offline
         ws1.received_message("@to_user first message")
         ws1.received_message("@to_user second message")
+        server.message_writer.flush()
 
         #message has been set to not delivered in DB
         offline_messages = MessageModel.objects.filter()
@@ -236,7 +546,7 @@ class ChatWebSocketServerTest(TestCase):
 
         #connecting to_user again
         ws2 = ChatWebSocketServer(MagicMock())
-        ws2.send = MagicMock()
+        ws2.send_lines = MagicMock()
         ws2.received_message("to_user")
 
         #message has been set to delivered in DB
@@ -247,9 +557,1025 @@ class ChatWebSocketServerTest(TestCase):
 
         #and has been actually delivered
 
-        calls = [call(MessageUtils().make_message("from_user", "first message")),
-                 call(MessageUtils().make_message("from_user", "second message"))]
-        ws2.send.assert_has_calls(calls, any_order=True)
+        self.assertIn([make_message("from_user", "first message"), make_message("from_user", "second message")],
+                      sent_lines(ws2))
+
+
+class OfflineMessagesTest(TestCase):
+    def setUp(self):
+        self.from_user = UserModel.objects.create(username = "from_user")
+        self.to_user = UserModel.objects.create(username = "to_user")
+        self.ws = MagicMock()
+        self.ws.user = self.to_user
+
+    def _queue_messages(self, count):
+        MessageModel.objects.bulk_create([
+            MessageModel(from_user=self.from_user, to_user=self.to_user, message_text="message %d" % i)
+            for i in range(count)])
+
+    def test_offline_messages_sent_in_one_frame_and_delivered(self):
+        self._queue_messages(3)
+        AuthenticateMessageController()._send_offline_messages(self.ws)
+
+        self.assertEquals(sent_lines(self.ws), [[make_message("from_user", "message %d" % i) for i in range(3)]])
+        self.assertEquals(MessageModel.objects.filter(delivered=False).count(), 0)
+
+    @override_settings(CHAT_OFFLINE_CHUNK_SIZE=2)
+    def test_offline_messages_sent_in_chunks_in_order(self):
+        self._queue_messages(5)
+        AuthenticateMessageController()._send_offline_messages(self.ws)
+
+        frames = sent_lines(self.ws)
+        self.assertEquals([len(lines) for lines in frames], [2, 2, 1])
+        self.assertEquals(sum(frames, []), [make_message("from_user", "message %d" % i) for i in range(5)])
+        self.assertEquals(MessageModel.objects.filter(delivered=False).count(), 0)
+
+    @override_settings(CHAT_OFFLINE_CHUNK_SIZE=2)
+    def test_query_count_grows_with_chunks_only(self):
+        for backlog in (3, 4, 11):
+            MessageModel.objects.all().delete()
+            self._queue_messages(backlog)
+            chunks = (backlog + 1) // 2
+
+            #one select and one update per chunk, and a full last chunk is followed by a select finding nothing
+            with self.assertNumQueries(2 * chunks + (backlog % 2 == 0)):
+                AuthenticateMessageController()._send_offline_messages(self.ws)
+            self.assertEquals(len(sent_lines(self.ws)), chunks)
+            self.ws.reset_mock()
+
+    def test_only_undelivered_messages_of_user_sent(self):
+        self._queue_messages(1)
+        MessageModel.objects.create(from_user=self.from_user, to_user=self.to_user,
+                                    message_text="old", delivered=True)
+        MessageModel.objects.create(from_user=self.to_user, to_user=self.from_user,
+                                    message_text="other")
+
+        AuthenticateMessageController()._send_offline_messages(self.ws)
+        self.assertEquals(sent_lines(self.ws), [[make_message("from_user", "message 0")]])
+        self.assertFalse(MessageModel.objects.get(message_text="other").delivered)
+
+
+class ResumeTest(TestCase):
+    def setUp(self):
+        kill_greenlets()
+        server.redis_adapter = server.RedisAdapter()
+        server.message_writer = MessageWriter()
+        self.from_user = UserModel.objects.create(username = "from_user")
+        self.to_user = UserModel.objects.create(username = "to_user")
+
+    def _queue_messages(self, texts):
+        MessageModel.objects.bulk_create([
+            MessageModel(from_user=self.from_user, to_user=self.to_user, message_text=text, seq=i + 1)
+            for i, text in enumerate(texts)])
+
+    @override_settings(CHAT_OFFLINE_CHUNK_SIZE=2)
+    def test_resumable_chunks_end_with_cursor_and_wait_for_confirmation(self):
+        self._queue_messages(["message %d" % i for i in range(3)])
+        ws = log_in("to_user 0")
+        lines = written_lines(ws)
+
+        self.assertEquals([line for line in lines if line[:1] == "@"],
+                          [make_message("from_user", "message %d" % i) for i in range(3)])
+        cursors = [line.split()[1] for line in lines if line.startswith("/resume ")]
+        self.assertEquals(len(cursors), 2)
+        self.assertEquals(MessageModel.objects.filter(delivered=False).count(), 3)
+
+        ws.received_message(make_resume(cursors[0]))
+        self.assertEquals(list(MessageModel.objects.filter(delivered=False).values_list("message_text", flat=True)),
+                          ["message 2"])
+
+    @override_settings(CHAT_OFFLINE_CHUNK_SIZE=2)
+    def test_login_with_cursor_resumes_after_confirmed_chunk(self):
+        self._queue_messages(["message %d" % i for i in range(3)])
+        chunks = list(DjangoStore().undelivered(self.to_user, 2, mark=False))
+
+        ws = log_in("to_user " + chunks[0].cursor)
+        lines = written_lines(ws)
+        self.assertEquals([line for line in lines if line[:1] == "@"], [make_message("from_user", "message 2")])
+
+    def test_message_saved_after_replay_not_confirmed(self):
+        self._queue_messages(["first"])
+        chunk = next(DjangoStore().undelivered(self.to_user, 10, mark=False))
+        # saved in the background by another server, with an older seq
+        MessageModel.objects.create(from_user=self.from_user, to_user=self.to_user, message_text="late", seq=0)
+
+        DjangoStore().confirm(self.to_user, chunk.cursor)
+        self.assertEquals(list(MessageModel.objects.filter(delivered=False).values_list("message_text", flat=True)),
+                          ["late"])
+
+    def test_unsaved_messages_replayed_without_waiting_for_the_writer(self):
+        server.message_writer = MessageWriter(flush_interval=60)
+        other = UserModel.objects.create(username = "other")
+        self._queue_messages(["saved"])
+        server.message_writer.put(Message(self.from_user, "unsaved", to_user=self.to_user))
+        server.message_writer.put(Message(self.from_user, "elsewhere", to_user=other))
+
+        with patch.object(server.message_writer, "flush") as flush:
+            ws = log_in("to_user 0")
+            lines = written_lines(ws)
+        self.assertFalse(flush.called)
+        self.assertEquals([line for line in lines if line[:1] == "@"],
+                          [make_message("from_user", "saved"), make_message("from_user", "unsaved")])
+
+        # confirmed once saved, like a live message
+        server.message_writer.flush()
+        self.assertEquals(list(MessageModel.objects.order_by("id").values_list("message_text", "delivered")),
+                          [("saved", False), ("unsaved", True), ("elsewhere", False)])
+
+    def test_invalid_cursor(self):
+        ws = log_in("to_user")
+        ws.send = MagicMock()
+        ws.received_message("/resume nonsense")
+
+        ws.send.assert_called_once_with("Invalid resume cursor.")
+
+
+class SessionTest(TestCase):
+    def setUp(self):
+        kill_greenlets()
+        server.redis_adapter = server.RedisAdapter()
+        server.message_writer = MessageWriter()
+        self.from_user = UserModel.objects.create(username = "from_user")
+        self.user = UserModel.objects.create(username = "session_user")
+
+    def _token(self):
+        lines = written_lines(log_in("session_user"))
+        return next(line.split()[1] for line in lines if line.startswith("/session "))
+
+    def test_session_login_skips_user_lookup(self):
+        token = self._token()
+        MessageModel.objects.create(from_user=self.from_user, to_user=self.user, message_text="hello", seq=1)
+        # another server, which has cached neither the session nor the user
+        server.redis_adapter = server.RedisAdapter()
+
+        with patch.object(UserModel.objects, "get_or_create") as get_or_create, \
+                patch.object(UserModel.objects, "get") as get:
+            ws = log_in(make_session(token) + " 0")
+            lines = written_lines(ws)
+        self.assertFalse(get_or_create.called or get.called)
+
+        self.assertEquals((ws.user.id, ws.user.username), (self.user.id, "session_user"))
+        self.assertEquals(server.redis_adapter.subscriptions["session_user"], [ws])
+        self.assertEquals(lines[0], make_message("from_user", "hello"))
+        self.assertTrue(lines[1].startswith("/resume "))
+        self.assertFalse(any(line.startswith("/session ") for line in lines))
+
+    def test_session_cached_until_it_expires(self):
+        token = self._token()
+        server.redis_adapter.redis.delete(SESSION_KEY % token.split(":")[0])
+
+        ws = log_in(make_session(token))
+        self.assertEquals(ws.user.username, "session_user")
+
+        server.redis_adapter = server.RedisAdapter()
+        ws = log_in(make_session(token))
+        lines = written_lines(ws)
+        self.assertEquals(ws.user, None)
+        self.assertTrue("Invalid session." in lines)
+
+    def test_session_login_answered_while_redis_is_down(self):
+        token = self._token()
+        server.redis_adapter = server.RedisAdapter()
+
+        with patch.object(server.redis_adapter.sessions, "resume", side_effect=redis_exceptions.ConnectionError()):
+            ws = log_in(make_session(token))
+            lines = written_lines(ws)
+        self.assertEquals(ws.user, None)
+        self.assertTrue("Chat server unavailable, try again later." in lines)
+
+    def test_forged_token_rejected_without_lookup(self):
+        token = self._token()
+        session_id, signature = token.split(":")
+
+        with patch.object(server.redis_adapter.sessions, "shards") as shards:
+            ws = log_in(make_session(session_id + ":" + signature[::-1]))
+            lines = written_lines(ws)
+        self.assertFalse(shards.get.called)
+        self.assertEquals(ws.user, None)
+        self.assertTrue("Invalid session." in lines)
+
+
+class MessageOrderTest(TestCase):
+    def setUp(self):
+        server.message_writer = MessageWriter()
+        self.from_user = UserModel.objects.create(username = "from_user")
+        self.to_user = UserModel.objects.create(username = "to_user")
+        self.ws = MagicMock()
+        self.ws.user = self.to_user
+
+    def test_seq_strictly_increasing(self):
+        seqs = [Message(self.from_user, "text").seq for i in range(1000)]
+        self.assertEquals(seqs, sorted(set(seqs)))
+
+    @patch("storage.time.time", return_value=100.0)
+    @patch("storage._last_time", 0)
+    def test_messages_of_two_nodes_confirmed_apart(self, now):
+        other = UserModel.objects.create(username = "other")
+        messages = []
+        for node_id, from_user in ((1, self.from_user), (2, other)):
+            set_node_id(node_id)
+            messages.append(Message(from_user, "at the same time", to_user=self.to_user))
+            storage._last_time = 0
+        set_node_id(0)
+        DjangoStore().save(messages)
+
+        self.assertNotEquals(messages[0].seq, messages[1].seq)
+        DjangoStore().mark_delivered([Delivery(self.to_user, messages[0].seq, 0)])
+        self.assertEquals(list(MessageModel.objects.order_by("from_user").values_list("delivered", flat=True)),
+                          [True, False])
+
+    def test_messages_replayed_in_seq_order(self):
+        messages = [Message(self.from_user, text, to_user=self.to_user) for text in ("first", "second", "third")]
+        DjangoStore().save(list(reversed(messages)))
+
+        AuthenticateMessageController()._send_offline_messages(self.ws)
+        self.assertEquals(sent_lines(self.ws), [[make_message("from_user", text)
+                                                 for text in ("first", "second", "third")]])
+
+    def test_backlog_chunks_continue_after_equal_seqs(self):
+        MessageModel.objects.bulk_create([
+            MessageModel(from_user=self.from_user, to_user=self.to_user, message_text=str(i), seq=i // 3)
+            for i in range(7)])
+
+        chunks = list(DjangoStore().undelivered(self.to_user, 2))
+        self.assertEquals([text for chunk in chunks for _, _, text in chunk], [str(i) for i in range(7)])
+
+    def test_backlog_read_from_index(self):
+        undelivered = MessageModel.objects.filter(to_user = self.to_user, delivered = False).order_by("seq", "id")
+        sql, params = undelivered.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        plan = " ".join(row[-1] for row in cursor.fetchall())
+
+        self.assertTrue("USING INDEX" in plan, plan)
+        self.assertFalse("TEMP B-TREE" in plan, plan)
+
+    def test_old_schema_upgraded(self):
+        cursor = connection.cursor()
+        cursor.execute('DROP TABLE "orm_messagemodel"')
+        cursor.execute('CREATE TABLE "orm_messagemodel" ("id" integer NOT NULL PRIMARY KEY, '
+                       '"from_user_id" integer NOT NULL REFERENCES "orm_usermodel" ("id"), '
+                       '"to_user_id" integer NOT NULL REFERENCES "orm_usermodel" ("id"), '
+                       '"message_text" text NOT NULL, "delivered" bool NOT NULL)')
+        for text in ("old 1", "old 2"):
+            cursor.execute('INSERT INTO "orm_messagemodel" ("from_user_id", "to_user_id", "message_text", "delivered") '
+                           'VALUES (%s, %s, %s, 0)', [self.from_user.id, self.to_user.id, text])
+
+        call_command("upgrade_chat_schema", stdout=StringIO())
+        call_command("upgrade_chat_schema", stdout=StringIO())
+        DjangoStore().save([Message(self.from_user, "new", to_user=self.to_user),
+                            Message(self.from_user, "room", room="#room", delivered=True, room_seq=1)])
+
+        self.assertEquals([(m.message_text, m.seq) for m in MessageModel.objects.order_by("seq")[:2]],
+                          [("old 1", 1), ("old 2", 2)])
+        AuthenticateMessageController()._send_offline_messages(self.ws)
+        self.assertEquals(sent_lines(self.ws), [[make_message("from_user", "old 1"), make_message("from_user", "old 2"),
+                                                 make_message("from_user", "new")]])
+        self.assertEquals(list(DjangoStore().room_backlog("#room", 0, 10)), [[(1, "from_user", "room")]])
+
+
+class HistoryTest(TestCase):
+    def setUp(self):
+        kill_greenlets()
+        server.redis_adapter = server.RedisAdapter()
+        server.message_writer = MessageWriter()
+        self.user = UserModel.objects.create(username = "user")
+        self.other = UserModel.objects.create(username = "other")
+        self.third = UserModel.objects.create(username = "third")
+        self.ws = MagicMock()
+        self.ws.user = self.user
+
+    def _save(self, count):
+        messages = []
+        for i in range(count):
+            from_user, to_user = (self.user, self.other) if i % 2 else (self.other, self.user)
+            messages.append(Message(from_user, "message %d" % i, to_user = to_user))
+        DjangoStore().save(messages + [Message(self.user, "elsewhere", to_user = self.third),
+                                       Message(self.user, "room", room = "#room")])
+        return [(msg.seq, msg.from_user.username, msg.message_text) for msg in messages]
+
+    def _history(self, command):
+        self.ws.reset_mock()
+        ChatMessageController().process_message(command, self.ws)
+        return self.ws.send.call_args[0][0].split("\n")
+
+    @override_settings(CHAT_HISTORY_PAGE_SIZE=2)
+    def test_pages_walk_back_through_the_conversation(self):
+        messages = self._save(5)
+
+        lines = self._history("/history @other")
+        self.assertEquals(lines, ["History with @other:"] + [make_history_message(*m) for m in messages[3:]] +
+                          ["More: /history @other %d 2" % messages[3][0]])
+        lines = self._history(lines[-1][len("More: "):])
+        self.assertEquals(lines[1:3], [make_history_message(*m) for m in messages[1:3]])
+        lines = self._history(lines[-1][len("More: "):])
+        self.assertEquals(lines, ["History with @other:", make_history_message(*messages[0])])
+
+    def test_default_page_is_the_latest_messages(self):
+        messages = self._save(3)
+        self.assertEquals(self._history("/history @other")[1:], [make_history_message(*m) for m in messages])
+
+    def test_queued_messages_included(self):
+        ChatMessageController().process_message("@other not saved yet", self.ws)
+        self.assertTrue(self._history("/history @other")[-1].endswith(make_message("user", "not saved yet")))
+
+    def test_page_cost_does_not_grow_with_depth(self):
+        messages = self._save(20)
+        with self.assertNumQueries(2):
+            DjangoStore().history(self.user, self.other, messages[2][0], 2)
+        with self.assertNumQueries(2):
+            DjangoStore().history(self.user, self.other, None, 2)
+
+    @override_settings(CHAT_HISTORY_PAGE_SIZE=5, CHAT_HISTORY_MAX_PAGE_SIZE=10)
+    def test_bad_arguments_rejected(self):
+        for command in ("/history", "/history other", "/history @other x", "/history @other 1 0",
+                        "/history @other 1 11", "/history @other 1 2 3"):
+            self.assertEquals(self._history(command), ["Usage: /history @user [before-seq] [limit]"])
+        self.assertEquals(self._history("/history @nobody"), ["UserModel matching query does not exist."])
+
+
+class MessageWriterTest(TestCase):
+    def setUp(self):
+        kill_greenlets()
+        self.from_user = UserModel.objects.create(username = "from_user")
+        self.to_user = UserModel.objects.create(username = "to_user")
+
+    def _message(self, text):
+        return Message(from_user=self.from_user, to_user=self.to_user, message_text=text)
+
+    def test_messages_saved_by_worker(self):
+        writer = MessageWriter(flush_interval=0.01)
+        writer.put(self._message("first"))
+        writer.put(self._message("second"))
+        self.assertEquals(MessageModel.objects.count(), 0)
+
+        gevent.sleep(0.05)
+        self.assertEquals(MessageModel.objects.count(), 2)
+
+    def test_worker_writes_in_batches(self):
+        writer = MessageWriter(batch_size=2, flush_interval=0.01)
+        with patch.object(MessageModel.objects, "bulk_create") as bulk_create:
+            for i in range(5):
+                writer.put(self._message(str(i)))
+            gevent.sleep(0.05)
+
+        self.assertEquals([len(c[0][0]) for c in bulk_create.call_args_list], [2, 2, 1])
+
+    def test_stop_saves_queued_messages(self):
+        writer = MessageWriter(flush_interval=10)
+        writer.put(self._message("first"))
+        writer.stop()
+
+        self.assertEquals(MessageModel.objects.get().message_text, "first")
+
+    def test_full_queue_flushed_by_sender(self):
+        writer = MessageWriter(max_size=2, when_full=MessageWriter.FLUSH)
+        for i in range(3):
+            writer.put(self._message(str(i)))
+
+        self.assertEquals(MessageModel.objects.count(), 2)
+        self.assertEquals(writer.queue.qsize(), 1)
+
+    def test_full_queue_blocks_sender(self):
+        writer = MessageWriter(max_size=1, when_full=MessageWriter.BLOCK)
+        writer._start_worker = MagicMock()
+        writer.put(self._message("first"))
+
+        sender = gevent.spawn(writer.put, self._message("second"))
+        gevent.sleep(0.01)
+        self.assertFalse(sender.ready())
+
+        writer.flush()
+        sender.join(1)
+        self.assertTrue(sender.ready())
+        self.assertEquals(MessageModel.objects.count(), 1)
+
+    def test_unknown_when_full_policy(self):
+        self.assertRaises(ValueError, MessageWriter, when_full="drop")
+
+    def test_zero_flush_interval_kept(self):
+        self.assertEquals(MessageWriter(flush_interval=0).flush_interval, 0)
+
+    def test_failed_batch_retried(self):
+        store = MagicMock()
+        store.save.side_effect = [Exception("database is down"), None]
+        writer = MessageWriter(flush_interval=0, store=store, retry_delay=0.01)
+        messages = [self._message("first"), self._message("second")]
+        for msg in messages:
+            writer.put(msg)
+        gevent.sleep(0.05)
+
+        self.assertEquals(store.save.call_args_list, [call(messages), call(messages)])
+        self.assertEquals(writer._batch, [])
+
+    def test_rejected_message_dropped_at_max_delay(self):
+        def save(batch):
+            if "rejected" in [msg.message_text for msg in batch]:
+                raise Exception("rejected")
+            saved.extend(batch)
+
+        saved = []
+        store = MagicMock(save=MagicMock(side_effect=save))
+        writer = MessageWriter(flush_interval=0, store=store, retry_delay=0.01, retry_max_delay=0.02)
+        messages = [self._message("first"), self._message("rejected"), self._message("second")]
+        for msg in messages:
+            writer.put(msg)
+        gevent.sleep(0.1)
+
+        self.assertEquals(saved, [messages[0], messages[2]])
+        self.assertEquals(writer._batch, [])
+
+    def test_stop_retries_then_gives_up(self):
+        store = MagicMock()
+        store.save.side_effect = Exception("database is down")
+        writer = MessageWriter(flush_interval=10, store=store, retry_delay=0.01, retry_max_delay=0.04)
+        writer.put(self._message("first"))
+        writer.stop()
+
+        self.assertEquals(store.save.call_count, 4)
+        self.assertEquals(writer._batch, [])
+        self.assertTrue(writer.worker is None)
+
+    def test_flush_waits_for_batch_being_saved(self):
+        def save(batch):
+            if batch[0].message_text == "first":
+                gevent.sleep(0.02)
+            saved.extend(batch)
+
+        saved = []
+        writer = MessageWriter(flush_interval=0, store=MagicMock(save=MagicMock(side_effect=save)))
+        writer.put(self._message("first"))
+        gevent.sleep(0.01)
+        writer.put(self._message("second"))
+        writer.flush()
+
+        self.assertEquals([msg.message_text for msg in saved], ["first", "second"])
+
+    def test_stop_waits_for_batch_being_saved(self):
+        def save(batch):
+            gevent.sleep(0.02)
+            saved.extend(batch)
+
+        saved = []
+        writer = MessageWriter(flush_interval=0, store=MagicMock(save=MagicMock(side_effect=save)))
+        writer.put(self._message("first"))
+        gevent.sleep(0.01)
+        writer.stop()
+
+        self.assertEquals([msg.message_text for msg in saved], ["first"])
+
+    def test_batch_saved_atomically(self):
+        bulk_create = MessageModel.objects.bulk_create
+
+        def fail(models):
+            bulk_create(models[:1])
+            raise Exception("failed")
+
+        with patch.object(MessageModel.objects, "bulk_create", side_effect=fail):
+            self.assertRaises(Exception, DjangoStore().save, [self._message("first"), self._message("second")])
+
+        self.assertEquals(MessageModel.objects.count(), 0)
+
+    @override_settings(CHAT_STORAGE_BACKEND="logstore.LogStore")
+    def test_store_chosen_by_settings(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with self.settings(CHAT_LOG_DIRECTORY=directory):
+                self.assertTrue(isinstance(MessageWriter().store, LogStore))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_database_store_by_default(self):
+        self.assertTrue(isinstance(get_store(), DjangoStore))
+
+
+class LogStoreTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.from_user = UserModel(username = "from_user")
+        self.to_user = UserModel(username = "to_user")
+        self.other_user = UserModel(username = "other_user")
+        self.store = LogStore(self.directory, segment_size=200)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def _reopen(self):
+        self.store.close()
+        self.store = LogStore(self.directory, segment_size=200)
+
+    def _backlog(self, user, chunk_size=100):
+        return [message for chunk in self.store.undelivered(user, chunk_size) for message in chunk]
+
+    def test_undelivered_messages_replayed_in_order(self):
+        self.store.save([Message(self.from_user, "message %d" % i, to_user=self.to_user) for i in range(3)] +
+                        [Message(self.from_user, "delivered", to_user=self.to_user, delivered=True)])
+
+        self.assertEquals(self._backlog(self.to_user),
+                          [(None, "from_user", "message %d" % i) for i in range(3)])
+        self.assertEquals(self._backlog(self.to_user), [])
+
+    def test_room_messages_read_after_room_seq(self):
+        # saved out of order by two servers
+        self.store.save([Message(self.from_user, "message %d" % i, room="#room", delivered=True, room_seq=i)
+                         for i in (1, 3, 2)])
+        self.store.save([Message(self.from_user, "message 4", room="#room", delivered=True, room_seq=4)])
+
+        expected = [[(2, "from_user", "message 2"), (3, "from_user", "message 3")], [(4, "from_user", "message 4")]]
+        self.assertEquals(list(self.store.room_backlog("#room", 1, 2)), expected)
+        self._reopen()
+        self.assertEquals(list(self.store.room_backlog("#room", 1, 2)), expected)
+        self.assertEquals(list(self.store.room_backlog("#other", 0, 2)), [])
+        self.assertEquals(self._backlog(self.to_user), [])
+
+    def test_segments_rolled_and_read_through_maps(self):
+        self.store.save([Message(self.from_user, "x" * 50 + str(i), to_user=self.to_user) for i in range(10)])
+
+        self.assertTrue(len(os.listdir(self.directory)) > 3)
+        self.assertEquals([text for _, _, text in self._backlog(self.to_user)],
+                          ["x" * 50 + str(i) for i in range(10)])
+
+    def test_index_rebuilt_and_delivery_kept_after_reopen(self):
+        self.store.save([Message(self.from_user, "message %d" % i, to_user=self.to_user) for i in range(5)])
+        chunks = self.store.undelivered(self.to_user, 2)
+        self.assertEquals(len(next(chunks)), 2)
+        next(chunks)
+
+        self._reopen()
+        self.assertEquals([text for _, _, text in self._backlog(self.to_user)], ["message 2", "message 3", "message 4"])
+
+        self._reopen()
+        self.assertEquals(self._backlog(self.to_user), [])
+
+    def test_live_messages_confirmed_one_by_one(self):
+        messages = [Message(self.from_user, "message %d" % i, to_user=self.to_user) for i in range(4)]
+        self.store.save(messages)
+
+        self.assertEquals(self.store.mark_delivered([Delivery(self.to_user, messages[2].seq, 0),
+                                                     Delivery(self.to_user, messages[2].seq, 0)]), [])
+        self._reopen()
+        self.store.mark_delivered([Delivery(self.to_user, messages[0].seq, 0)])
+        self._reopen()
+        self.assertEquals([text for _, _, text in self._backlog(self.to_user)], ["message 1", "message 3"])
+        self.assertEquals(self.store.confirmed, {})
+
+        self._reopen()
+        self.assertEquals(self._backlog(self.to_user), [])
+
+    def test_chunk_not_delivered_when_sending_fails(self):
+        self.store.save([Message(self.from_user, "message", to_user=self.to_user)])
+        for chunk in self.store.undelivered(self.to_user, 10):
+            break
+
+        self.assertEquals(len(self._backlog(self.to_user)), 1)
+
+    def test_history_paged_by_seq_after_reopen(self):
+        users = [(self.from_user, self.to_user), (self.to_user, self.from_user)]
+        messages = [Message(users[i % 2][0], "message %d" % i, to_user=users[i % 2][1]) for i in range(5)]
+        self.store.save(messages + [Message(self.from_user, "other", to_user=self.other_user)])
+        self._reopen()
+
+        expected = [(msg.seq, msg.from_user.username, msg.message_text) for msg in messages]
+        self.assertEquals(self.store.history(self.to_user, self.from_user, None, 2), expected[3:])
+        self.assertEquals(self.store.history(self.from_user, self.to_user, expected[3][0], 10), expected[:3])
+
+    def test_cut_record_truncated_on_open(self):
+        self.store.save([Message(self.from_user, "complete", to_user=self.to_user)])
+        self.store.active.write("\x00\x00\x00\x09partial")
+        self._reopen()
+        self.store.save([Message(self.from_user, "next", to_user=self.to_user)])
+
+        self.assertEquals([text for _, _, text in self._backlog(self.to_user)], ["complete", "next"])
+
+    def test_resumable_chunks_confirmed_after_reopen(self):
+        self.store.save([Message(self.from_user, "message %d" % i, to_user=self.to_user) for i in range(5)])
+        chunks = list(self.store.undelivered(self.to_user, 2, mark=False))
+        self.assertEquals([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.store.confirm(self.to_user, "0")
+        self.assertEquals(len(next(self.store.undelivered(self.to_user, 10, mark=False))), 5)
+
+        self._reopen()
+        self.store.confirm(self.to_user, chunks[1].cursor)
+        self._reopen()
+        self.assertEquals([text for _, _, text in self._backlog(self.to_user)], ["message 4"])
+
+    def test_long_names_rejected_before_writing(self):
+        long_user = UserModel(username = "u" * 256)
+        self.assertRaises(ValueError, self.store.save, [Message(self.from_user, "first", to_user=self.to_user),
+                                                        Message(long_user, "second", to_user=self.to_user)])
+
+        self.assertEquals(self._backlog(self.to_user), [])
+        self.assertEquals(self.store.segments[-1].size, 0)
+
+    def test_delivered_segments_deleted_past_max_size(self):
+        self.store.close()
+        self.store = LogStore(self.directory, segment_size=200, max_size=400)
+        self.store.save([Message(self.from_user, "x" * 50 + str(i), to_user=self.to_user) for i in range(20)])
+        self._backlog(self.to_user)
+        self.store.save([Message(self.from_user, "last", to_user=self.to_user)])
+
+        self.assertTrue(len(self.store.segments) <= 3)
+        self.assertEquals(len(os.listdir(self.directory)), len(self.store.segments) + 1)
+        history = self.store.history(self.to_user, self.from_user, None, 100)
+        self.assertTrue(0 < len(history) < 21)
+        self.assertEquals(history[-1][2], "last")
+
+    def test_segments_with_undelivered_messages_kept(self):
+        self.store.close()
+        self.store = LogStore(self.directory, segment_size=200, max_size=400)
+        self.store.save([Message(self.from_user, "x" * 50 + str(i), to_user=self.to_user) for i in range(20)])
+
+        self.assertEquals(len(self._backlog(self.to_user)), 20)
+
+    def test_delivery_marks_rewritten_on_open(self):
+        self.store.save([Message(self.from_user, "message %d" % i, to_user=self.to_user) for i in range(3)])
+        for chunk in self.store.undelivered(self.to_user, 1):
+            pass
+        self._reopen()
+
+        with open(os.path.join(self.directory, "delivered.log")) as delivered_log:
+            self.assertEquals(len(delivered_log.readlines()), 1)
+        self.assertEquals(self._backlog(self.to_user), [])
+
+    def test_offline_messages_sent_from_log(self):
+        to_user = UserModel.objects.create(username = "to_user")
+        server.message_writer = MessageWriter(store=self.store)
+        self.store.save([Message(self.from_user, "message %d" % i, to_user=to_user) for i in range(3)])
+        ws = MagicMock()
+        ws.user = to_user
+
+        with self.assertNumQueries(0):
+            AuthenticateMessageController()._send_offline_messages(ws)
+        self.assertEquals(sent_lines(ws), [[make_message("from_user", "message %d" % i) for i in range(3)]])
+
+
+class DeflateTest(TestCase):
+    def _server_and_client(self, context_takeover=True, max_size=100000):
+        extension, server_deflate = negotiate(offer(context_takeover), 6, 10, True, max_size)
+        return server_deflate, accept(extension, 6, 10, max_size)
+
+    def _receive(self, stream, frames):
+        messages = []
+        for frame in frames:
+            stream.parser.send(frame)
+            if stream.has_message:
+                messages.append(stream.message.data)
+                stream.message = None
+        return messages
+
+    def test_negotiation(self):
+        self.assertEquals(negotiate(None, 6, 0, True, None), (None, None))
+        self.assertEquals(negotiate("x-webkit-deflate-frame", 6, 0, True, None), (None, None))
+
+        extension, deflate = negotiate("permessage-deflate; client_max_window_bits", 6, 0, True, None)
+        self.assertEquals(extension, "permessage-deflate")
+        self.assertTrue(deflate.compress_takeover and deflate.decompress_takeover)
+
+        extension, deflate = negotiate("permessage-deflate; x_unknown, permessage-deflate; "
+                                       "server_no_context_takeover; server_max_window_bits=10", 6, 0, True, None)
+        self.assertEquals(extension, "permessage-deflate; server_no_context_takeover; server_max_window_bits=10")
+        self.assertEquals((deflate.compress_takeover, deflate.decompress_takeover, deflate.window_bits),
+                          (False, True, 10))
+
+        self.assertEquals(negotiate("permessage-deflate; server_max_window_bits=8", 6, 0, True, None), (None, None))
+
+        extension, deflate = negotiate("permessage-deflate", 6, 0, False, None)
+        self.assertEquals(extension, "permessage-deflate; server_no_context_takeover; client_no_context_takeover")
+        self.assertEquals(accept(extension, 6, 0, None).compress_takeover, False)
+
+    def test_messages_compressed_both_ways_with_context_takeover(self):
+        server_deflate, client_deflate = self._server_and_client()
+        client = DeflateStream(client_deflate, always_mask=True, expect_masking=False)
+        server = DeflateStream(server_deflate)
+        messages = ["\n".join(make_message("user_%d" % (i % 3), "message %d" % i) for i in range(50))
+                    for j in range(3)] + ["short", u"\u00e9t\u00e9 " * 20]
+
+        frames = [server_deflate.frame(message) for message in messages]
+        self.assertEquals(self._receive(client, frames), [message.encode("utf-8") for message in messages])
+        self.assertTrue(len(frames[1]) < len(frames[0]) < len(messages[0]) / 5)
+        self.assertEquals(ord(frames[3][0]) & 0x40, 0)
+
+        frames = [client_deflate.frame(message, mask=True) for message in messages]
+        self.assertEquals(self._receive(server, frames), [message.encode("utf-8") for message in messages])
+
+    def test_fragmented_compressed_message(self):
+        server_deflate, client_deflate = self._server_and_client(context_takeover=False)
+        payload = server_deflate.compress("@user >> " + "fragmented " * 100)
+        frames = [Frame(OPCODE_TEXT, payload[:10], fin=0, rsv1=1).build(),
+                  Frame(OPCODE_CONTINUATION, payload[10:], fin=1).build()]
+
+        stream = DeflateStream(client_deflate, always_mask=True, expect_masking=False)
+        self.assertEquals(self._receive(stream, frames), ["@user >> " + "fragmented " * 100])
+
+    def test_bad_compressed_messages_close_the_socket(self):
+        server_deflate, client_deflate = self._server_and_client(max_size=1000)
+        stream = DeflateStream(server_deflate)
+        stream.parser.send(client_deflate.frame("x" * 2000, mask=True))
+        self.assertEquals(stream.errors[0].code, 1009)
+
+        server_deflate, client_deflate = self._server_and_client()
+        stream = DeflateStream(server_deflate)
+        stream.parser.send(client_deflate.frame("\xff" * 20, mask=True))
+        self.assertEquals(stream.errors[0].code, 1007)
+
+    def test_server_socket_negotiates_and_compresses(self):
+        start_response = MagicMock()
+        sock = MagicMock()
+        environ = {"REQUEST_METHOD": "GET", "HTTP_UPGRADE": "websocket", "HTTP_CONNECTION": "Upgrade",
+                   "HTTP_SEC_WEBSOCKET_KEY": "dGhlIHNhbXBsZSBub25jZQ==", "HTTP_SEC_WEBSOCKET_VERSION": "13",
+                   "HTTP_SEC_WEBSOCKET_EXTENSIONS": "permessage-deflate", "ws4py.socket": sock}
+        ChatWSGIApplication(handler_cls=ChatWebSocketServer)(environ, start_response)
+        ws = environ["ws4py.websocket"]
+
+        # no zlib state is kept by default
+        extension = "permessage-deflate; server_no_context_takeover; client_no_context_takeover"
+        self.assertTrue(("Sec-WebSocket-Extensions", extension) in start_response.call_args[0][1])
+        self.assertTrue(isinstance(ws.stream, DeflateStream))
+        ws._write_frame("@user >> " + "x" * 1000)
+        self.assertEquals(ws.deflate._compressor, None)
+        client = DeflateStream(accept(extension, 6, 0, None), always_mask=True, expect_masking=False)
+        self.assertEquals(self._receive(client, [sock.sendall.call_args[0][0]]), ["@user >> " + "x" * 1000])
+
+    @override_settings(CHAT_DEFLATE_LEVEL=None)
+    def test_server_without_deflate(self):
+        start_response = MagicMock()
+        environ = {"REQUEST_METHOD": "GET", "HTTP_UPGRADE": "websocket", "HTTP_CONNECTION": "Upgrade",
+                   "HTTP_SEC_WEBSOCKET_KEY": "dGhlIHNhbXBsZSBub25jZQ==", "HTTP_SEC_WEBSOCKET_VERSION": "13",
+                   "HTTP_SEC_WEBSOCKET_EXTENSIONS": "permessage-deflate", "ws4py.socket": MagicMock()}
+        ChatWSGIApplication(handler_cls=ChatWebSocketServer)(environ, start_response)
+
+        self.assertEquals([header for header in start_response.call_args[0][1]
+                           if header[0] == "Sec-WebSocket-Extensions"], [])
+        self.assertEquals(environ["ws4py.websocket"].deflate, None)
+
+    def test_client_offers_deflate(self):
+        client = ChatWebsocketClient("ws://127.0.0.1:9000", [], deflate_level=1)
+        self.assertTrue(("Sec-WebSocket-Extensions", "permessage-deflate") in client.handshake_headers)
+        self.assertFalse("Sec-WebSocket-Extensions" in dict(ChatWebsocketClient("ws://127.0.0.1:9000", [])
+                                                            .handshake_headers))
+
+
+class OutboxTest(TestCase):
+    def setUp(self):
+        kill_greenlets()
+        self.write = MagicMock()
+        self.written = MagicMock()
+        self.disconnect = MagicMock()
+
+    def _outbox(self, **kwargs):
+        return Outbox(self.write, self.written, self.disconnect, **kwargs)
+
+    def test_pending_frames_coalesced(self):
+        outbox = self._outbox()
+        for frame in ("first", "second", "third"):
+            outbox.put(frame)
+        gevent.sleep(0)
+
+        self.write.assert_called_once_with("first\nsecond\nthird")
+        self.assertFalse(self.written.called)
+
+    def test_messages_confirmed_once_written(self):
+        events = []
+        outbox = Outbox(events.append, events.append, self.disconnect, coalesce_bytes=10)
+        outbox.put("first", [(None, 1)])
+        outbox.put("second")
+        outbox.put("third", [("#room", 3)])
+        gevent.sleep(0)
+
+        self.assertEquals(events, ["first\nsecond", [(None, 1)], "third", [("#room", 3)]])
+
+    def test_coalesced_frames_bounded(self):
+        outbox = self._outbox(coalesce_bytes=10)
+        for frame in ("first", "second", "third"):
+            outbox.put(frame)
+        gevent.sleep(0)
+
+        self.assertEquals(self.write.call_args_list, [call("first\nsecond"), call("third")])
+
+    def test_full_outbox_drops_oldest(self):
+        outbox = self._outbox(max_size=2, when_full=Outbox.DROP_OLDEST)
+        for i, frame in enumerate(("first", "second", "third")):
+            outbox.put(frame, [(None, i)])
+        gevent.sleep(0)
+
+        self.write.assert_called_once_with("second\nthird")
+        self.written.assert_called_once_with([(None, 1), (None, 2)])
+
+    def test_full_outbox_leaves_message_offline(self):
+        outbox = self._outbox(max_size=1, when_full=Outbox.OFFLINE)
+        outbox.put("first", [(None, 1)])
+        outbox.put("second", [(None, 2)])
+        gevent.sleep(0)
+
+        self.write.assert_called_once_with("first")
+        self.written.assert_called_once_with([(None, 1)])
+
+    def test_full_outbox_disconnects(self):
+        outbox = self._outbox(max_size=1, when_full=Outbox.DISCONNECT)
+        outbox.put("first")
+        outbox.put("second")
+
+        self.disconnect.assert_called_once_with()
+        self.assertEquals(outbox.writer, None)
+
+    def test_unknown_when_full_policy(self):
+        self.assertRaises(ValueError, self._outbox, when_full="block")
+
+    def test_writer_stops_when_outbox_empty(self):
+        outbox = self._outbox()
+        outbox.put("first")
+        gevent.sleep(0)
+        self.assertEquals(outbox.writer, None)
+
+        outbox.put("second")
+        gevent.sleep(0)
+        self.assertEquals(self.write.call_args_list, [call("first"), call("second")])
+
+    def test_flush_waits_until_frames_written(self):
+        outbox = self._outbox()
+        outbox.put("first")
+        outbox.put("second")
+
+        self.assertTrue(outbox.flush(1))
+        self.write.assert_called_once_with("first\nsecond")
+
+    def test_frames_unwritten_after_flush_timeout_left_offline(self):
+        self.write.side_effect = lambda frame: gevent.sleep(1)
+        outbox = self._outbox(coalesce_bytes=1)
+        outbox.put("first", [(None, 1)])
+        outbox.put("second", [(None, 2)])
+
+        self.assertFalse(outbox.flush(0.05))
+        self.assertEquals(outbox.qsize(), 0)
+        self.assertFalse(self.written.called)
+
+
+class AckTest(TestCase):
+    def setUp(self):
+        kill_greenlets()
+        self.write = MagicMock()
+        self.confirm = MagicMock()
+        self.disconnect = MagicMock()
+        server.redis_adapter = server.RedisAdapter()
+        server.message_writer = MessageWriter()
+
+    def _window(self, size=2, timeout=1, retries=1, backlog=1):
+        return AckWindow(self.write, self.confirm, self.disconnect, size, timeout, retries, backlog)
+
+    def _written(self):
+        return [c[0][0] for c in self.write.call_args_list]
+
+    def test_codec(self):
+        frame = "\n".join([make_record(12, 7, "@bob >> hi\n!13 8 2 no"), make_record(0, 0, u"caf\xe9")])
+        self.assertEquals(parse_records(frame), [(12, 7, "@bob >> hi\n!13 8 2 no"), (0, 0, "caf\xc3\xa9")])
+        self.assertEquals(parse_ack(make_ack(12)), 12)
+        self.assertRaises(Exception, parse_records, "!x 1 2 hi")
+        self.assertRaises(Exception, parse_records, "!1 1 9 hi")
+        self.assertRaises(Exception, parse_ack, "/ack")
+
+    def test_window_refilled_on_cumulative_ack(self):
+        window = self._window()
+        for i, message in enumerate(("first", "second", "third", "fourth")):
+            window.send([message], [(None, i)])
+        self.assertEquals(self._written(), ["!1 0 5 first", "!2 1 6 second"])
+
+        window.ack(2)
+        self.assertEquals(self._written(), ["!1 0 5 first", "!2 1 6 second", "!3 2 5 third"])
+        self.confirm.assert_called_once_with([(None, 0), (None, 1)])
+        window.ack(1)
+        window.ack(3)
+        self.assertTrue(window.wait(0))
+        self.assertEquals(self.confirm.call_args_list, [call([(None, 0), (None, 1)]), call([(None, 2)])])
+        window.close()
+
+    def test_unacknowledged_sent_again_then_disconnected(self):
+        window = self._window(timeout=0.02, retries=1)
+        window.send(["first", "#room @bob >> second"], [(None, 5), ("#room", 2)])
+        gevent.sleep(0.1)
+
+        frame = "!1 5 5 first\n!1 2 20 #room @bob >> second"
+        self.assertEquals(self._written(), [frame, frame])
+        self.disconnect.assert_called_once_with()
+
+    def test_progress_resets_retries(self):
+        window = self._window(timeout=0.05, retries=1)
+        window.send(["first"], [(None, 1)])
+        window.send(["second"], [(None, 2)])
+        gevent.sleep(0.07)
+        window.ack(1)
+        gevent.sleep(0.1)
+
+        self.assertFalse(self.disconnect.called)
+        self.assertEquals(self._written(), ["!1 1 5 first", "!2 2 6 second", "!1 1 5 first", "!2 2 6 second",
+                                            "!2 2 6 second"])
+        window.close()
+
+    def test_close_leaves_unacknowledged_unconfirmed(self):
+        window = self._window(backlog=2)
+        for i, message in enumerate(("first", "second", "third")):
+            window.send([message], [(None, i)])
+        window.ack(1)
+        window.close()
+
+        self.assertTrue(window.wait(0))
+        self.confirm.assert_called_once_with([(None, 0)])
+
+    def test_socket_acknowledges_only_with_protocol(self):
+        self.assertEquals(ChatWebSocketServer(MagicMock()).acks, None)
+        self.assertNotEquals(ChatWebSocketServer(MagicMock(), protocols=[ACK_PROTOCOL]).acks, None)
+
+    def test_unacknowledged_messages_replayed(self):
+        ws = ChatWebSocketServer(MagicMock(), protocols=[ACK_PROTOCOL])
+        ws.outbox.write = MagicMock()
+        ws.received_message("alice")
+        sender = MagicMock()
+        sender.user = UserModel.objects.create(username = "bob")
+        controller = ChatMessageController()
+        controller.process_message("@alice first", sender)
+        controller.process_message("@alice second", sender)
+        wait_for_listener()
+
+        records = [record for c in ws.outbox.write.call_args_list for record in parse_records(c[0][0])]
+        self.assertEquals([(message_id, text) for message_id, _, text in records[-2:]],
+                          [(1, make_message("bob", "first")), (2, make_message("bob", "second"))])
+        self.assertEquals([seq for _, seq, _ in records[-2:]],
+                          list(MessageModel.objects.order_by("id").values_list("seq", flat=True)))
+        ws.received_message(make_ack(1))
+        ws.closed(1000)
+        server.message_writer.flush()
+
+        self.assertEquals([(m.message_text, m.delivered) for m in MessageModel.objects.order_by("id")],
+                          [("first", True), ("second", False)])
+
+    def test_client_drops_duplicates_and_batches_acks(self):
+        client = ChatWebsocketClient("ws://127.0.0.1:9000", [], acks=True, ack_every=2, ack_delay=0.01)
+        client.send = MagicMock()
+        self.assertIn(ACK_PROTOCOL, client.protocols)
+
+        # a text that looks like a record is not one
+        second = "\n".join([make_record(2, 2, "@bob >> b\n!3 3 9 @bob >> c"), make_record(2, 1, "#room @bob >> b")])
+        client.received_message(TextMessage(make_record(1, 1, "@bob >> a")))
+        client.received_message(TextMessage(make_record(0, 0, "Joined #room.")))
+        client.received_message(TextMessage(second))
+        client.received_message(TextMessage(second))
+        client.received_message(TextMessage(make_record(4, 4, "@bob >> d")))
+        self.assertEquals(client.send.call_args_list, [call(make_ack(2)), call(make_ack(2))])
+        self.assertEquals(client.duplicates, 2)
+
+        client.received_message(TextMessage(make_record(3, 3, "@bob >> c")))
+        gevent.sleep(0.05)
+        client.send.assert_called_with(make_ack(4))
+        self.assertEquals([client.messages.get_nowait().data for i in range(client.messages.qsize())],
+                          ["@bob >> a", "Joined #room.", "@bob >> b\n!3 3 9 @bob >> c\n#room @bob >> b", "@bob >> d",
+                           "@bob >> c"])
+
+    def test_reconnected_client_drops_replayed_messages(self):
+        client = ChatWebsocketClient("ws://127.0.0.1:9000", [], acks=True)
+        client.send = MagicMock()
+        client.received_message(TextMessage(make_record(1, 5, "@bob >> a")))
+
+        # not acknowledged in time, the message is replayed at the next login
+        other = client.reconnected()
+        other.send = MagicMock()
+        other.received_message(TextMessage("\n".join([make_record(0, 5, "@bob >> a"), make_record(0, 5, "@carol >> a"),
+                                                       make_record(0, 0, make_resume("7"))])))
+
+        other.send.assert_called_once_with(make_resume("7"))
+        self.assertEquals(other.duplicates, 1)
+        self.assertEquals(other.messages.get_nowait().data, "@carol >> a")
+
+
+class LRUCacheTest(TestCase):
+    def test_least_recently_used_entry_evicted(self):
+        cache = LRUCache(2, 60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEquals(cache.get("a"), 1)
+        self.assertEquals(cache.get("b"), None)
+        self.assertEquals(cache.get("c"), 3)
+        self.assertEquals(cache.evictions, 1)
+        self.assertEquals(len(cache), 2)
+
+    def test_entries_expire(self):
+        cache = LRUCache(2, 60)
+        cache.set("a", 1, ttl=-1)
+        cache.set("b", 2)
+
+        self.assertEquals(cache.get("a", "expired"), "expired")
+        self.assertEquals(cache.get("b"), 2)
+
+    def test_hits_and_misses_counted(self):
+        cache = LRUCache(2, 60)
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("a")
+        cache.get("b")
+
+        self.assertEquals((cache.hits, cache.misses), (2, 1))
 
 
 class DataStoreAdapterTest(TestCase):
@@ -259,11 +1585,906 @@ class DataStoreAdapterTest(TestCase):
         ds.add_connection("username", ws)
 
         #should publish on redis
-        ds.send_message_to_channel("username", "message")
+        ds.send_message_to_channel("username", "message", 7)
+        wait_for_listener()
+
+        ws.deliver.assert_called_with(["message"], ((None, 7),))
+
+    def test_get_user_loads_user_once(self):
+        UserModel.objects.create(username = "username")
+        ds = server.RedisAdapter()
+
+        with self.assertNumQueries(1):
+            self.assertEquals(ds.get_user("username").username, "username")
+            self.assertEquals(ds.get_user("username").username, "username")
+        self.assertIsInstance(ds.get_user("username"), UserRecord)
+
+    def test_get_user_caches_unknown_username(self):
+        ds = server.RedisAdapter()
+
+        with self.assertNumQueries(1):
+            self.assertRaises(UserModel.DoesNotExist, ds.get_user, "unknown")
+            self.assertRaises(UserModel.DoesNotExist, ds.get_user, "unknown")
+
+    def test_stored_user_replaces_unknown_username(self):
+        ds = server.RedisAdapter()
+        self.assertRaises(UserModel.DoesNotExist, ds.get_user, "username")
+
+        user = UserModel.objects.create(username = "username")
+        ds.store_user(user)
+        self.assertEquals(ds.get_user("username"), user)
+
+    def test_failing_socket_does_not_stop_dispatch(self):
+        ws1 = MagicMock()
+        ws1.send = MagicMock(side_effect=Exception("closed"))
+        ws2 = MagicMock()
+        ds = server.RedisAdapter()
+        ds.add_connection("username", ws1)
+        ds.add_connection("username", ws2)
+
+        ds.send_message_to_channel("username", "first", 1)
+        ds.send_message_to_channel("username", "second", 2)
+        wait_for_listener()
+
+        ws2.deliver.assert_has_calls([call(["first"], ((None, 1),)), call(["second"], ((None, 2),))])
+
+    def test_sockets_of_same_user_share_one_subscription(self):
+        ds = server.RedisAdapter()
+        ds.add_connection("username", MagicMock())
+        ds.add_connection("username", MagicMock())
+
+        self.assertEquals(ds.shards.get("username").pubsub.channels.keys(), ["username"])
+        self.assertEquals(len(ds.subscriptions["username"]), 2)
+
+    def test_channel_unsubscribed_when_last_socket_removed(self):
+        ws1 = MagicMock()
+        ws2 = MagicMock()
+        ds = server.RedisAdapter()
+        ds.add_connection("username", ws1)
+        ds.add_connection("username", ws2)
+
+        ds.remove_connection("username", ws1)
+        self.assertEquals(ds.subscriptions["username"], [ws2])
+
+        ds.remove_connection("username", ws2)
+        self.assertFalse("username" in ds.subscriptions)
+        wait_for_listener()
+        shard = ds.shards.get("username")
+        self.assertFalse(shard.pubsub.subscribed)
+        self.assertTrue(ds.listeners[shard].dead)
+
+    def test_listener_does_not_poll_idle_channels(self):
+        ds = server.RedisAdapter()
+        ds.add_connection("username", MagicMock())
+        wait_for_listener()
+
+        pubsub = ds.shards.get("username").pubsub
+        pubsub.get_message = MagicMock(wraps=pubsub.get_message)
+        wait_for_listener()
+        self.assertEquals(pubsub.get_message.call_count, 0)
+
+class AutoPipelineTest(TestCase):
+    def setUp(self):
+        kill_greenlets()
+        self.redis = server.RedisAdapter().redis
+        self.redis.delete("autopipeline:counter", "autopipeline:text")
+        self.pipeline = AutoPipeline(self.redis)
+        self.incr = self.redis.register_script("return redis.call('INCR', KEYS[1])")
+
+    def _call_concurrently(self, *calls):
+        def call(function, *args):
+            try:
+                return self.pipeline.call(function, *args)
+            except Exception, e:
+                return e
+
+        greenlets = [gevent.spawn(call, *c) for c in calls]
+        gevent.joinall(greenlets)
+        return greenlets
+
+    def test_calls_of_one_tick_share_one_pipeline(self):
+        with patch.object(self.redis, "pipeline", wraps=self.redis.pipeline) as pipeline:
+            greenlets = self._call_concurrently(*[(self.incr, ["autopipeline:counter"])] * 10)
+
+        self.assertEquals(pipeline.call_count, 1)
+        self.assertEquals(sorted(g.value for g in greenlets), range(1, 11))
+
+    def test_error_returned_to_its_caller_only(self):
+        self.redis.set("autopipeline:text", "text")
+        good, bad = self._call_concurrently((self.incr, ["autopipeline:counter"]),
+                                            (self.incr, ["autopipeline:text"]))
+
+        self.assertEquals(good.value, 1)
+        self.assertTrue(isinstance(bad.value, redis_exceptions.ResponseError))
+
+    def test_calls_within_window_share_one_pipeline(self):
+        self.pipeline.window = 0.02
+        first = gevent.spawn(self.pipeline.call, self.incr, ["autopipeline:counter"])
+        gevent.sleep(0.005)
+        with patch.object(self.redis, "pipeline", wraps=self.redis.pipeline) as pipeline:
+            second = gevent.spawn(self.pipeline.call, self.incr, ["autopipeline:counter"])
+            gevent.joinall([first, second])
+
+        self.assertEquals(pipeline.call_count, 1)
+        self.assertEquals(sorted([first.value, second.value]), [1, 2])
+
+    def test_scripts_loaded_again_after_redis_lost_them(self):
+        self.assertEquals(self.pipeline.call(self.incr, ["autopipeline:counter"]), 1)
+
+        self.redis.script_flush()
+        self.assertEquals(self.pipeline.call(self.incr, ["autopipeline:counter"]), 2)
+        self.assertEquals(self.pipeline.call(self.incr, ["autopipeline:counter"]), 3)
+
+    @override_settings(CHAT_REDIS_MAX_CONNECTIONS=3, CHAT_REDIS_POOL_TIMEOUT=0.01)
+    def test_connection_pool_bounded(self):
+        pool = server.RedisAdapter().shards.home.pool
+        connections = [pool.get_connection("PING") for _ in range(3)]
+
+        self.assertRaises(redis_exceptions.ConnectionError, pool.get_connection, "PING")
+        for connection in connections:
+            pool.release(connection)
+
+
+class PresenceTest(TestCase):
+    def setUp(self):
+        kill_greenlets()
+        self.shards = server.RedisAdapter().shards
+        self.redis = self.shards.home.redis
+        self.redis.zrem(ONLINE_KEY, "presence_user")
+        self.redis.delete(USER_KEY % "presence_user")
+        self.presence = Presence(self.shards, 30, lambda: ["presence_user"])
+
+    def _other_node(self):
+        presence = Presence(self.shards, 30, lambda: [])
+        presence.node_id = "other_node"
+        return presence
+
+    def test_user_online_until_leaving(self):
+        self.presence.join("presence_user")
+        self.assertTrue(self.presence.is_online("presence_user"))
+        self.assertTrue("presence_user" in self.presence.online_users())
+
+        self.presence.leave("presence_user")
+        self.assertFalse(self.presence.is_online("presence_user"))
+        self.assertFalse("presence_user" in self.presence.online_users())
+
+    def test_user_online_while_on_any_node(self):
+        other_node = self._other_node()
+        self.assertFalse(self.presence.join("presence_user"))
+        self.assertTrue(other_node.join("presence_user"))
+
+        self.presence.leave("presence_user")
+        self.assertTrue(self.presence.is_online("presence_user"))
+
+        other_node.leave("presence_user")
+        self.assertFalse(self.presence.is_online("presence_user"))
+
+    def test_presence_expires_without_heartbeat(self):
+        self.presence.ttl = -1
+        self.presence.join("presence_user")
+        self.assertFalse(self.presence.is_online("presence_user"))
+
+        self.presence.ttl = 30
+        self.presence.refresh()
+        self.assertTrue(self.presence.is_online("presence_user"))
+
+    def test_refresh_forgets_expired_users(self):
+        other_node = self._other_node()
+        other_node.ttl = -1
+        other_node.join("presence_user")
+
+        self.presence.local_users = lambda: []
+        self.presence.refresh()
+        self.assertEquals(self.redis.zscore(ONLINE_KEY, "presence_user"), None)
+
+    def test_no_publish_to_offline_user(self):
+        subscriber = self.redis.pubsub(ignore_subscribe_messages=True)
+        subscriber.subscribe("presence_user")
+
+        self.assertEquals(self.presence.publish_if_online("presence_user", "message"), 0)
+        gevent.sleep(0.05)
+        self.assertEquals(subscriber.get_message(), None)
+
+        self.presence.join("presence_user")
+        self.assertEquals(self.presence.publish_if_online("presence_user", "message"), 1)
+        subscriber.close()
+
+    def test_message_to_offline_user_saved_undelivered(self):
+        from_user = UserModel.objects.create(username = "from_user")
+        UserModel.objects.create(username = "presence_user")
+        server.redis_adapter = server.RedisAdapter()
+        server.message_writer = MessageWriter()
+        ws = MagicMock()
+        ws.user = from_user
+
+        ChatMessageController().process_message("@presence_user some message", ws)
+        server.message_writer.flush()
+
+        self.assertFalse(MessageModel.objects.get().delivered)
+
+
+class RateLimitTest(TestCase):
+    def setUp(self):
+        kill_greenlets()
+        server.redis_adapter = server.RedisAdapter()
+        server.message_writer = MessageWriter()
+        self.redis = server.redis_adapter.redis
+        self.redis.delete(RATE_LIMIT_KEY % "limited_user")
+
+    @patch("ratelimit.time.time")
+    def test_token_bucket_refills_at_rate_up_to_burst(self, now):
+        now.return_value = 100.0
+        bucket = TokenBucket(10, 5)
+        self.assertTrue(bucket.take(5))
+        self.assertFalse(bucket.take())
+
+        now.return_value = 100.2
+        self.assertTrue(bucket.take(2))
+        self.assertFalse(bucket.take())
+
+        now.return_value = 200.0
+        self.assertFalse(bucket.take(6))
+        self.assertTrue(bucket.take(5))
+
+    def test_user_bucket_shared_by_servers(self):
+        servers = [UserRateLimit(server.RedisAdapter().shards, 0.01, 3) for i in range(2)]
+
+        self.assertEquals([servers[i % 2].take("limited_user") for i in range(4)], [True, True, True, False])
+        self.assertFalse(servers[0].take("limited_user", 2))
+        self.assertTrue(0 < self.redis.pttl(RATE_LIMIT_KEY % "limited_user") <= 301000)
+
+    def test_tokens_leased_and_spent_locally(self):
+        shards = server.RedisAdapter().shards
+        first, second = [UserRateLimit(shards, 0.01, 3, lease=2) for i in range(2)]
+
+        self.assertTrue(first.take("limited_user"))
+        self.assertTrue(second.take("limited_user"))
+        with patch.object(first, "_lease") as lease:
+            self.assertTrue(first.take("limited_user"))
+        self.assertFalse(lease.called)
+        self.assertFalse(second.take("limited_user"))
+
+        first.forget("limited_user")
+        self.assertFalse(first.take("limited_user"))
+
+    def _socket(self):
+        ws = ChatWebSocketServer(MagicMock())
+        ws.received_message("limited_user")
+        ws.outbox = MagicMock()
+        UserModel.objects.create(username = "to_user")
+        return ws
+
+    @override_settings(CHAT_SOCKET_RATE=0.01, CHAT_SOCKET_BURST=4)
+    @patch("server.SOCKET_THROTTLED")
+    def test_socket_over_limit_dropped_before_parsing(self, throttled):
+        # the login takes the first token
+        ws = self._socket()
+        ws.received_message(TextMessage(make_batch(["@to_user 1", "@to_user 2"])))
+
+        with self.assertNumQueries(0):
+            ws.received_message(TextMessage(make_batch(["@to_user 3", "@to_user 4"])))
+        ws.outbox.put.assert_called_with("Rate limit exceeded, the message was dropped.")
+        throttled.inc.assert_called_once_with(2)
+
+        ws.received_message("@to_user 5")
+        server.message_writer.flush()
+        self.assertEquals(sorted(MessageModel.objects.values_list("message_text", flat=True)), ["1", "2", "5"])
+
+    @override_settings(CHAT_USER_RATE=0.01, CHAT_USER_BURST=2)
+    @patch("server.USER_THROTTLED")
+    def test_user_limit_shared_by_sockets(self, throttled):
+        server.redis_adapter = server.RedisAdapter()
+        ws = self._socket()
+        other = ChatWebSocketServer(MagicMock())
+        other.received_message("limited_user")
+        other.outbox = MagicMock()
+
+        ws.received_message("@to_user 1")
+        other.received_message("@to_user 2")
+        other.received_message("@to_user 3")
+
+        other.outbox.put.assert_called_with("Rate limit exceeded, the message was dropped.")
+        throttled.inc.assert_called_once_with(1)
+
+    @override_settings(CHAT_USER_RATE=0.01, CHAT_USER_BURST=2)
+    def test_user_limit_open_while_its_node_is_down(self):
+        server.redis_adapter = server.RedisAdapter()
+        ws = self._socket()
+
+        with patch.object(server.redis_adapter.user_rate_limit, "take", side_effect=ShardDown("down")):
+            ws.received_message("@to_user 1")
+        server.message_writer.flush()
+
+        self.assertFalse(call("Rate limit exceeded, the message was dropped.") in ws.outbox.put.call_args_list)
+        self.assertEquals(list(MessageModel.objects.values_list("message_text", flat=True)), ["1"])
+
+    @override_settings(CHAT_SOCKET_RATE=None, CHAT_USER_RATE=None)
+    def test_limits_disabled(self):
+        server.redis_adapter = server.RedisAdapter()
+        ws = self._socket()
+        self.assertEquals(ws.rate_limit, None)
+        for i in range(500):
+            ws.received_message("@to_user %d" % i)
+        self.assertFalse(call("Rate limit exceeded, the message was dropped.") in ws.outbox.put.call_args_list)
+        # saved now, the worker would save them in the transaction of the next test
+        server.message_writer.flush()
+
+
+class RoomsTest(TestCase):
+    def setUp(self):
+        kill_greenlets()
+        server.redis_adapter = server.RedisAdapter()
+        server.message_writer = MessageWriter()
+        self.redis = server.redis_adapter.redis
+        self.users = {}
+        for username in ("room_user_1", "room_user_2", "room_user_3"):
+            self.redis.delete(USER_ROOMS_KEY % username, USER_KEY % username)
+            self.redis.zrem(ONLINE_KEY, username)
+            self.users[username] = UserModel.objects.create(username = username)
+            self.redis.delete(READS_KEY % username)
+        self.redis.delete(ROOM_KEY % "#room", ROOM_SEQ_KEY % "#room")
+
+    def _connect(self, username, adapter=None):
+        ws = MagicMock()
+        ws.user = self.users[username]
+        (adapter or server.redis_adapter).add_connection(username, ws)
+        return ws
+
+    def _send(self, ws, message):
+        ChatMessageController().process_message(message, ws)
+
+    def test_join_subscribes_local_sockets_once(self):
+        ws1 = self._connect("room_user_1")
+        ws2 = self._connect("room_user_1")
+        self._send(ws1, "/join #room")
+
+        ws1.send.assert_called_with("Joined #room.")
+        self.assertEquals(server.redis_adapter.subscriptions["#room"], [ws1, ws2])
+        self.assertEquals(server.redis_adapter.rooms.members("#room"), set(["room_user_1"]))
+
+        self._send(ws1, "/leave #room")
+        self.assertFalse("#room" in server.redis_adapter.subscriptions)
+        self.assertEquals(server.redis_adapter.rooms.members("#room"), set())
+
+    def test_rooms_restored_on_connect(self):
+        server.redis_adapter.join_room("room_user_1", "#room")
+        ws = self._connect("room_user_1")
+        self.assertEquals(server.redis_adapter.subscriptions["#room"], [ws])
+
+        server.redis_adapter.remove_connection("room_user_1", ws)
+        self.assertEquals(server.redis_adapter.subscriptions, {})
+
+    def test_room_message_published_once_per_node(self):
+        other_node = server.RedisAdapter()
+        ws1 = self._connect("room_user_1")
+        ws2 = self._connect("room_user_2")
+        ws3 = self._connect("room_user_3", other_node)
+        self._send(ws1, "/join #room")
+        self._send(ws2, "/join #room")
+        other_node.join_room("room_user_3", "#room")
+
+        with patch.object(server.redis_adapter.rooms, "publish",
+                          wraps=server.redis_adapter.rooms.publish) as publish:
+            self._send(ws1, "#room hello all")
+            self.assertEquals(publish.call_count, 1)
+        wait_for_listener()
+
+        for ws in (ws1, ws2, ws3):
+            ws.deliver.assert_called_with(["#room @room_user_1 >> hello all"], (("#room", 1),))
+
+    def _room_lines(self, ws):
+        return [line for line in written_lines(ws) if line[:1] == "#"]
+
+    def test_room_message_stored_once_and_read_at_login(self):
+        for username in ("room_user_1", "room_user_2", "room_user_3"):
+            server.redis_adapter.join_room(username, "#room")
+        ws1 = self._connect("room_user_1")
+        ws3 = self._connect("room_user_3")
+
+        self._send(ws1, "#room first")
+        self._send(ws1, "#room second")
+        server.message_writer.flush()
+        wait_for_listener()
+        self.assertEquals(list(MessageModel.objects.order_by("room_seq").values_list("room", "room_seq", "to_user")),
+                          [("#room", 1, None), ("#room", 2, None)])
+
+        ws2 = log_in("room_user_2")
+        self.assertEquals(self._room_lines(ws2), ["#room @room_user_1 >> first", "#room @room_user_1 >> second"])
+        ws2.closed(1000)
+        self.assertEquals(server.redis_adapter.rooms.reads("room_user_2"), {"#room": 2})
+        self.assertEquals(self._room_lines(log_in("room_user_2")), [])
+
+        # online elsewhere, so it got them live
+        self.assertEquals(self._room_lines(log_in("room_user_3")), [])
+
+    def test_reads_advance_only_through_consecutive_room_seqs(self):
+        server.redis_adapter.join_room("room_user_1", "#room")
+        rooms = server.redis_adapter.rooms
+        for i in range(5):
+            rooms.publish("#room", "message")
+
+        reads = RoomReads()
+        for room_seq in (4, 1, 2, 6):
+            reads.read("#room", room_seq)
+        reads.read("#left", 1)
+        self.assertEquals(reads.runs["#room"], [[1, 2], [4, 4], [6, 6]])
+        rooms.save_reads("room_user_1", reads)
+        self.assertEquals(rooms.reads("room_user_1"), {"#room": 2})
+
+        reads.read("#room", 3)
+        self.assertEquals(reads.runs["#room"], [[1, 4], [6, 6]])
+        rooms.save_reads("room_user_1", reads)
+        self.assertEquals(rooms.reads("room_user_1"), {"#room": 4})
+
+    def test_only_members_send_to_room(self):
+        ws = self._connect("room_user_1")
+        self._send(ws, "#room hello all")
+
+        ws.send.assert_called_with("You are not a member of #room.")
+        self.assertEquals(server.message_writer.queue.qsize(), 0)
+
+    def test_invalid_commands_rejected(self):
+        ws = self._connect("room_user_1")
+        self._send(ws, "/join room")
+        ws.send.assert_called_with("Usage: /join #room")
+        self._send(ws, "/shout #room")
+        ws.send.assert_called_with("Unknown command /shout.")
+
+    def test_username_cannot_be_a_room(self):
+        self.assertEquals(server.Authentication().authenticate("#room"), None)
+
+
+class ShardingTest(TestCase):
+    """ Shards over the redis server on 6379 and two more started for the tests."""
+
+    PORTS = (6391, 6392)
+    ROOMS = ["#shard_room_%d" % i for i in range(20)]
+
+    @classmethod
+    def setUpClass(cls):
+        super(ShardingTest, cls).setUpClass()
+        cls.servers = dict((port, start_redis(port)) for port in cls.PORTS)
+
+    @classmethod
+    def tearDownClass(cls):
+        for process in cls.servers.values():
+            process.terminate()
+            process.wait()
+        super(ShardingTest, cls).tearDownClass()
+
+    def setUp(self):
+        kill_greenlets()
+        self.nodes = ["redis://localhost:6379/0"] + ["redis://localhost:%d/0" % port for port in self.PORTS]
+        with override_settings(CHAT_REDIS_NODES=self.nodes):
+            server.redis_adapter = server.RedisAdapter()
+        server.message_writer = MessageWriter()
+        self.shards = server.redis_adapter.shards
+        self.users = [self._name_on(shard) for shard in self.shards]
+        for shard in self.shards:
+            for username in self.users:
+                shard.redis.delete(USER_ROOMS_KEY % username, USER_KEY % username, READS_KEY % username)
+                shard.redis.zrem(ONLINE_KEY, username)
+            shard.redis.delete(*[ROOM_KEY % room for room in self.ROOMS] + [ROOM_SEQ_KEY % room for room in self.ROOMS])
+
+    def tearDown(self):
+        kill_greenlets()
+        for shard in self.shards:
+            shard.pubsub.close()
+        server.redis_adapter = server.RedisAdapter()
+
+    def _name_on(self, shard, prefix="shard_user_"):
+        return next(name for name in ("%s%d" % (prefix, i) for i in range(1000)) if self.shards.get(name) is shard)
+
+    def test_ring_spreads_keys(self):
+        ring = HashRing(["a", "b", "c", "d"])
+        counts = {}
+        for i in range(10000):
+            node = ring.get("user_%d" % i)
+            counts[node] = counts.get(node, 0) + 1
+
+        self.assertEquals(sorted(counts), ["a", "b", "c", "d"])
+        self.assertTrue(all(1500 < count < 3500 for count in counts.values()), counts)
+
+    def test_ring_moves_keys_only_to_added_node(self):
+        keys = ["user_%d" % i for i in range(10000)]
+        ring = HashRing(["a", "b", "c"])
+        before = [ring.get(key) for key in keys]
+
+        ring.add("d")
+        moved = [ring.get(key) for key, node in zip(keys, before) if ring.get(key) != node]
+        self.assertEquals(set(moved), set(["d"]))
+        self.assertTrue(1500 < len(moved) < 3500, len(moved))
+
+        ring.remove("d")
+        self.assertEquals([ring.get(key) for key in keys], before)
+
+    def test_user_channels_on_their_shards(self):
+        sockets = []
+        for username in self.users:
+            ws = MagicMock()
+            server.redis_adapter.add_connection(username, ws)
+            sockets.append(ws)
+
+        for shard, username in zip(self.shards, self.users):
+            self.assertEquals(shard.pubsub.channels.keys(), [username])
+            self.assertEquals(server.redis_adapter.send_message_to_channel(username, "to " + username, 1), 1)
+        wait_for_listener()
+
+        for ws, username in zip(sockets, self.users):
+            ws.deliver.assert_called_once_with(["to " + username], ((None, 1),))
+
+    def test_room_members_on_other_shards(self):
+        room = next(room for room in self.ROOMS if self.shards.get(room) is self.shards.home)
+        online, offline = self.users[1:]
+        ws = MagicMock()
+        server.redis_adapter.add_connection(online, ws)
+        server.redis_adapter.join_room(online, room)
+        server.redis_adapter.join_room(offline, room)
+
+        self.assertEquals(server.redis_adapter.send_message_to_room(room, "hello"), 1)
+        wait_for_listener()
+        ws.deliver.assert_called_once_with(["hello"], ((room, 1),))
+        self.assertEquals(server.redis_adapter.rooms.rooms_of(offline), set([room]))
+        self.assertEquals([shard.redis.exists(USER_ROOMS_KEY % offline) for shard in self.shards], [0, 0, 1])
+
+    def test_presence_kept_on_the_shard_of_the_user(self):
+        for username in self.users:
+            server.redis_adapter.add_connection(username, MagicMock())
+        server.redis_adapter.presence.refresh()
+
+        for shard, username in zip(self.shards, self.users):
+            self.assertEquals([other.redis.zscore(ONLINE_KEY, username) is not None for other in self.shards],
+                              [other is shard for other in self.shards])
+            self.assertEquals([other.redis.exists(USER_KEY % username) for other in self.shards],
+                              [int(other is shard) for other in self.shards])
+        self.assertTrue(set(self.users) <= set(server.redis_adapter.presence.online_users()))
+
+    def test_down_shard_fails_fast_until_it_answers(self):
+        username, other = self.users[2], self.users[1]
+        process = self.servers[6392]
+        process.terminate()
+        process.wait()
+
+        self.shards.check(0.5)
+        self.assertEquals(self.shards.down(), [self.shards.nodes[2]])
+        with patch("redis.connection.Connection.connect") as connect:
+            self.assertRaises(ShardDown, server.redis_adapter.send_message_to_channel, username, "message", 1)
+        self.assertFalse(connect.called)
+        self.assertEquals(server.redis_adapter.send_message_to_channel(other, "message", 1), 0)
+
+        self.servers[6392] = start_redis(6392)
+        self.shards.check(0.5)
+        self.assertEquals(self.shards.down(), [])
+        self.assertEquals(server.redis_adapter.send_message_to_channel(username, "message", 1), 0)
+
+    def test_rebalance_moves_rooms_to_added_node(self):
+        with override_settings(CHAT_REDIS_NODES=self.nodes[:2]):
+            rooms = server.RedisAdapter().rooms
+        for room in self.ROOMS:
+            rooms.join(self.users[0], room)
+            rooms.publish(room, "message")
+
+        grown = Rooms(Shards(self.nodes))
+        moved = grown.rebalance()
+        self.assertTrue(0 < moved < len(self.ROOMS), moved)
+        self.assertEquals(grown.rebalance(), 0)
+
+        self.assertEquals(grown.rooms_of(self.users[0]), set(self.ROOMS))
+        self.assertEquals(grown.reads(self.users[0]), dict((room, 0) for room in self.ROOMS))
+        for room in self.ROOMS:
+            self.assertEquals(grown.publish(room, "message"), 2)
+            self.assertEquals(grown.members(room), set([self.users[0]]))
+            self.assertEquals([shard.redis.exists(ROOM_KEY % room) for shard in grown.shards],
+                              [int(shard is grown.shards.get(room)) for shard in grown.shards])
+
+
+class MetricsTest(TestCase):
+    def test_counter_and_gauge_rendered(self):
+        registry = metrics.Registry(True)
+        registry.counter("chat_test_total", "Test counter.").inc(3)
+        registry.gauge("chat_test_gauge", "Test gauge.", lambda: 7)
+
+        self.assertEquals(registry.render(), "\n".join([
+            "# HELP chat_test_total Test counter.",
+            "# TYPE chat_test_total counter",
+            "chat_test_total 3",
+            "# HELP chat_test_gauge Test gauge.",
+            "# TYPE chat_test_gauge gauge",
+            "chat_test_gauge 7"]) + "\n")
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Registry(True).histogram("chat_test_seconds", "Test.", buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.observe(value)
+
+        samples = dict(histogram.samples())
+        self.assertEquals(samples['chat_test_seconds_bucket{le="0.1"}'], 2)
+        self.assertEquals(samples['chat_test_seconds_bucket{le="1"}'], 3)
+        self.assertEquals(samples['chat_test_seconds_bucket{le="+Inf"}'], 4)
+        self.assertEquals(samples["chat_test_seconds_count"], 4)
+
+    def test_histogram_times_block(self):
+        histogram = metrics.Registry(True).histogram("chat_test_seconds", "Test.")
+        with histogram.time():
+            pass
+
+        self.assertEquals(dict(histogram.samples())["chat_test_seconds_count"], 1)
+
+    def test_gauge_set_without_function(self):
+        gauge = metrics.Registry(True).gauge("chat_test_gauge", "Test gauge.")
+        gauge.inc(3)
+        gauge.dec()
+
+        self.assertEquals(list(gauge.samples()), [("chat_test_gauge", 2)])
+
+    def test_connection_greenlets_counted(self):
+        gauge = metrics.Registry(True).gauge("chat_test_gauge", "Test gauge.")
+        pool = server.ChatWebSocketPool()
+        with patch.object(server, "CONNECTION_GREENLETS", gauge):
+            greenlets = [pool.spawn(gevent.sleep, 0.01) for _ in range(3)]
+            self.assertEquals(gauge.value, 3)
+
+            pool.discard(greenlets[0])
+            gevent.joinall(greenlets)
+        self.assertEquals(gauge.value, 0)
+
+    def test_disabled_registry_returns_no_op_metrics(self):
+        registry = metrics.Registry(False)
+        counter = registry.counter("chat_test_total", "Test counter.")
+
+        self.assertTrue(counter is metrics.NULL_METRIC)
+        self.assertTrue(registry.histogram("chat_test_seconds", "Test.") is metrics.NULL_METRIC)
+        counter.inc()
+        with registry.histogram("chat_test_seconds", "Test.").time():
+            pass
+        self.assertEquals(registry.render(), "\n")
+
+    def test_metrics_served_over_http(self):
+        registry = metrics.Registry(True)
+        registry.counter("chat_test_total", "Test counter.").inc()
+        http_server = registry.serve(0)
+
+        connection = gevent.socket.create_connection(("127.0.0.1", http_server.server_port))
+        connection.sendall("GET /metrics HTTP/1.0\r\n\r\n")
+        response = connection.makefile().read()
+        http_server.stop()
+
+        self.assertTrue(response.startswith("HTTP/1.1 200 OK"))
+        self.assertTrue(response.endswith("chat_test_total 1\n"))
+
+    def test_routed_messages_counted(self):
+        UserModel.objects.create(username = "to_user")
+        server.redis_adapter = server.RedisAdapter()
+        server.message_writer = MessageWriter()
+        server.redis_adapter.add_connection("to_user", MagicMock())
+        ws = MagicMock()
+        ws.user = UserModel.objects.create(username = "from_user")
+        routed = metrics.Counter("chat_messages_routed_total", "Test.")
+
+        with patch.object(server, "MESSAGES_ROUTED", routed):
+            ChatMessageController().process_message("@to_user some message", ws)
+
+        self.assertEquals(routed.value, 1)
+
+
+class DrainTest(TestCase):
+    def setUp(self):
+        kill_greenlets()
+        server.redis_adapter = server.RedisAdapter()
+        server.message_writer = MessageWriter()
+        self.wsgi_server = MagicMock()
+
+    def _login(self, username):
+        ws = log_in(username)
+        ws.close = MagicMock()
+        return ws
+
+    def test_clients_told_to_reconnect_within_spread(self):
+        sockets = [self._login("alice"), self._login("bob")]
+        server.drain(self.wsgi_server, timeout=1, spread=2)
+
+        self.wsgi_server.stop_accepting.assert_called_once_with()
+        self.assertTrue(self.wsgi_server.stop.called)
+        for ws in sockets:
+            delays = [int(line.split()[1]) for line in written_lines(ws) if line.startswith("/reconnect ")]
+            self.assertEquals(len(delays), 1)
+            self.assertTrue(0 <= delays[0] <= 2000)
+            ws.close.assert_called_once_with(1001, "Server restarting")
+        self.assertEquals(server.redis_adapter.stats(), {"users": 0, "sockets": 0})
+
+    def test_messages_sent_while_draining_kept_for_replay(self):
+        alice = UserModel.objects.get(username = self._login("alice").user.username)
+        server.drain(self.wsgi_server, timeout=1, spread=0)
+
+        sender = MagicMock()
+        sender.user = UserModel.objects.create(username = "bob")
+        ChatMessageController().process_message("@alice after the drain", sender)
+        server.message_writer.flush()
+        self.assertFalse(MessageModel.objects.get(to_user = alice).delivered)
+
+    def test_unwritten_frames_kept_for_replay(self):
+        ws = self._login("alice")
+        sender = MagicMock()
+        sender.user = UserModel.objects.create(username = "bob")
+        ws.outbox.write.side_effect = lambda frame: gevent.sleep(1)
+        ws.outbox.coalesce_bytes = 1
+        ws.send("first frame")
+        ChatMessageController().process_message("@alice still queued", sender)
+        wait_for_listener()
+
+        server.drain(self.wsgi_server, timeout=0.05, spread=0)
+        server.message_writer.flush()
+        self.assertEquals(list(MessageModel.objects.values_list("message_text", "delivered")),
+                          [("still queued", False)])
+        ws.close.assert_called_once_with(1001, "Server restarting")
+
+
+class CooperativeTest(TestCase):
+    def setUp(self):
+        kill_greenlets()
+        server.redis_adapter = server.RedisAdapter()
+
+    def _login(self, username):
+        ws = log_in(username)
+        ws.outbox.write.reset_mock()
+        return ws
+
+    def test_standard_library_patched(self):
+        self.assertTrue(socket.socket is gevent.socket.socket)
+
+    def test_database_thread_errors_raised_in_caller(self):
+        threads = DatabaseThreads(1)
+        threads.pool = ThreadPool(1)
+
+        self.assertEquals(list(threads.iterate(iter([1, 2]))), [1, 2])
+        self.assertRaises(KeyError, threads.call, {}.__getitem__, "missing")
+
+    def test_slow_query_does_not_delay_other_sockets(self):
+        sleep = monkey.get_original("time", "sleep")
+        def slow_history(store, user, other, before_seq, limit):
+            sleep(0.5)
+            return []
+
+        server.message_writer = MessageWriter()
+        alice, bob, carol = [self._login(username) for username in ("alice", "bob", "carol")]
+        # the test database is in memory, so the pool is made here
+        threads = DatabaseThreads(2)
+        threads.pool = ThreadPool(2)
+        server.message_writer = MessageWriter(store=DjangoStore(threads))
+
+        with patch.object(DjangoStore, "_history", slow_history), patch.object(DjangoStore, "_save"):
+            start = time.time()
+            history = gevent.spawn(alice.received_message, "/history @bob")
+            gevent.sleep(0.05)
+            carol.received_message("@bob hello")
+            while not bob.outbox.write.called and time.time() - start < 2:
+                gevent.sleep(0.01)
+            delivered = time.time() - start
+            history.join()
+
+        bob.outbox.write.assert_called_once_with(make_message("carol", "hello"))
+        self.assertTrue(delivered < 0.4, delivered)
+        self.assertTrue(time.time() - start >= 0.5)
+
+
+class ServerScriptTest(TestCase):
+    def test_server_imports_without_django_settings_module(self):
+        env = dict(os.environ)
+        env.pop("DJANGO_SETTINGS_MODULE", None)
+        command = [sys.executable, "-c", "import server"]
+
+        self.assertEquals(subprocess.call(command, env=env, cwd=os.path.dirname(server.__file__) or "."), 0)
+
+
+class WorkersTest(TestCase):
+    def test_workers_listen_on_same_port(self):
+        first = reuseport_listener(('127.0.0.1', 0))
+        second = reuseport_listener(first.getsockname())
+
+        self.assertEquals(first.getsockname(), second.getsockname())
+        first.close()
+        second.close()
+
+    def test_worker_health_published_to_redis(self):
+        redis = server.RedisAdapter().redis
+        health = WorkerHealth(redis, "test_worker", lambda: {"sockets": 3})
+        health.publish()
+
+        report = worker_status(redis)["test_worker"]
+        self.assertEquals(report["sockets"], 3)
+        self.assertEquals(report["pid"], os.getpid())
+
+        health.stop()
+        self.assertFalse("test_worker" in worker_status(redis))
+
+    def test_arbiter_replaces_workers(self):
+        arbiter = Arbiter([sys.executable, "-c", "import time; time.sleep(30)"], 2)
+        arbiter.workers = [arbiter._spawn(i) for i in range(2)]
+        old_workers = list(arbiter.workers)
+
+        arbiter._replace_all()
+        self.assertTrue(all(worker.poll() is not None for worker in old_workers))
+        self.assertTrue(all(worker.poll() is None for worker in arbiter.workers))
+
+        arbiter._terminate(arbiter.workers)
+        self.assertTrue(all(worker.poll() is not None for worker in arbiter.workers))
+
+    def test_old_worker_stopped_once_new_one_is_ready(self):
+        def ready(worker):
+            checks.append(old_worker.poll())
+            return len(checks) == 3
+
+        checks = []
+        arbiter = Arbiter([sys.executable, "-c", "import time; time.sleep(30)"], 1, ready=ready)
+        arbiter.workers = [arbiter._spawn(0)]
+        old_worker = arbiter.workers[0]
+
+        arbiter._replace_all()
+        self.assertEquals(checks, [None] * 3)
+        self.assertTrue(old_worker.poll() is not None)
+        self.assertTrue(arbiter.workers[0] is not old_worker)
+        arbiter._terminate(arbiter.workers)
+
+    def test_old_worker_kept_if_new_one_is_not_ready(self):
+        arbiter = Arbiter([sys.executable, "-c", "import time; time.sleep(30)"], 1, ready=lambda worker: False,
+                          start_timeout=0.3)
+        arbiter.workers = [arbiter._spawn(0)]
+        old_worker = arbiter.workers[0]
+
+        arbiter._replace_all()
+        self.assertTrue(arbiter.workers == [old_worker])
+        self.assertTrue(old_worker.poll() is None)
+        arbiter._terminate(arbiter.workers)
+
+    def test_worker_ready_once_reported(self):
+        redis = server.RedisAdapter().redis
+        health = WorkerHealth(redis, "test_worker", lambda: {})
+        self.assertFalse(has_reported(redis, os.getpid()))
+
+        health.publish()
+        self.assertTrue(has_reported(redis, os.getpid()))
+        health.stop()
 
-        ws.send.assert_called_with("message")
 
 def kill_greenlets():
     for ob in gc.get_objects():
         if isinstance(ob, Greenlet):
-            ob.kill()
\ No newline at end of file
+            ob.kill()
+
+def start_redis(port):
+    """ Starts a redis server without persistence on port and waits until it answers."""
+
+    process = subprocess.Popen(["redis-server", "--port", str(port), "--save", "", "--appendonly", "no"],
+                               stdout=open(os.devnull, "w"))
+    client = StrictRedis(port=port)
+    for i in range(100):
+        try:
+            client.ping()
+            return process
+        except redis_exceptions.ConnectionError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("redis-server did not start on port %d" % port)
+
+def wait_for_listener():
+    """ Lets the redis listener greenlet dispatch the published messages."""
+    gevent.sleep(0.1)
+
+def sent_lines(ws):
+    """ The lines of each frame send_lines sent on the mock socket ws."""
+
+    return [c[0][0] for c in ws.send_lines.call_args_list]
+
+def log_in(login):
+    """ Logs a ChatWebSocketServer on a mock socket in with the message login, the frames it writes recorded."""
+
+    ws = ChatWebSocketServer(MagicMock())
+    ws.outbox.write = MagicMock()
+    ws.received_message(login)
+    gevent.sleep(0)
+    return ws
+
+def written_lines(ws):
+    """ The lines of the frames the outbox of ws has written."""
+
+    return "\n".join(c[0][0] for c in ws.outbox.write.call_args_list).split("\n")
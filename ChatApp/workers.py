@@ -0,0 +1,182 @@
+"""
+Multi-process mode of the chat server.  The arbiter starts N worker processes
+that all listen on the same port with SO_REUSEPORT, so the kernel spreads the
+connections among them.  Workers deliver messages to each other through the
+same redis channels that connect separate servers.
+
+The arbiter restarts workers that die.  On SIGHUP it replaces the workers one
+by one, stopping the old worker only once the new one has published its
+first health report, so the port keeps accepting connections.  SIGTERM or
+SIGINT stops every worker.
+"""
+import json
+import os
+import signal
+import socket as stdlib_socket
+import subprocess
+import time
+import gevent
+from gevent import socket
+
+SO_REUSEPORT = getattr(stdlib_socket, "SO_REUSEPORT", 15)
+
+WORKERS_KEY = "chat:workers"
+WORKER_KEY = "chat:worker:%s"
+
+
+def reuseport_listener(address, backlog=1024):
+    """ Listening socket that other processes can bind to the same address."""
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
+
+
+class WorkerHealth(object):
+    """
+    Publishes the health of a worker to redis every interval seconds.  The
+    report expires if the worker stops publishing it.
+    """
+
+    def __init__(self, redis, worker_id, report, interval=5):
+        self.redis = redis
+        self.worker_id = worker_id
+        self.report = report
+        self.interval = interval
+        self.started = time.time()
+        self.greenlet = None
+
+    def start(self):
+        self.greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+        self.redis.srem(WORKERS_KEY, self.worker_id)
+        self.redis.delete(WORKER_KEY % self.worker_id)
+
+    def publish(self):
+        health = dict(self.report(), pid=os.getpid(), uptime=int(time.time() - self.started),
+                      updated=int(time.time()))
+        pipe = self.redis.pipeline()
+        pipe.sadd(WORKERS_KEY, self.worker_id)
+        pipe.setex(WORKER_KEY % self.worker_id, 3 * self.interval, json.dumps(health))
+        pipe.execute()
+
+    def _run(self):
+        while True:
+            try:
+                self.publish()
+            except Exception:
+                pass
+            gevent.sleep(self.interval)
+
+
+def worker_status(redis):
+    """ Latest health report of every worker, None for workers that stopped reporting."""
+
+    worker_ids = sorted(redis.smembers(WORKERS_KEY))
+    if not worker_ids:
+        return {}
+
+    reports = redis.mget([WORKER_KEY % worker_id for worker_id in worker_ids])
+    return dict((worker_id, json.loads(report) if report else None)
+                for worker_id, report in zip(worker_ids, reports))
+
+
+def has_reported(redis, pid):
+    """ Whether the worker process pid has published a health report, which it does once it serves."""
+
+    return any(report is not None and report["pid"] == pid for report in worker_status(redis).values())
+
+
+class Arbiter(object):
+    def __init__(self, command, workers, stop_timeout=10, ready=None, start_timeout=30):
+        """
+        command is the argument list that starts one worker process.  A worker
+        that has not exited stop_timeout seconds after SIGTERM is killed.
+        ready tells whether a worker process serves; a worker that is not
+        ready start_timeout seconds after it was started does not replace the
+        old one.  Without ready a worker is ready once started.
+        """
+
+        self.command = command
+        self.workers_num = workers
+        self.stop_timeout = stop_timeout
+        self.ready = ready or (lambda worker: True)
+        self.start_timeout = start_timeout
+        self.workers = []
+        self.stopping = False
+        self.restarting = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._restart)
+
+        for i in range(self.workers_num):
+            self.workers.append(self._spawn(i))
+
+        while not self.stopping:
+            if self.restarting:
+                self.restarting = False
+                self._replace_all()
+
+            for i, worker in enumerate(self.workers):
+                if worker.poll() is not None:
+                    print "Worker %d exited with %d, restarting it." % (worker.pid, worker.returncode)
+                    self.workers[i] = self._spawn(i)
+
+            time.sleep(0.5)
+
+        self._terminate(self.workers)
+
+    def _spawn(self, index):
+        """ Starts the worker for slot index, which keeps its index when replaced."""
+
+        return subprocess.Popen(self.command + ["--index", str(index)], preexec_fn=_ignore_sigint)
+
+    def _replace_all(self):
+        for i, worker in enumerate(self.workers):
+            replacement = self._spawn(i)
+            if self._wait_ready(replacement):
+                self.workers[i] = replacement
+                self._terminate([worker])
+            else:
+                print "Worker %d did not become ready, keeping worker %d." % (replacement.pid, worker.pid)
+                self._terminate([replacement])
+
+    def _wait_ready(self, worker):
+        deadline = time.time() + self.start_timeout
+        while worker.poll() is None and not self.stopping and time.time() < deadline:
+            if self.ready(worker):
+                return True
+            time.sleep(0.1)
+        return False
+
+    def _terminate(self, workers):
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+
+        deadline = time.time() + self.stop_timeout
+        for worker in workers:
+            while worker.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if worker.poll() is None:
+                worker.kill()
+                worker.wait()
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def _restart(self, signum, frame):
+        self.restarting = True
+
+
+def _ignore_sigint():
+    # Ctrl-C reaches the whole process group; only the arbiter handles it.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)